@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+"""
+Command line entry point: `python -m pct [command]`.
+
+Without a command the interactive composer is started.
+"""
+
+import argparse
+import sys
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='pct',
+        description='Pictionary-Telephone Tool',
+    )
+    commands = parser.add_subparsers(dest='command')
+
+    commands.add_parser('interact', help='run the interactive composer')
+
+    serve = commands.add_parser('serve', help='run the HTTP composer service')
+    serve.add_argument('--host')
+    serve.add_argument('--port', type=int)
+    serve.add_argument('--workers', type=int)
+    serve.add_argument('--queue', type=int)
+
+    calibrate = commands.add_parser(
+        'calibrate',
+        help='benchmark this host and write a tuned settings profile',
+    )
+    calibrate.add_argument('--output', help='settings file to write')
+
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    arguments = parse_arguments(argv)
+
+    if arguments.command == 'serve':
+        from .server.server import serve
+        return serve(
+            arguments.host,
+            arguments.port,
+            arguments.workers,
+            arguments.queue,
+        )
+
+    if arguments.command == 'calibrate':
+        from .benchmarks.calibrate import calibrate_and_save
+        filepath, report = calibrate_and_save(arguments.output)
+        print('\n'.join(report))
+        print('Wrote {}'.format(filepath))
+        return 0
+
+    from .interactor.interactor import PctInteractor
+    PctInteractor().cmdloop()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+
+"""
+Image backend selection benchmark.
+
+Times each image backend on every operation (decode, encode, resize,
+rotate, blur, edges) over synthetic cards of each size class, checks its
+output against OpenCV's, and saves the fastest backend for each operation
+and size class to the per-host selection cache used when PCT_IMAGE_BACKEND
+is 'auto'::
+
+  python -m pct.benchmarks.backends [--output FILE]
+"""
+
+import argparse
+import math
+import sys
+import tempfile
+
+from ..common.configuration import (
+    PCT_BACKEND_SIZES,
+    PCT_BACKEND_SLOWDOWN,
+    PCT_IMAGE_OPERATIONS,
+)
+from ..common.settings import (
+    get_setting,
+)
+from .calibrate import (
+    time_operation,
+)
+
+def make_cases(image):
+    """
+    Returns, by operation, a function that runs it on image with a given
+    backend, with the arguments the composer typically uses.
+    """
+    import cv2
+
+    height, width = image.shape[:2]
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    fit = get_setting('PCT_DEFAULT_FIT')
+    blur = 1 + 2 * fit
+    blurred = cv2.GaussianBlur(gray, (blur, blur), 0)
+    encoded = cv2.imencode('.jpg', image)[1].tobytes()
+    quality = get_setting('PCT_JPEG_QUALITY')
+    angle = get_setting('PCT_DEFAULT_ROTATION')
+
+    return {
+        'decode': lambda b: b.decode(encoded),
+        'encode': lambda b: b.encode(image, '.jpg', quality),
+        'resize': lambda b: b.resize(image, height // 4, width // 4),
+        'rotate': lambda b: b.rotate(image, angle),
+        'blur': lambda b: b.blur(gray, blur),
+        'edges': lambda b: b.edges(blurred, 0, 250 // math.sqrt(fit)),
+    }
+
+def get_difference(operation, reference, result, image):
+    """
+    Returns the mean absolute pixel difference between a backend's result
+    and OpenCV's, or None if the result is unusable. Encoders are compared
+    by how far their decoded output is from the original.
+    """
+    import cv2
+    import numpy
+
+    if result is None:
+        return None
+    if operation == 'encode':
+        errors = []
+        for buffer in (reference, result):
+            decoded = cv2.imdecode(
+                numpy.frombuffer(buffer, numpy.uint8),
+                cv2.IMREAD_COLOR,
+            )
+            if decoded is None or decoded.shape != image.shape:
+                return None
+            errors.append(cv2.absdiff(decoded, image).mean())
+        return abs(errors[1] - errors[0])
+    if result.shape != reference.shape:
+        return None
+    return float(cv2.absdiff(result, reference).mean())
+
+def select_backends():
+    """
+    Returns the fastest backend name by operation and size class, and a
+    report of the timings. Backends that are much slower than the fastest
+    on one size class aren't timed on the larger ones.
+    """
+    from .memory import make_synthetic_cards
+    from ..composer.backends import (
+        create_image_backend,
+        get_available_backends,
+    )
+    import cv2
+
+    reference_backend = create_image_backend('opencv')
+    tolerance = get_setting('PCT_IMAGE_BACKEND_TOLERANCE')
+    candidates = {
+        operation: [
+            b for b in get_available_backends() if b.supports(operation)
+        ]
+        for operation in PCT_IMAGE_OPERATIONS
+    }
+    selection = {operation: {} for operation in PCT_IMAGE_OPERATIONS}
+    report = []
+
+    with tempfile.TemporaryDirectory() as directory:
+        for size_class, _ in get_setting('PCT_IMAGE_SIZE_CLASSES'):
+            height, width = PCT_BACKEND_SIZES[size_class]
+            image = cv2.imread(make_synthetic_cards(
+                directory,
+                1,
+                height,
+                width,
+            )[0])
+            cases = make_cases(image)
+            report.append('{} ({}x{})'.format(size_class, width, height))
+
+            for operation in PCT_IMAGE_OPERATIONS:
+                case = cases[operation]
+                reference = case(reference_backend)
+                timings = {}
+                for backend in list(candidates[operation]):
+                    # Approximations are allowed to differ, by definition
+                    if backend is not reference_backend \
+                            and operation not in backend.approximate:
+                        difference = get_difference(
+                            operation,
+                            reference,
+                            case(backend),
+                            image,
+                        )
+                        if difference is None or difference > tolerance:
+                            candidates[operation].remove(backend)
+                            report.append('  {:<7} {:<7} rejected'.format(
+                                operation,
+                                backend.name,
+                            ))
+                            continue
+                    timings[backend.name] = time_operation(
+                        lambda: case(backend)
+                    )
+
+                best = min(timings, key=timings.get)
+                selection[operation][size_class] = best
+                candidates[operation] = [
+                    b for b in candidates[operation]
+                    if b.name in timings
+                    and timings[b.name] <= timings[best] * PCT_BACKEND_SLOWDOWN
+                ]
+                report.append('  {:<7} {}'.format(operation, ', '.join(
+                    '{}{} {:.1f} ms'.format(
+                        '*' if name == best else '',
+                        name,
+                        elapsed * 1000,
+                    )
+                    for name, elapsed in sorted(timings.items())
+                )))
+    return selection, report
+
+def select_and_save(filepath=None):
+    from ..composer.backends import save_backend_selection
+
+    selection, report = select_backends()
+    return save_backend_selection(selection, filepath), report
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m pct.benchmarks.backends',
+        description='Picks the fastest image backend for each operation.',
+    )
+    parser.add_argument('--output', help='backend selection file to write')
+    arguments = parser.parse_args(argv)
+
+    filepath, report = select_and_save(arguments.output)
+    print('\n'.join(report))
+    print('Wrote {}'.format(filepath))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+
+"""
+Startup auto-calibration of performance settings.
+
+Runs short microbenchmarks (decode and blur throughput, proxy rendering)
+on a synthetic card sized like a phone photo, and derives a settings
+profile for this host: worker counts, proxy resolution and memory budgets.
+The fastest image backends are selected as well (see
+pct.benchmarks.backends)::
+
+  python -m pct calibrate [--output FILE]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+from ..common.settings import (
+    get_setting,
+    save_settings,
+)
+
+MEGABYTE = 1024 * 1024
+
+def time_operation(operation, repeat=3):
+    """
+    Returns the fastest of `repeat` runs of operation, in seconds.
+    """
+    best = None
+    for _ in range(repeat):
+        start = perf_counter()
+        operation()
+        elapsed = perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def get_physical_memory():
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+def measure_worker_threads(image, cpus):
+    """
+    Finds the smallest thread count past which decode and blur throughput
+    stops improving by at least 10%. OpenCV is pinned to one thread
+    meanwhile, so that its own threads don't hide the scaling.
+    """
+    import cv2
+
+    encoded = cv2.imencode('.jpg', image)[1]
+    def job(_):
+        decoded = cv2.imdecode(encoded, cv2.IMREAD_COLOR)
+        cv2.GaussianBlur(decoded, (21, 21), 0)
+
+    tasks = max(4, cpus * 2)
+    best_workers = 1
+    best_rate = None
+    workers = 1
+    threads = cv2.getNumThreads()
+    cv2.setNumThreads(1)
+    try:
+        while workers <= cpus:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                elapsed = time_operation(
+                    lambda: list(pool.map(job, range(tasks))),
+                    repeat=2,
+                )
+            rate = tasks / elapsed
+            if best_rate is not None and rate < best_rate * 1.1:
+                break
+            best_rate = rate
+            best_workers = workers
+            workers *= 2
+    finally:
+        cv2.setNumThreads(threads)
+    return best_workers
+
+def measure_proxy_width(image, candidates=None, budget_ms=None):
+    """
+    Returns the widest proxy that can be resized and encoded within one
+    interactive frame.
+    """
+    import cv2
+
+    if candidates is None:
+        candidates = get_setting('PCT_CALIBRATION_PROXY_WIDTHS')
+    if budget_ms is None:
+        budget_ms = get_setting('PCT_CALIBRATION_FRAME_MS')
+
+    chosen = candidates[0]
+    for width in candidates:
+        height = image.shape[0] * width // image.shape[1]
+        def render():
+            proxy = cv2.resize(
+                image,
+                (width, height),
+                interpolation=cv2.INTER_NEAREST,
+            )
+            cv2.imencode('.jpg', proxy)
+        if time_operation(render) * 1000 > budget_ms:
+            break
+        chosen = width
+    return chosen
+
+def calibrate():
+    """
+    Returns a dictionary of tuned settings and a report of what they were
+    derived from.
+    """
+    from .memory import make_synthetic_cards
+    import cv2
+
+    with tempfile.TemporaryDirectory() as directory:
+        filepath = make_synthetic_cards(
+            directory,
+            1,
+            get_setting('PCT_CALIBRATION_HEIGHT'),
+            get_setting('PCT_CALIBRATION_WIDTH'),
+        )[0]
+        image = cv2.imread(filepath)
+
+    cpus = os.cpu_count() or 1
+    workers = measure_worker_threads(image, cpus)
+    proxy_width = measure_proxy_width(image)
+
+    profile = {
+        'PCT_WORKER_THREADS': workers,
+        'PCT_SERVER_WORKERS': workers,
+        'PCT_PROXY_WIDTH': proxy_width,
+    }
+
+    memory = get_physical_memory()
+    if memory is not None:
+        profile['PCT_SESSION_MEMORY_BUDGET_MB'] = int(
+            memory * get_setting('PCT_CALIBRATION_SESSION_MEMORY') / MEGABYTE
+        )
+        profile['PCT_DECODE_CACHE_MB'] = int(
+            memory * get_setting('PCT_CALIBRATION_CACHE_MEMORY') / MEGABYTE
+        )
+
+    report = ['{}x{} card, {} CPUs'.format(
+        image.shape[1],
+        image.shape[0],
+        cpus,
+    )]
+    for name, value in sorted(profile.items()):
+        report.append('{} = {}'.format(name, value))
+    return profile, report
+
+def calibrate_and_save(filepath=None):
+    from .backends import select_and_save
+
+    profile, report = calibrate()
+    _, backend_report = select_and_save()
+    profile['PCT_IMAGE_BACKEND'] = 'auto'
+    report.extend(backend_report)
+    report.append('PCT_IMAGE_BACKEND = auto')
+    return save_settings(profile, filepath), report
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m pct.benchmarks.calibrate',
+        description='Writes a settings profile tuned for this host.',
+    )
+    parser.add_argument('--output', help='settings file to write')
+    arguments = parser.parse_args(argv)
+
+    filepath, report = calibrate_and_save(arguments.output)
+    print('\n'.join(report))
+    print('Wrote {}'.format(filepath))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+"""
+Execution backend benchmark.
+
+Times a composer workflow (magic, rotate, previews) on synthetic cards
+under each execution backend, and checks that every backend produces the
+same fits as the thread backend::
+
+  python -m pct.benchmarks.execution [--cards N] [--height H] [--width W]
+                                     [--backends thread process]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+
+from time import perf_counter
+
+from ..common.configuration import (
+    PCT_DEFAULT_FIT,
+    PCT_DEFAULT_ROTATION,
+    PCT_EXECUTION_BACKENDS,
+    PCT_EXECUTION_CARDS,
+    PCT_EXECUTION_CARD_HEIGHT,
+    PCT_EXECUTION_CARD_WIDTH,
+)
+from ..common.settings import (
+    reload_settings,
+)
+
+def time_stage(timings, stage, operation):
+    start = perf_counter()
+    operation()
+    timings[stage] = perf_counter() - start
+
+def run_workflow(filepaths, backend):
+    import numpy
+    from ..composer.composer import PctComposer
+    from ..composer.execution import (
+        get_executor,
+        rotate_operation,
+    )
+
+    # The composer picks its backend through the settings layer
+    previous = os.environ.get('PCT_EXECUTION_BACKEND')
+    os.environ['PCT_EXECUTION_BACKEND'] = backend
+    reload_settings()
+    try:
+        # Starts the workers so that their start-up isn't timed
+        get_executor().run(
+            rotate_operation,
+            numpy.zeros((2, 2, 3), dtype=numpy.uint8),
+            0,
+        )
+        composer = PctComposer(filepaths, headless=True)
+        composer.prepare()
+        timings = {}
+
+        time_stage(
+            timings,
+            'magic',
+            lambda: composer.fit_all(PCT_DEFAULT_FIT),
+        )
+        fits = [a.shape for a in composer.get_arrays()]
+        time_stage(
+            timings,
+            'rotate',
+            lambda: [
+                composer.rotate(i, PCT_DEFAULT_ROTATION)
+                for i in range(len(filepaths))
+            ],
+        )
+        time_stage(
+            timings,
+            'previews',
+            lambda: [
+                composer.get_encoded_preview(i, 512)
+                for i in range(len(filepaths))
+            ],
+        )
+        composer.cleanup()
+    finally:
+        if previous is None:
+            del os.environ['PCT_EXECUTION_BACKEND']
+        else:
+            os.environ['PCT_EXECUTION_BACKEND'] = previous
+        reload_settings()
+    return timings, fits
+
+def check_execution(cards=PCT_EXECUTION_CARDS,
+                    height=PCT_EXECUTION_CARD_HEIGHT,
+                    width=PCT_EXECUTION_CARD_WIDTH,
+                    backends=PCT_EXECUTION_BACKENDS):
+    from .memory import make_synthetic_cards
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        filepaths = make_synthetic_cards(directory, cards, height, width)
+        for backend in backends:
+            results[backend] = run_workflow(filepaths, backend)
+
+    passed = True
+    report = ['{} cards at {}x{}'.format(cards, width, height)]
+    reference = results[backends[0]]
+    for backend in backends:
+        timings, fits = results[backend]
+        matches = fits == reference[1]
+        passed = passed and matches
+        report.append(
+            '{:<8} {}{}'.format(
+                backend,
+                '  '.join(
+                    '{} {:7.1f} ms'.format(stage, timings[stage] * 1000)
+                    for stage in ('magic', 'rotate', 'previews')
+                ),
+                '' if matches else '  FITS DIFFER',
+            )
+        )
+    return passed, report
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m pct.benchmarks.execution',
+        description='Compares execution backends on a composer workflow.',
+    )
+    parser.add_argument('--cards', type=int, default=PCT_EXECUTION_CARDS)
+    parser.add_argument(
+        '--height',
+        type=int,
+        default=PCT_EXECUTION_CARD_HEIGHT,
+    )
+    parser.add_argument('--width', type=int, default=PCT_EXECUTION_CARD_WIDTH)
+    parser.add_argument(
+        '--backends',
+        nargs='+',
+        choices=PCT_EXECUTION_BACKENDS,
+        default=PCT_EXECUTION_BACKENDS,
+    )
+    arguments = parser.parse_args(argv)
+
+    passed, report = check_execution(
+        arguments.cards,
+        arguments.height,
+        arguments.width,
+        arguments.backends,
+    )
+    print('\n'.join(report))
+    print('PASS' if passed else 'FAIL')
+    return 0 if passed else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
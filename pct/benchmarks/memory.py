@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+
+"""
+Peak-memory regression harness for composer workflows.
+
+Runs a scripted PctComposer workflow against synthetic cards and records,
+for each stage, the peak resident set size and the tracemalloc high-water
+mark (NumPy reports its buffers to tracemalloc). Fails when any stage's
+traced peak exceeds the per-card budget::
+
+  python -m pct.benchmarks.memory [--cards N] [--height H] [--width W]
+                                  [--rotates K] [--budget MB]
+"""
+
+import argparse
+import os
+import resource
+import sys
+import tempfile
+import tracemalloc
+
+from os import path
+
+from ..common.settings import (
+    get_setting,
+    reload_settings,
+)
+from ..datamanagement.files import (
+    get_output_image_filepath,
+    get_output_metadata_filepath,
+)
+
+MEGABYTE = 1024 * 1024
+
+def make_synthetic_cards(directory, count, height, width, seed=0):
+    """
+    Writes `count` card-like images: a pale, noisy page with a dark card
+    outline and some scribbles, offset differently on each card.
+    """
+    import cv2
+    import numpy
+
+    random = numpy.random.RandomState(seed)
+    filepaths = []
+    for index in range(count):
+        image = numpy.full((height, width, 3), 235, dtype=numpy.uint8)
+        image -= random.randint(0, 20, image.shape).astype(numpy.uint8)
+        
+        margin = min(height, width) // 10
+        offset = random.randint(0, margin // 2)
+        cv2.rectangle(
+            image,
+            (margin + offset, margin),
+            (width - margin, height - margin - offset),
+            (40, 40, 40),
+            max(2, margin // 20),
+        )
+        for _ in range(8):
+            points = random.randint(
+                margin * 2,
+                min(height, width) - margin * 2,
+                (6, 1, 2),
+            ).astype(numpy.int32)
+            cv2.polylines(image, [points], False, (20, 20, 120), 3)
+        
+        filepath = path.join(directory, 'card{:03d}.jpg'.format(index))
+        cv2.imwrite(filepath, image)
+        filepaths.append(filepath)
+    return filepaths
+
+class PctMemoryProbe:
+    
+    def start(self, stage):
+        self._stage = stage
+        self._reset_rss_peak()
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        else:
+            tracemalloc.stop()
+            tracemalloc.start()
+    
+    def stop(self):
+        _, traced_peak = tracemalloc.get_traced_memory()
+        result = {
+            'stage': self._stage,
+            'rss_peak_mb': self._get_rss_peak() / MEGABYTE,
+            'traced_peak_mb': traced_peak / MEGABYTE,
+        }
+        self._results.append(result)
+        return result
+    
+    def get_results(self):
+        return self._results
+    
+    def close(self):
+        tracemalloc.stop()
+    
+    #
+    # Private
+    #
+    
+    def __init__(self):
+        self._stage = None
+        self._results = []
+        tracemalloc.start()
+    
+    def _reset_rss_peak(self):
+        # Linux can reset VmHWM; elsewhere the peak is process-wide
+        try:
+            with open('/proc/self/clear_refs', 'w') as fp:
+                fp.write('5')
+        except OSError:
+            pass
+    
+    def _get_rss_peak(self):
+        try:
+            with open('/proc/self/status') as fp:
+                for line in fp:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == 'darwin':
+            return peak
+        return peak * 1024
+
+def run_workflow(directory, filepaths, rotates, probe):
+    from ..composer.composer import PctComposer
+    
+    probe.start('load')
+    composer = PctComposer(filepaths, headless=True)
+    composer.prepare()
+    probe.stop()
+    
+    probe.start('magic')
+    composer.fit_all(get_setting('PCT_DEFAULT_FIT'))
+    probe.stop()
+    
+    probe.start('rotate')
+    for index in range(len(filepaths)):
+        for _ in range(rotates):
+            composer.rotate(index, get_setting('PCT_DEFAULT_ROTATION'))
+    probe.stop()
+    
+    probe.start('undo/redo')
+    for index in range(len(filepaths)):
+        for _ in range(rotates):
+            composer.undo(index)
+        for _ in range(rotates):
+            composer.redo(index)
+    probe.stop()
+    
+    probe.start('compose')
+    composer.compose()
+    probe.stop()
+    
+    probe.start('save')
+    composer.save(
+        get_output_image_filepath(directory),
+        get_output_metadata_filepath(directory),
+    )
+    probe.stop()
+    
+    composer.cleanup()
+    return probe.get_results()
+
+def check_memory(cards=None, height=None, width=None, rotates=None,
+                 budget_mb=None):
+    if cards is None:
+        cards = get_setting('PCT_MEMORY_CARDS')
+    if height is None:
+        height = get_setting('PCT_MEMORY_CARD_HEIGHT')
+    if width is None:
+        width = get_setting('PCT_MEMORY_CARD_WIDTH')
+    if rotates is None:
+        rotates = get_setting('PCT_MEMORY_ROTATES')
+    if budget_mb is None:
+        budget_mb = get_setting('PCT_MEMORY_BUDGET_PER_CARD_MB')
+    # Renders are cached in the workspace, so runs neither reuse nor leave
+    # renders in the user's cache
+    previous = os.environ.get('PCT_RENDER_CACHE_DIRECTORY')
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            os.environ['PCT_RENDER_CACHE_DIRECTORY'] = path.join(
+                directory,
+                'renders',
+            )
+            reload_settings()
+            filepaths = make_synthetic_cards(directory, cards, height, width)
+            probe = PctMemoryProbe()
+            try:
+                results = run_workflow(directory, filepaths, rotates, probe)
+            finally:
+                probe.close()
+    finally:
+        if previous is None:
+            os.environ.pop('PCT_RENDER_CACHE_DIRECTORY', None)
+        else:
+            os.environ['PCT_RENDER_CACHE_DIRECTORY'] = previous
+        reload_settings()
+    
+    passed = True
+    report = ['{} cards at {}x{}, {} rotates, budget {} MB/card'.format(
+        cards,
+        width,
+        height,
+        rotates,
+        budget_mb,
+    )]
+    for result in results:
+        per_card = result['traced_peak_mb'] / cards
+        over = per_card > budget_mb
+        passed = passed and not over
+        report.append(
+            '{:<10} rss peak {:8.1f} MB  traced peak {:8.1f} MB  '
+            '({:.1f} MB/card){}'.format(
+                result['stage'],
+                result['rss_peak_mb'],
+                result['traced_peak_mb'],
+                per_card,
+                '  OVER BUDGET' if over else '',
+            )
+        )
+    return passed, report
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m pct.benchmarks.memory',
+        description='Checks composer workflow memory against a budget.',
+    )
+    # Defaults come from the settings, so they can be overridden there
+    parser.add_argument('--cards', type=int)
+    parser.add_argument('--height', type=int)
+    parser.add_argument('--width', type=int)
+    parser.add_argument('--rotates', type=int)
+    parser.add_argument('--budget', type=float)
+    arguments = parser.parse_args(argv)
+    
+    passed, report = check_memory(
+        arguments.cards,
+        arguments.height,
+        arguments.width,
+        arguments.rotates,
+        arguments.budget,
+    )
+    print('\n'.join(report))
+    print('PASS' if passed else 'FAIL')
+    return 0 if passed else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
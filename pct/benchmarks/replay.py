@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+"""
+Session replay benchmark.
+
+Replays a trace recorded with the interactor's record command headlessly
+against a copy of a directory (or archive), and reports per-command latency
+percentiles and the total wall time::
+
+  python -m pct.benchmarks.replay TRACE DIRECTORY [--runs N] [--realtime]
+
+Every load in the trace is pointed at the copy, which starts without any
+composer outputs or journal, and renders go to an empty render cache, so
+that runs can be compared with each other.
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+
+from time import (
+    perf_counter,
+    sleep,
+)
+
+from ..common.configuration import (
+    PCT_PREFIX,
+    PCT_REPLAY_PERCENTILES,
+    PCT_REPLAY_SKIPPED_COMMANDS,
+)
+from ..common.settings import (
+    reload_settings,
+)
+from ..datamanagement.traces import (
+    read_trace,
+)
+
+LOAD_COMMANDS = ('l', 'load')
+
+def percentile(values, percent):
+    # Nearest rank, so that reported latencies were actually observed
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * percent // 100))
+    return ordered[int(rank) - 1]
+
+def get_command_name(line):
+    name = line.split()[0]
+    if name.isdigit():
+        return 'image'
+    return name
+
+def prepare_line(line, directory):
+    tokens = line.split(None, 1)
+    if tokens[0] in LOAD_COMMANDS:
+        return '{} {}'.format(tokens[0], directory)
+    return line
+
+def copy_directory(directory, destination):
+    # Keeps the name, since session names are derived from it
+    target = os.path.join(
+        destination,
+        os.path.basename(os.path.normpath(directory)),
+    )
+    if os.path.isdir(directory):
+        shutil.copytree(
+            directory,
+            target,
+            ignore=shutil.ignore_patterns(PCT_PREFIX + '*'),
+        )
+    else:
+        shutil.copy2(directory, target)
+    return target
+
+def replay_trace(entries, directory, realtime=False):
+    """
+    Replays trace entries against directory, and returns the latency of
+    each command by name, in seconds, and the total wall time.
+    """
+    from ..interactor.interactor import PctInteractor
+
+    latencies = {}
+    with open(os.devnull, 'w') as devnull:
+        interactor = PctInteractor(stdout=devnull, headless=True)
+        start = perf_counter()
+        stop = False
+        for entry in entries:
+            line = entry['line']
+            if not line or line.split()[0] in PCT_REPLAY_SKIPPED_COMMANDS:
+                continue
+            if realtime:
+                sleep(max(0, entry['time'] - (perf_counter() - start)))
+            line = interactor.precmd(prepare_line(line, directory))
+            command_start = perf_counter()
+            stop = interactor.onecmd(line)
+            stop = interactor.postcmd(stop, line)
+            latencies.setdefault(get_command_name(line), []).append(
+                perf_counter() - command_start
+            )
+            if stop:
+                break
+        if not stop:
+            interactor.do_quit('')
+        elapsed = perf_counter() - start
+    return latencies, elapsed
+
+def run_replay(trace, directory, runs=1, realtime=False):
+    entries = read_trace(trace)
+    latencies = {}
+    elapsed = []
+    previous = os.environ.get('PCT_RENDER_CACHE_DIRECTORY')
+    try:
+        for _ in range(runs):
+            with tempfile.TemporaryDirectory() as workspace:
+                os.environ['PCT_RENDER_CACHE_DIRECTORY'] = os.path.join(
+                    workspace,
+                    'renders',
+                )
+                reload_settings()
+                run_latencies, run_elapsed = replay_trace(
+                    entries,
+                    copy_directory(directory, workspace),
+                    realtime,
+                )
+            for name, values in run_latencies.items():
+                latencies.setdefault(name, []).extend(values)
+            elapsed.append(run_elapsed)
+    finally:
+        if previous is None:
+            os.environ.pop('PCT_RENDER_CACHE_DIRECTORY', None)
+        else:
+            os.environ['PCT_RENDER_CACHE_DIRECTORY'] = previous
+        reload_settings()
+    return latencies, elapsed
+
+def format_report(latencies, elapsed):
+    report = ['{:<12} {:>5}  {}  {:>9}'.format(
+        'command',
+        'count',
+        '  '.join('{:>9}'.format('p{}'.format(p))
+                  for p in PCT_REPLAY_PERCENTILES),
+        'max',
+    )]
+    for name, values in sorted(latencies.items()):
+        report.append('{:<12} {:>5}  {}  {:>9}'.format(
+            name,
+            len(values),
+            '  '.join(
+                '{:6.1f} ms'.format(percentile(values, p) * 1000)
+                for p in PCT_REPLAY_PERCENTILES
+            ),
+            '{:6.1f} ms'.format(max(values) * 1000),
+        ))
+    report.append('wall time {}'.format(', '.join(
+        '{:.2f} s'.format(e) for e in elapsed
+    )))
+    return report
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m pct.benchmarks.replay',
+        description='Replays a recorded interactor session.',
+    )
+    parser.add_argument('trace', help='trace file written by record')
+    parser.add_argument('directory', help='directory or archive to replay on')
+    parser.add_argument('--runs', type=int, default=1)
+    parser.add_argument(
+        '--realtime',
+        action='store_true',
+        help='wait between commands as long as the recorded session did',
+    )
+    arguments = parser.parse_args(argv)
+
+    latencies, elapsed = run_replay(
+        arguments.trace,
+        arguments.directory,
+        arguments.runs,
+        arguments.realtime,
+    )
+    print('\n'.join(format_report(latencies, elapsed)))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+"""
+Startup-time benchmark for the command line tools.
+
+Imports each entry module in a fresh interpreter with `-X importtime`,
+checks the total import time against a budget and makes sure none of the
+heavy modules (OpenCV, NumPy) are loaded before the prompt appears::
+
+  python -m pct.benchmarks.startup [--budget MS] [--runs N]
+"""
+
+import argparse
+import subprocess
+import sys
+
+from ..common.configuration import (
+    PCT_STARTUP_BUDGET_MS,
+    PCT_STARTUP_MODULES,
+    PCT_STARTUP_FORBIDDEN_MODULES,
+)
+
+def parse_importtime(output):
+    """
+    Parses `-X importtime` output into a dictionary mapping each imported
+    module to its cumulative import time in microseconds, and the total
+    time of all top-level imports.
+    """
+    modules = {}
+    total = 0
+    for line in output.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3:
+            continue
+        try:
+            cumulative = int(fields[1])
+        except ValueError:
+            continue
+        name = fields[2].rstrip()
+        stripped = name.lstrip()
+        modules[stripped] = cumulative
+        # Nested imports are indented below their parent
+        if len(name) - len(stripped) == 1:
+            total += cumulative
+    return modules, total
+
+def measure_imports(module, python=sys.executable):
+    process = subprocess.run(
+        [python, '-X', 'importtime', '-c', 'import {}'.format(module)],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    if process.returncode != 0:
+        raise RuntimeError(process.stderr)
+    return parse_importtime(process.stderr)
+
+def check_startup(module, budget_ms=PCT_STARTUP_BUDGET_MS, runs=5,
+                  forbidden=PCT_STARTUP_FORBIDDEN_MODULES):
+    # The first run warms the bytecode cache; the fastest run is reported
+    measure_imports(module)
+    results = [measure_imports(module) for _ in range(runs)]
+    modules, total = min(results, key=lambda result: result[1])
+
+    elapsed_ms = total / 1000
+    loaded = [
+        m for m in forbidden
+        if any(name == m or name.startswith(m + '.') for name in modules)
+    ]
+    passed = elapsed_ms <= budget_ms and not loaded
+
+    report = ['{}: {:.1f} ms (budget {} ms)'.format(
+        module,
+        elapsed_ms,
+        budget_ms,
+    )]
+    for m in loaded:
+        report.append('{}: imports {} at startup'.format(module, m))
+    return passed, report
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m pct.benchmarks.startup',
+        description='Checks command line startup time against a budget.',
+    )
+    parser.add_argument('--budget', type=float, default=PCT_STARTUP_BUDGET_MS)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('modules', nargs='*', default=PCT_STARTUP_MODULES)
+    arguments = parser.parse_args(argv)
+
+    passed = True
+    for module in arguments.modules:
+        module_passed, report = check_startup(
+            module,
+            arguments.budget,
+            arguments.runs,
+        )
+        print('\n'.join(report))
+        passed = passed and module_passed
+    print('PASS' if passed else 'FAIL')
+    return 0 if passed else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
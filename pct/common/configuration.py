@@ -4,34 +4,210 @@
 A global configuration file for the library.
 """
 
+# Runtime settings (see pct.common.settings)
+PCT_SETTINGS_FILEPATH = '~/.pct/settings.json'
+PCT_SETTINGS_ENVIRONMENT = 'PCT_SETTINGS_FILE'
+
 # Debugging and testing
 PCT_DEFAULT_DEBUG = True
 
+# Startup Benchmark
+PCT_STARTUP_BUDGET_MS = 150
+PCT_STARTUP_MODULES = ['pct.__main__', 'pct.interactor.interactor']
+PCT_STARTUP_FORBIDDEN_MODULES = ['cv2', 'numpy']
+
+# Memory Benchmark
+PCT_MEMORY_CARDS = 6
+PCT_MEMORY_CARD_HEIGHT = 1200
+PCT_MEMORY_CARD_WIDTH = 900
+PCT_MEMORY_ROTATES = 3
+PCT_MEMORY_BUDGET_PER_CARD_MB = 12
+
+# Execution Benchmark
+PCT_EXECUTION_CARDS = 6
+PCT_EXECUTION_CARD_HEIGHT = 3000
+PCT_EXECUTION_CARD_WIDTH = 2250
+
+# Replay Benchmark (commands that wait, change settings or load other
+# directories are skipped)
+PCT_REPLAY_SKIPPED_COMMANDS = [
+    'record',
+    'watch',
+    'calibrate',
+    'queue',
+    'next',
+]
+PCT_REPLAY_PERCENTILES = [50, 90, 99]
+
+# Calibration
+PCT_CALIBRATION_WIDTH = 3000
+PCT_CALIBRATION_HEIGHT = 2250
+PCT_CALIBRATION_FRAME_MS = 16
+PCT_CALIBRATION_PROXY_WIDTHS = [256, 384, 512, 768, 1024, 1536]
+PCT_CALIBRATION_SESSION_MEMORY = 0.25
+PCT_CALIBRATION_CACHE_MEMORY = 0.0625
+
+# Performance Settings (worker threads cap the scheduler's slots, 0 means
+# one per CPU; progressive refreshes scale their quick proxies from copies
+# of the cards at most the proxy width wide)
+PCT_WORKER_THREADS = 0
+PCT_PROXY_WIDTH = 512
+
+# CPU Budget (0 CPUs means all of them; jobs queue by priority, first to
+# last, and OpenCV and BLAS libraries get the threads of one job each)
+PCT_CPU_BUDGET = 0
+PCT_THREADS_PER_JOB = 1
+PCT_SCHEDULER_PRIORITIES = ['interactive', 'refine', 'background']
+PCT_BLAS_THREAD_VARIABLES = [
+    'OMP_NUM_THREADS',
+    'OPENBLAS_NUM_THREADS',
+    'MKL_NUM_THREADS',
+    'VECLIB_MAXIMUM_THREADS',
+    'NUMEXPR_NUM_THREADS',
+]
+
+# Execution backends for image operations
+PCT_EXECUTION_BACKENDS = ['thread', 'process']
+PCT_EXECUTION_BACKEND = 'thread'
+
+# Image Backends (a backend name, or 'auto' to pick the fastest backend for
+# each operation and size class on this host; backends are only picked
+# where they match OpenCV within the tolerance, a mean absolute pixel
+# difference, and approximate implementations only when allowed)
+PCT_IMAGE_BACKENDS = ['opencv', 'pillow', 'numpy']
+PCT_IMAGE_BACKEND = 'opencv'
+PCT_IMAGE_BACKEND_APPROXIMATE = False
+PCT_IMAGE_BACKEND_TOLERANCE = 1.0
+PCT_IMAGE_BACKEND_CACHE = '~/.pct/backends.json'
+PCT_IMAGE_OPERATIONS = ['decode', 'encode', 'resize', 'rotate', 'blur', 'edges']
+PCT_IMAGE_SIZE_CLASSES = [['small', 500000], ['medium', 4000000], ['large', 0]]
+
+# Backend Selection Benchmark (candidates slower than the fastest by more
+# than the factor are not timed on larger images)
+PCT_BACKEND_SIZES = {
+    'small': [480, 640],
+    'medium': [1200, 1600],
+    'large': [2250, 3000],
+}
+PCT_BACKEND_SLOWDOWN = 4.0
+
 # Image Files
 PCT_IMAGE_EXTENSIONS = ['jpg', 'png']
 
+# Archives (an empty output directory puts outputs next to the archive)
+PCT_ARCHIVE_EXTENSIONS = ['zip', 'tar', 'tar.gz', 'tgz', 'tar.bz2', 'tar.xz']
+PCT_ARCHIVE_SEPARATOR = '::'
+PCT_ARCHIVE_OUTPUT_DIRECTORY = ''
+
+# Load Settings (duplicate detection costs a decode and hash of each card
+# per load, so it is off unless asked for)
+PCT_DUPLICATE_POLICIES = ['off', 'warn', 'skip']
+PCT_DEFAULT_DUPLICATE_POLICY = 'off'
+# Cards whose hashes are within the threshold (in bits) are only taken for
+# duplicates once their thumbnails correlate at least as much as the minimum
+# correlation; line-art cards share many hash bits without being alike
+PCT_DUPLICATE_THRESHOLD = 3
+PCT_DUPLICATE_CORRELATION = 0.9
+PCT_HASH_SIZE = 8
+PCT_HASH_CACHE_KEY = 'dhash'
+PCT_THUMBNAIL_SIZE = 32
+PCT_THUMBNAIL_CACHE_KEY = 'thumbnail'
+
+# Watch Settings (seconds)
+PCT_WATCH_INTERVAL = 0.5
+PCT_WATCH_DEBOUNCE = 1.0
+
 # Preview Settings
 PCT_PREVIEW_START_X = 1500
 PCT_PREVIEW_START_Y = -200
 PCT_PREVIEW_MARGIN = 5
 PCT_PREVIEW_WIDTH = 300
 
+# Progressive Refresh (proxies are shown first and refined in the
+# background until the next command arrives)
+PCT_PROGRESSIVE_PREVIEWS = False
+PCT_REFINE_POLL_SECONDS = 0.05
+
 # Edit Settings
 PCT_DEFAULT_AUTOMAGIC = True
 PCT_DEFAULT_ROTATION = 5
 PCT_DEFAULT_FIT = 25
 PCT_FIT_BUFFER = 25
 
+# Deskew Settings (degrees; skews outside the range are left alone, as are
+# cards whose contours fill less of their minimum area rectangle than the
+# minimum rectangularity, since their skew is no more than a guess)
+PCT_DESKEW = True
+PCT_DESKEW_MIN_ANGLE = 0.5
+PCT_DESKEW_MAX_ANGLE = 15.0
+PCT_DESKEW_MIN_RECTANGULARITY = 0.95
+
 # Composition Settings
 PCT_COMPOSITION_START_X = 1500
 PCT_COMPOSITION_START_Y = 300
 PCT_COMPOSITION_WIDTH = 1800
 PCT_BORDER_PIXELS = 50
 
+# Layout Settings (rows and grids wrap to stay under the maximum width in
+# pixels, or when it is 0, under the maximum width to height ratio)
+PCT_LAYOUT_MODES = ['strip', 'rows', 'grid']
+PCT_LAYOUT_MODE = 'strip'
+PCT_LAYOUT_MAX_WIDTH = 0
+PCT_LAYOUT_MAX_ASPECT = 3.0
+
+# Output Size (the composition is scaled to the height, or else the width,
+# or else down to the megapixels; with all of them 0, cards keep their
+# resolution)
+PCT_OUTPUT_HEIGHT = 0
+PCT_OUTPUT_WIDTH = 0
+PCT_OUTPUT_MEGAPIXELS = 0
+
 PCT_HACK_WINDOW_DELAY = 10
 
+# Encoding Settings
+PCT_JPEG_QUALITY = 90
+
+# Grayscale Storage (cards whose channels differ by more than the tolerance
+# in more than the outlier fraction of pixels are kept in color)
+PCT_GRAYSCALE_CARDS = False
+PCT_GRAYSCALE_TOLERANCE = 12
+PCT_GRAYSCALE_OUTLIERS = 0.002
+PCT_PACKED_PREVIEWS = False
+
+# Session Settings
+PCT_SESSION_MEMORY_BUDGET_MB = 2048
+PCT_DECODE_CACHE_MB = 512
+
+# Render Cache (opt-in, e.g. '~/.cache/pct'; an empty directory disables
+# it; bump the version whenever rendering changes so that stale renders are
+# never reused)
+PCT_RENDER_CACHE_DIRECTORY = ''
+PCT_RENDER_CACHE_MB = 2048
+PCT_RENDER_VERSION = 1
+
+# Export Settings
+PCT_FFMPEG_BINARY = 'ffmpeg'
+PCT_EXPORT_FORMATS = ['gif', 'mp4']
+PCT_DEFAULT_EXPORT_FORMAT = 'gif'
+PCT_EXPORT_HEIGHT = 720
+PCT_EXPORT_FPS = 10
+PCT_EXPORT_CARD_SECONDS = 2.0
+PCT_EXPORT_FADE_SECONDS = 0.5
+
+# Server Settings
+PCT_SERVER_HOST = '127.0.0.1'
+PCT_SERVER_PORT = 8080
+PCT_SERVER_WORKERS = 4
+PCT_SERVER_QUEUE = 16
+PCT_SERVER_MAX_SESSIONS = 8
+PCT_SERVER_SESSION_TIMEOUT = 900
+PCT_SERVER_REAP_INTERVAL = 60
+
 # Composition files
 PCT_PREFIX = '_pct_'
 PCT_EDITED_IMAGE_PREFIX = PCT_PREFIX + 'edit_'
 PCT_COMPOSED_IMAGE_FILENAME = PCT_PREFIX + 'composed.jpg'
-PCT_COMPOSED_METADATA_FILENAME = PCT_PREFIX + 'metadata.txt'
\ No newline at end of file
+PCT_COMPOSED_METADATA_FILENAME = PCT_PREFIX + 'metadata.txt'
+PCT_ANIMATION_FILENAME = PCT_PREFIX + 'animation'
+PCT_LOAD_CACHE_FILENAME = PCT_PREFIX + 'cache.json'
+PCT_JOURNAL_FILENAME = PCT_PREFIX + 'journal.jsonl'
\ No newline at end of file
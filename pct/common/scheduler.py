@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+
+"""
+A single CPU budget for all image work.
+
+Fit, decode, encode, compose and preview jobs all run in the scheduler's
+slots, rather than in pools of a thread per CPU each: PCT_CPU_BUDGET CPUs
+(0 means all of them) shared out as slots of PCT_THREADS_PER_JOB threads,
+which is also how many threads OpenCV and BLAS libraries may use inside a
+job. Queued jobs start in the order of PCT_SCHEDULER_PRIORITIES, so that
+interactive work goes ahead of refinements and background precompute,
+and in submission order within a priority.
+
+BLAS libraries read their thread counts from the environment when they
+load, so those limits are set when pct.composer, which imports NumPy and
+OpenCV first, is imported. OpenCV's thread count is process-wide, so it is
+only clamped to a job's share while jobs run side by side.
+"""
+
+import atexit
+import heapq
+import itertools
+import os
+import sys
+import threading
+
+from concurrent.futures import Future
+from contextlib import contextmanager
+from time import perf_counter
+
+from .configuration import (
+    PCT_BLAS_THREAD_VARIABLES,
+    PCT_SCHEDULER_PRIORITIES,
+)
+from .settings import (
+    get_setting,
+    get_worker_threads,
+)
+
+class PctSchedulerError(Exception):
+    pass
+
+class PctScheduler:
+
+    def submit(self, kind, function, *args, priority=None):
+        """
+        Queues function(*args) as a job of the given kind, and returns its
+        future. Without a priority, jobs take the one of the submitting
+        thread (see prioritized). Jobs submitted by a job run inline, in
+        their caller's slot, since waiting for another could deadlock.
+        """
+        if getattr(_context, 'job', False):
+            return self._run_inline(kind, function, args)
+        rank = self._get_rank(priority)
+        future = Future()
+        with self._condition:
+            if self._shutdown:
+                raise PctSchedulerError('The scheduler is shut down.')
+            self._start_workers()
+            heapq.heappush(self._queue, (
+                rank,
+                next(self._counter),
+                kind,
+                function,
+                args,
+                future,
+                perf_counter(),
+            ))
+            self._condition.notify()
+        return future
+
+    def run(self, kind, function, *args, priority=None):
+        return self.submit(kind, function, *args, priority=priority).result()
+
+    def map(self, kind, function, items, priority=None):
+        futures = [
+            self.submit(kind, function, item, priority=priority)
+            for item in items
+        ]
+        return [f.result() for f in futures]
+
+    def get_slots(self):
+        return self._slots
+
+    def get_threads_per_job(self):
+        return self._threads_per_job
+
+    def get_stats(self):
+        """
+        Returns the budget, the jobs running and queued by priority, the
+        share of slot time spent on jobs since the scheduler was created,
+        and the count, run time and queue time of the jobs of each kind.
+        """
+        with self._condition:
+            now = perf_counter()
+            busy = self._busy + sum([now - s for s in self._running.values()])
+            elapsed = now - self._started
+            queued = {name: 0 for name in PCT_SCHEDULER_PRIORITIES}
+            for entry in self._queue:
+                queued[PCT_SCHEDULER_PRIORITIES[entry[0]]] += 1
+            return {
+                'budget': self._budget,
+                'slots': self._slots,
+                'threads_per_job': self._threads_per_job,
+                'running': len(self._running),
+                'queued': queued,
+                'utilization': busy / (self._slots * elapsed) if elapsed else 0,
+                'jobs': {k: dict(v) for k, v in self._jobs.items()},
+            }
+
+    def shutdown(self):
+        with self._condition:
+            self._shutdown = True
+            pending = self._queue
+            self._queue = []
+            self._condition.notify_all()
+        for entry in pending:
+            entry[5].cancel()
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+    #
+    # Private
+    #
+
+    def __init__(self, budget=None, threads_per_job=None):
+        if budget is None:
+            budget = get_cpu_budget()
+        if threads_per_job is None:
+            threads_per_job = get_setting('PCT_THREADS_PER_JOB')
+        self._budget = budget
+        self._threads_per_job = max(1, min(threads_per_job, budget))
+        self._slots = max(1, min(
+            budget // self._threads_per_job,
+            get_worker_threads(),
+        ))
+        self._queue = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._workers = []
+        self._running = {}
+        self._busy = 0.0
+        self._jobs = {}
+        self._started = perf_counter()
+        self._shutdown = False
+        self._library_threads = None
+
+    def _get_rank(self, priority):
+        if priority is None:
+            priority = getattr(_context, 'priority', PCT_SCHEDULER_PRIORITIES[0])
+        if priority not in PCT_SCHEDULER_PRIORITIES:
+            raise PctSchedulerError('Unknown priority {}.'.format(priority))
+        return PCT_SCHEDULER_PRIORITIES.index(priority)
+
+    def _start_workers(self):
+        # Called with the condition held, on the first submission
+        if self._workers:
+            return
+        for index in range(self._slots):
+            worker = threading.Thread(
+                target=self._work,
+                name='pct-scheduler-{}'.format(index),
+                daemon=True,
+            )
+            worker.start()
+            self._workers.append(worker)
+
+    def _work(self):
+        _context.job = True
+        while True:
+            with self._condition:
+                while not self._queue and not self._shutdown:
+                    self._condition.wait()
+                if not self._queue:
+                    return
+                _, number, kind, function, args, future, queued = \
+                    heapq.heappop(self._queue)
+                if not future.set_running_or_notify_cancel():
+                    continue
+                started = perf_counter()
+                self._running[number] = started
+                self._update_library_threads()
+            try:
+                result = function(*args)
+            except Exception as err:
+                future.set_exception(err)
+            else:
+                future.set_result(result)
+            finally:
+                with self._condition:
+                    elapsed = perf_counter() - started
+                    del self._running[number]
+                    self._update_library_threads()
+                    self._busy += elapsed
+                    self._record(kind, elapsed, started - queued)
+
+    def _run_inline(self, kind, function, args):
+        future = Future()
+        future.set_running_or_notify_cancel()
+        started = perf_counter()
+        try:
+            future.set_result(function(*args))
+        except Exception as err:
+            future.set_exception(err)
+        with self._condition:
+            self._record(kind, perf_counter() - started, 0.0)
+        return future
+
+    def _update_library_threads(self):
+        # Called with the condition held. A job running alone may use the
+        # whole budget; OpenCV is only imported by the jobs themselves
+        cv2 = sys.modules.get('cv2')
+        if cv2 is None:
+            return
+        threads = self._budget
+        if len(self._running) > 1:
+            threads = self._threads_per_job
+        if threads != self._library_threads:
+            cv2.setNumThreads(threads)
+            self._library_threads = threads
+
+    def _record(self, kind, elapsed, waited):
+        stats = self._jobs.setdefault(kind, {
+            'count': 0,
+            'seconds': 0.0,
+            'waited': 0.0,
+        })
+        stats['count'] += 1
+        stats['seconds'] += elapsed
+        stats['waited'] += waited
+
+_context = threading.local()
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+def get_cpu_budget():
+    budget = get_setting('PCT_CPU_BUDGET')
+    if budget > 0:
+        return budget
+    return os.cpu_count() or 1
+
+def get_scheduler():
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = PctScheduler()
+        return _scheduler
+
+def shutdown_scheduler():
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is not None:
+            _scheduler.shutdown()
+        _scheduler = None
+
+atexit.register(shutdown_scheduler)
+
+@contextmanager
+def prioritized(priority):
+    """
+    Gives the jobs this thread submits in the block the given priority.
+    """
+    if priority not in PCT_SCHEDULER_PRIORITIES:
+        raise PctSchedulerError('Unknown priority {}.'.format(priority))
+    previous = getattr(_context, 'priority', None)
+    _context.priority = priority
+    try:
+        yield
+    finally:
+        if previous is None:
+            del _context.priority
+        else:
+            _context.priority = previous
+
+def set_library_thread_variables(threads=None):
+    # Only takes effect before NumPy is first imported; explicit
+    # environment settings win
+    if threads is None:
+        threads = get_setting('PCT_THREADS_PER_JOB')
+    for name in PCT_BLAS_THREAD_VARIABLES:
+        os.environ.setdefault(name, str(threads))
+
+def limit_library_threads(threads):
+    # For worker processes, which run one job each
+    set_library_thread_variables(threads)
+    import cv2
+    cv2.setNumThreads(threads)
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+"""
+Runtime settings layered over the configuration defaults.
+
+Any setting defined in pct.common.configuration can be overridden by a
+JSON settings file (~/.pct/settings.json, or the file named by the
+PCT_SETTINGS_FILE environment variable) and then by an environment
+variable of the same name. Environment values are parsed according to
+the type of the default.
+"""
+
+import json
+import os
+
+from os import path
+
+from . import configuration
+
+_settings = None
+
+def get_settings_filepath():
+    filepath = os.environ.get(configuration.PCT_SETTINGS_ENVIRONMENT)
+    if not filepath:
+        filepath = configuration.PCT_SETTINGS_FILEPATH
+    return path.expanduser(filepath)
+
+def get_defaults():
+    return {
+        name: getattr(configuration, name)
+        for name in dir(configuration) if name.startswith('PCT_')
+    }
+
+def load_settings(filepath=None):
+    settings = get_defaults()
+    
+    for name, value in read_settings_file(filepath).items():
+        if name in settings:
+            settings[name] = value
+    
+    for name, default in list(settings.items()):
+        if name in os.environ:
+            settings[name] = parse_value(os.environ[name], default)
+    
+    return settings
+
+def read_settings_file(filepath=None):
+    if filepath is None:
+        filepath = get_settings_filepath()
+    try:
+        with open(filepath) as fp:
+            values = json.load(fp)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(values, dict):
+        return {}
+    return values
+
+def save_settings(values, filepath=None):
+    """
+    Merges values into the settings file and reloads the settings.
+    """
+    if filepath is None:
+        filepath = get_settings_filepath()
+    merged = read_settings_file(filepath)
+    merged.update(values)
+    
+    directory = path.dirname(filepath)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temp_filepath = filepath + '.tmp'
+    with open(temp_filepath, 'w') as fp:
+        json.dump(merged, fp, indent=2, sort_keys=True)
+    os.replace(temp_filepath, filepath)
+    
+    reload_settings()
+    return filepath
+
+def parse_value(string, default):
+    if isinstance(default, bool):
+        return string.strip().lower() in ('1', 'true', 'yes', 'on')
+    if isinstance(default, int):
+        return int(string)
+    if isinstance(default, float):
+        return float(string)
+    if isinstance(default, (list, dict)):
+        return json.loads(string)
+    return string
+
+def reload_settings():
+    global _settings
+    _settings = load_settings()
+    return _settings
+
+def get_setting(name):
+    if _settings is None:
+        reload_settings()
+    return _settings[name]
+
+def get_worker_threads():
+    workers = get_setting('PCT_WORKER_THREADS')
+    if workers > 0:
+        return workers
+    return os.cpu_count() or 1
@@ -1,2 +1,7 @@
 # -*- coding: utf-8 -*-
 
+# BLAS libraries read their thread limits when they load, and the modules
+# of this package are the first to import NumPy
+from ..common.scheduler import set_library_thread_variables
+
+set_library_thread_variables()
@@ -0,0 +1,494 @@
+# -*- coding: utf-8 -*-
+
+"""
+Image backends for the operations that dominate processing time: decode,
+encode, resize, rotate, blur and edge detection.
+
+The OpenCV backend implements all of them and is the reference. The Pillow
+backend (when Pillow is installed) and the pure-NumPy backend implement the
+operations they can; those they can only approximate are never used unless
+PCT_IMAGE_BACKEND_APPROXIMATE is set. PCT_IMAGE_BACKEND names the backend,
+or with 'auto', picks the fastest backend for each operation and image
+size class from a microbenchmark (see pct.benchmarks.backends) whose
+results are cached per host.
+"""
+
+import io
+import json
+import math
+import platform
+import threading
+
+from os import (
+    makedirs,
+    path,
+    replace,
+)
+
+import numpy
+import cv2
+
+from ..common.configuration import (
+    PCT_IMAGE_BACKENDS,
+    PCT_IMAGE_OPERATIONS,
+)
+from ..common.settings import (
+    get_setting,
+)
+
+class PctImageBackendError(Exception):
+    pass
+
+class PctOpenCVBackend:
+
+    name = 'opencv'
+    approximate = ()
+
+    def supports(self, operation):
+        return hasattr(self, operation)
+
+    def decode(self, buffer):
+        return cv2.imdecode(
+            numpy.frombuffer(buffer, numpy.uint8),
+            cv2.IMREAD_COLOR,
+        )
+
+    def encode(self, image, extension, quality=None):
+        params = []
+        if quality is not None and extension in ('.jpg', '.jpeg'):
+            params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+        success, buffer = cv2.imencode(extension, image, params)
+        if not success:
+            return None
+        return buffer.tobytes()
+
+    def resize(self, image, height, width):
+        if height * width < image.shape[0] * image.shape[1]:
+            interp = cv2.INTER_AREA
+        else:
+            interp = cv2.INTER_LINEAR
+        return cv2.resize(image, (width, height), interpolation=interp)
+
+    def rotate(self, image, angle):
+        rows, cols = image.shape[:2]
+        M = cv2.getRotationMatrix2D((cols // 2, rows // 2), -angle, 1)
+        return cv2.warpAffine(image, M, (cols, rows))
+
+    def blur(self, image, size):
+        return cv2.GaussianBlur(image, (size, size), 0)
+
+    def edges(self, image, low, high):
+        return cv2.Canny(image, low, high)
+
+class PctPillowBackend:
+
+    name = 'pillow'
+    # Pillow's Gaussian blur is built from box blurs
+    approximate = ('blur',)
+
+    def supports(self, operation):
+        if not hasattr(self, operation):
+            return False
+        return operation not in self.approximate \
+            or get_setting('PCT_IMAGE_BACKEND_APPROXIMATE')
+
+    def decode(self, buffer):
+        try:
+            image = self._exif_transpose(self._Image.open(io.BytesIO(buffer)))
+            rgb = numpy.asarray(image.convert('RGB'))
+        except Exception:
+            return None
+        return numpy.ascontiguousarray(rgb[:, :, ::-1])
+
+    def encode(self, image, extension, quality=None):
+        if image.ndim == 3:
+            image = numpy.ascontiguousarray(image[:, :, ::-1])
+        output = io.BytesIO()
+        try:
+            if extension in ('.jpg', '.jpeg'):
+                # OpenCV's default quality, when none is given
+                self._Image.fromarray(image).save(
+                    output,
+                    'JPEG',
+                    quality=95 if quality is None else quality,
+                )
+            elif extension == '.png':
+                self._Image.fromarray(image).save(output, 'PNG')
+            else:
+                return None
+        except (OSError, ValueError):
+            return None
+        return output.getvalue()
+
+    def resize(self, image, height, width):
+        if height * width < image.shape[0] * image.shape[1]:
+            resample = self._Image.BOX
+        else:
+            resample = self._Image.BILINEAR
+        return numpy.asarray(
+            self._Image.fromarray(image).resize((width, height), resample)
+        )
+
+    def rotate(self, image, angle):
+        # Pillow turns counterclockwise
+        rows, cols = image.shape[:2]
+        return numpy.asarray(self._Image.fromarray(image).rotate(
+            -angle,
+            resample=self._Image.BILINEAR,
+            center=(cols // 2, rows // 2),
+        ))
+
+    def blur(self, image, size):
+        return numpy.asarray(self._Image.fromarray(image).filter(
+            self._ImageFilter.GaussianBlur(_get_gaussian_sigma(size))
+        ))
+
+    #
+    # Private
+    #
+
+    # EXIF orientations to the transposes that undo them
+    _ORIENTATIONS = {
+        2: 'FLIP_LEFT_RIGHT',
+        3: 'ROTATE_180',
+        4: 'FLIP_TOP_BOTTOM',
+        5: 'TRANSPOSE',
+        6: 'ROTATE_270',
+        7: 'TRANSVERSE',
+        8: 'ROTATE_90',
+    }
+
+    def __init__(self):
+        try:
+            from PIL import (
+                Image,
+                ImageFilter,
+            )
+        except ImportError:
+            raise PctImageBackendError(
+                'The pillow image backend requires Pillow.'
+            )
+        self._Image = Image
+        self._ImageFilter = ImageFilter
+
+    def _exif_transpose(self, image):
+        # OpenCV applies EXIF orientation when decoding, so Pillow must too
+        try:
+            orientation = image.getexif().get(0x0112)
+        except AttributeError:
+            exif = getattr(image, '_getexif', lambda: None)()
+            orientation = exif.get(0x0112) if exif else None
+        method = self._ORIENTATIONS.get(orientation)
+        if method is None:
+            return image
+        return image.transpose(getattr(self._Image, method))
+
+class PctNumpyBackend:
+
+    name = 'numpy'
+    # Edges are thresholded gradients, without Canny's thinning and
+    # hysteresis
+    approximate = ('edges',)
+
+    def supports(self, operation):
+        if not hasattr(self, operation):
+            return False
+        return operation not in self.approximate \
+            or get_setting('PCT_IMAGE_BACKEND_APPROXIMATE')
+
+    def resize(self, image, height, width):
+        # Separable, like OpenCV: area averaging along axes that shrink
+        # when the image does, bilinear otherwise
+        shrink = height * width < image.shape[0] * image.shape[1]
+        result = image.astype(numpy.float32)
+        axes = sorted(
+            [(height / image.shape[0], 0, height),
+             (width / image.shape[1], 1, width)],
+        )
+        for scale, axis, size in axes:
+            if size == result.shape[axis]:
+                continue
+            if shrink and scale < 1:
+                result = _area_axis(result, size, axis)
+            else:
+                result = _linear_axis(result, size, axis)
+        return _to_uint8(result)
+
+    def rotate(self, image, angle):
+        # Inverse mapping with bilinear sampling, over a zero border
+        rows, cols = image.shape[:2]
+        theta = math.radians(-angle)
+        a = math.cos(theta)
+        b = math.sin(theta)
+        cx = cols // 2
+        cy = rows // 2
+        y, x = numpy.mgrid[0:rows, 0:cols].astype(numpy.float32)
+        x -= cx
+        y -= cy
+        sx = a * x - b * y + cx
+        sy = b * x + a * y + cy
+        padded = numpy.pad(
+            image.astype(numpy.float32),
+            [(1, 1), (1, 1)] + [(0, 0)] * (image.ndim - 2),
+        )
+        x0 = numpy.floor(sx)
+        y0 = numpy.floor(sy)
+        fx = sx - x0
+        fy = sy - y0
+        x0 = numpy.clip(x0.astype(numpy.intp) + 1, 0, cols + 1)
+        y0 = numpy.clip(y0.astype(numpy.intp) + 1, 0, rows + 1)
+        x1 = numpy.clip(x0 + 1, 0, cols + 1)
+        y1 = numpy.clip(y0 + 1, 0, rows + 1)
+        # Samples that fall off the image entirely read the zero border
+        outside = (sx <= -1) | (sx >= cols) | (sy <= -1) | (sy >= rows)
+        x0[outside] = 0
+        x1[outside] = 0
+        y0[outside] = 0
+        y1[outside] = 0
+        if image.ndim == 3:
+            fx = fx[:, :, None]
+            fy = fy[:, :, None]
+        top = padded[y0, x0] * (1 - fx) + padded[y0, x1] * fx
+        bottom = padded[y1, x0] * (1 - fx) + padded[y1, x1] * fx
+        return _to_uint8(top * (1 - fy) + bottom * fy)
+
+    def blur(self, image, size):
+        kernel = _get_gaussian_kernel(size)
+        result = image.astype(numpy.float32)
+        for axis in (0, 1):
+            result = _convolve_axis(result, kernel, axis)
+        return _to_uint8(result)
+
+    def edges(self, image, low, high):
+        image = image.astype(numpy.float32)
+        padded = numpy.pad(image, 1, mode='reflect')
+        gx = (padded[:-2, 2:] + 2 * padded[1:-1, 2:] + padded[2:, 2:]) \
+            - (padded[:-2, :-2] + 2 * padded[1:-1, :-2] + padded[2:, :-2])
+        gy = (padded[2:, :-2] + 2 * padded[2:, 1:-1] + padded[2:, 2:]) \
+            - (padded[:-2, :-2] + 2 * padded[:-2, 1:-1] + padded[:-2, 2:])
+        magnitude = numpy.abs(gx) + numpy.abs(gy)
+        return numpy.where(magnitude >= high, 255, 0).astype(numpy.uint8)
+
+_BACKENDS = {
+    'opencv': PctOpenCVBackend,
+    'pillow': PctPillowBackend,
+    'numpy': PctNumpyBackend,
+}
+
+_backends = {}
+_selection = None
+_lock = threading.Lock()
+_selection_lock = threading.Lock()
+
+def create_image_backend(name):
+    if name not in PCT_IMAGE_BACKENDS:
+        raise PctImageBackendError('Unknown image backend {}.'.format(name))
+    with _lock:
+        backend = _backends.get(name)
+        if backend is None:
+            backend = _BACKENDS[name]()
+            _backends[name] = backend
+        return backend
+
+def get_available_backends():
+    backends = []
+    for name in PCT_IMAGE_BACKENDS:
+        try:
+            backends.append(create_image_backend(name))
+        except PctImageBackendError:
+            pass
+    return backends
+
+def get_image_backend(operation, pixels=0):
+    """
+    Returns the backend to run operation with, on an image of about the
+    given number of pixels. Falls back to OpenCV for operations that the
+    chosen backend can't run, or can only approximate.
+    """
+    name = get_setting('PCT_IMAGE_BACKEND')
+    if name == 'auto':
+        name = get_backend_selection().get(operation, {}).get(
+            get_size_class(pixels),
+            'opencv',
+        )
+    backend = create_image_backend(name)
+    if not backend.supports(operation):
+        return create_image_backend('opencv')
+    return backend
+
+def get_backend_recipe():
+    """
+    Returns the backend names that operations resolve to, by operation
+    (and by size class when 'auto'), so that renders made with different
+    backends are cached apart.
+    """
+    name = get_setting('PCT_IMAGE_BACKEND')
+    if name == 'auto':
+        selection = get_backend_selection()
+        return {
+            operation: {
+                size_class: get_backend_name(backend, operation)
+                for size_class, backend in selection.get(operation, {}).items()
+            }
+            for operation in PCT_IMAGE_OPERATIONS
+        }
+    return {
+        operation: get_backend_name(name, operation)
+        for operation in PCT_IMAGE_OPERATIONS
+    }
+
+def get_backend_name(name, operation):
+    # The backend that runs operation when name is chosen
+    if create_image_backend(name).supports(operation):
+        return name
+    return 'opencv'
+
+def get_size_class(pixels):
+    for name, limit in get_setting('PCT_IMAGE_SIZE_CLASSES'):
+        if not limit or pixels <= limit:
+            return name
+    return name
+
+def get_host_key():
+    # Selections are only reused on the same host, with the same libraries
+    # and approximation policy
+    versions = [cv2.__version__, numpy.__version__]
+    try:
+        import PIL
+        versions.append(PIL.__version__)
+    except ImportError:
+        versions.append('')
+    return '|'.join([
+        platform.node(),
+        platform.machine(),
+        platform.python_version(),
+    ] + versions + [
+        'approximate' if get_setting('PCT_IMAGE_BACKEND_APPROXIMATE') else '',
+    ])
+
+def get_backend_selection():
+    """
+    Returns the backend names by operation and size class for this host,
+    running the selection benchmark the first time.
+    """
+    global _selection
+    with _selection_lock:
+        if _selection is None:
+            selection = read_backend_selection()
+            if selection is None:
+                from ..benchmarks.backends import select_backends
+                selection = select_backends()[0]
+                save_backend_selection(selection)
+            _selection = selection
+        return _selection
+
+def read_backend_selection(filepath=None):
+    try:
+        with open(_get_cache_filepath(filepath)) as fp:
+            selections = json.load(fp)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(selections, dict):
+        return None
+    return selections.get(get_host_key())
+
+def save_backend_selection(selection, filepath=None):
+    global _selection
+    filepath = _get_cache_filepath(filepath)
+    try:
+        with open(filepath) as fp:
+            selections = json.load(fp)
+        if not isinstance(selections, dict):
+            selections = {}
+    except (OSError, ValueError):
+        selections = {}
+    selections[get_host_key()] = selection
+
+    directory = path.dirname(filepath)
+    if directory:
+        makedirs(directory, exist_ok=True)
+    temp_filepath = filepath + '.tmp'
+    with open(temp_filepath, 'w') as fp:
+        json.dump(selections, fp, indent=2, sort_keys=True)
+    replace(temp_filepath, filepath)
+    _selection = selection
+    return filepath
+
+def _get_cache_filepath(filepath=None):
+    if filepath is None:
+        filepath = get_setting('PCT_IMAGE_BACKEND_CACHE')
+    return path.expanduser(filepath)
+
+#
+# NumPy helpers
+#
+
+def _to_uint8(image):
+    return numpy.clip(numpy.rint(image), 0, 255).astype(numpy.uint8)
+
+def _area_axis(image, size, axis):
+    # Each output pixel averages the span of input it covers, partial
+    # pixels included, using cumulative sums
+    image = numpy.moveaxis(image, axis, 0)
+    count = image.shape[0]
+    sums = numpy.zeros((count + 1,) + image.shape[1:], numpy.float32)
+    numpy.cumsum(image, axis=0, out=sums[1:])
+    edges = numpy.arange(size + 1) * (count / size)
+    whole = numpy.minimum(numpy.floor(edges).astype(numpy.intp), count)
+    fraction = (edges - whole).astype(numpy.float32)
+    fraction = fraction.reshape((-1,) + (1,) * (image.ndim - 1))
+    at_edges = sums[whole] \
+        + fraction * image[numpy.minimum(whole, count - 1)]
+    result = (at_edges[1:] - at_edges[:-1]) * (size / count)
+    return numpy.moveaxis(result, 0, axis)
+
+def _linear_axis(image, size, axis):
+    # Pixel centers are aligned as in OpenCV's INTER_LINEAR
+    image = numpy.moveaxis(image, axis, 0)
+    count = image.shape[0]
+    source = (numpy.arange(size) + 0.5) * (count / size) - 0.5
+    first = numpy.floor(source).astype(numpy.intp)
+    fraction = (source - first).astype(numpy.float32)
+    fraction[first < 0] = 0
+    fraction[first >= count - 1] = 0
+    first = numpy.clip(first, 0, count - 1)
+    second = numpy.minimum(first + 1, count - 1)
+    fraction = fraction.reshape((-1,) + (1,) * (image.ndim - 1))
+    result = image[first] * (1 - fraction) + image[second] * fraction
+    return numpy.moveaxis(result, 0, axis)
+
+# OpenCV uses fixed kernels for small sizes without a sigma
+_SMALL_GAUSSIAN_KERNELS = {
+    1: [1.0],
+    3: [0.25, 0.5, 0.25],
+    5: [0.0625, 0.25, 0.375, 0.25, 0.0625],
+    7: [0.03125, 0.109375, 0.21875, 0.28125, 0.21875, 0.109375, 0.03125],
+}
+
+def _get_gaussian_sigma(size):
+    # The sigma OpenCV derives from a kernel size
+    return 0.3 * ((size - 1) * 0.5 - 1) + 0.8
+
+def _get_gaussian_kernel(size):
+    if size in _SMALL_GAUSSIAN_KERNELS:
+        return numpy.array(_SMALL_GAUSSIAN_KERNELS[size], numpy.float32)
+    sigma = _get_gaussian_sigma(size)
+    x = numpy.arange(size) - (size - 1) / 2
+    kernel = numpy.exp(-x * x / (2 * sigma * sigma))
+    return (kernel / kernel.sum()).astype(numpy.float32)
+
+def _convolve_axis(image, kernel, axis):
+    # Borders are reflected without repeating the edge, as in OpenCV
+    radius = len(kernel) // 2
+    pad = [(0, 0)] * image.ndim
+    pad[axis] = (radius, radius)
+    padded = numpy.pad(image, pad, mode='reflect')
+    result = numpy.zeros_like(image)
+    length = image.shape[axis]
+    for offset, weight in enumerate(kernel):
+        result += weight * numpy.take(
+            padded,
+            range(offset, offset + length),
+            axis=axis,
+        )
+    return result
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+"""
+A decoded image cache that can be shared between composers.
+"""
+
+import threading
+
+from collections import OrderedDict
+
+from ..datamanagement.files import (
+    get_file_signature,
+)
+from .imageprocessing import (
+    compact_image,
+    read_image,
+    read_images,
+)
+
+class PctImageCache:
+    """
+    A least-recently-used cache of decoded images, bounded in bytes.
+    Cached images are read-only so composers can safely share them.
+    """
+
+    def load(self, filepath):
+        signature = get_file_signature(filepath)
+        with self._lock:
+            cached = self._images.get(filepath)
+            if cached is not None and cached[0] == signature:
+                self._images.move_to_end(filepath)
+                return cached[1]
+
+        image = self._decode(filepath)
+        if image is None:
+            return None
+        image.flags.writeable = False
+
+        with self._lock:
+            previous = self._images.pop(filepath, None)
+            if previous is not None:
+                self._nbytes -= previous[1].nbytes
+            self._images[filepath] = (signature, image)
+            self._nbytes += image.nbytes
+            self._evict()
+        return image
+
+    def prefetch(self, filepaths, workers=None):
+        """
+        Decodes the images that aren't cached yet in parallel, so that
+        later loads are cache hits.
+        """
+        missing = []
+        for filepath in filepaths:
+            signature = get_file_signature(filepath)
+            with self._lock:
+                cached = self._images.get(filepath)
+            if cached is None or cached[0] != signature:
+                missing.append((filepath, signature))
+        images = read_images([f for f, _ in missing], workers)
+        with self._lock:
+            for (filepath, signature), image in zip(missing, images):
+                if image is None:
+                    continue
+                image = compact_image(image)
+                image.flags.writeable = False
+                previous = self._images.pop(filepath, None)
+                if previous is not None:
+                    self._nbytes -= previous[1].nbytes
+                self._images[filepath] = (signature, image)
+                self._nbytes += image.nbytes
+            self._evict()
+
+    def get_arrays(self):
+        with self._lock:
+            return [image for _, image in self._images.values()]
+
+    def get_nbytes(self):
+        return self._nbytes
+
+    def clear(self):
+        with self._lock:
+            self._images = OrderedDict()
+            self._nbytes = 0
+
+    #
+    # Private
+    #
+
+    def __init__(self, max_bytes):
+        self._lock = threading.Lock()
+        self._images = OrderedDict()
+        self._nbytes = 0
+        self._max_bytes = max_bytes
+
+    def _decode(self, filepath):
+        return compact_image(read_image(filepath))
+
+    def _evict(self):
+        # The newest entry is always kept, even if it exceeds the budget
+        while self._nbytes > self._max_bytes and len(self._images) > 1:
+            _, (_, image) = self._images.popitem(last=False)
+            self._nbytes -= image.nbytes
@@ -2,22 +2,72 @@
 
 import cv2
 
-from os.path import basename
+from hashlib import sha1
+from os.path import (
+    abspath,
+    basename,
+    splitext,
+)
 
+from ..common.scheduler import (
+    get_scheduler,
+)
+from ..common.settings import (
+    get_setting,
+)
 from ..common.configuration import (
-    PCT_FIT_BUFFER,
-    PCT_HACK_WINDOW_DELAY,
+    PCT_COMPOSED_IMAGE_FILENAME,
+    PCT_LAYOUT_MODES,
 )
 from ..datamanagement.files import (
     get_edited_image_filepath,
+    get_file_signature,
+    get_image_name,
+)
+from ..datamanagement.renders import (
+    get_recipe_key,
+    get_render_cache,
+)
+from .backends import (
+    get_backend_recipe,
+)
+from .export import (
+    PctAnimationWriter,
+    PctExportError,
 )
 from .imageprocessing import (
     crop_image,
-    resize_image_width,
-    rotate_image,
-    compose_images,
-    find_dominant_contours,
-    collected_extrema,
+    resize_image,
+    resize_image_nearest,
+    encode_image,
+    fit_image_to_frame,
+    blend_images,
+    save_raw_image,
+    read_image,
+    write_image,
+    compact_image,
+    pack_image,
+    unpack_image,
+    PctPackedImage,
+)
+from .layout import (
+    compute_layout,
+    get_layout_geometry,
+    get_layout_scale,
+    render_layout,
+    scale_layout,
+)
+from .progressive import (
+    PctRefinement,
+)
+from .execution import (
+    get_executor,
+    get_deskew_range,
+    fit_operation,
+    deskew_operation,
+    rotate_operation,
+    resize_operation,
+    encode_operation,
 )
 
 class PctComposerResponse:
@@ -56,6 +106,26 @@ class BaseComposer:
     def _log_debug(self, msg):
         if self._debug_writer and self._debug:
             self._debug_writer.write(msg)
+    
+    def _save_render(self, filepath, key, render):
+        # Renders with a recipe key are encoded once, then copied out of
+        # the render cache; render is only called on a miss
+        cache = get_render_cache()
+        extension = splitext(filepath)[1]
+        if key is not None and cache is not None \
+                and cache.copy(key, extension, filepath):
+            return True
+        encoded = get_scheduler().run(
+            'encode',
+            write_image,
+            filepath,
+            render(),
+        )
+        if encoded is None:
+            return False
+        if key is not None and cache is not None:
+            cache.write(key, extension, encoded)
+        return True
 
 class PctComposerError(BaseComposerError):
     pass
@@ -69,34 +139,126 @@ class PctComposer(BaseComposer):
             image_composer.prepare(debug)
         self._log_debug('Image preparation complete.')
     
-    def compose(self, debug=False):
+    def compose(self, debug=False, height=None, width=None, megapixels=None):
+        """
+        Composes the cards at the given output height, or else width, or
+        else at most the given megapixels. Without any, the output size
+        settings are used, and by default cards keep their resolution.
+        """
         self._debug = debug
         self._log_debug('Composing image...')
+        self._output_size = self._get_output_size(height, width, megapixels)
         if not self._create_composition():
             self._log('No composition could be created.')
             return False
         return True
     
+    def get_layout_mode(self):
+        return self._layout_mode
+    
+    def set_layout_mode(self, mode):
+        if mode not in PCT_LAYOUT_MODES:
+            raise PctComposerError('Unknown layout mode {}.'.format(mode))
+        self._layout_mode = mode
+    
     def refresh_previews(self, width, startx=0, starty=0, margin=0,
-                         debug=False):
+                         debug=False, progressive=False):
+        """
+        Shows the card previews. When progressive, previews that aren't
+        ready are shown as quick proxies, and the refinements that replace
+        them are returned.
+        """
         self._debug = debug
         self._log_debug('Refreshing previews...')
         x = startx
         y = starty
+        refinements = []
         for composer in self._get_composers():
-            composer.refresh_preview(x, y, width, debug)
+            refinement = composer.refresh_preview(
+                x,
+                y,
+                width,
+                debug,
+                progressive,
+            )
+            if refinement is not None:
+                refinements.append(refinement)
             x += width + margin
+        return refinements
 
-    def refresh_composition(self, width, startx=0, starty=0, debug=False):
+    def refresh_composition(self, width, startx=0, starty=0, debug=False,
+                            progressive=False):
         self._debug = debug
         self._log_debug('Refreshing composition...')
-        return self._refresh_composition(width, startx, starty)
+        return self._refresh_composition(width, startx, starty, progressive)
+
+    def get_image_files(self):
+        return [c.get_image_file() for c in self._get_composers()]
+    
+    def get_arrays(self):
+        arrays = []
+        for composer in self._get_composers():
+            arrays.extend(composer.get_arrays())
+        for composition in self._get_renders():
+            arrays.append(composition)
+        return arrays
+    
+    def spill(self, spill_files, debug=False):
+        self._debug = debug
+        self._log_debug('Spilling images...')
+        for composer in self._get_composers():
+            composer.spill(spill_files[composer.get_image_file()], debug)
+        return True
+    
+    def get_journal_operations(self):
+        # By image file, every operation since the file was loaded, including
+        # those already applied to an image restored from a spill
+        return {
+            c.get_image_file(): c.get_journal_operations()
+            for c in self._get_composers()
+        }
+    
+    def get_signatures(self):
+        # By image file, its signature when it was loaded
+        return {
+            c.get_image_file(): c.get_signature()
+            for c in self._get_composers()
+        }
+    
+    def set_image_source(self, image_loader=None, image_fingerprint=None,
+                         image_operations=None, image_signatures=None):
+        # For images loaded from now on, e.g. by update_images
+        self._image_loader = image_loader
+        self._image_fingerprint = image_fingerprint
+        self._image_operations = image_operations or {}
+        self._image_signatures = image_signatures or {}
+
+    def get_encoded_preview(self, index, width, debug=False):
+        self._debug = debug
+        self._log_debug('Encoding preview of image {}'.format(index))
+        if not self._check_index(index):
+            self._log('Invalid index.')
+            return None
+        return self._get_composer(index).get_encoded_preview(width, debug)
+
+    def get_encoded_composition(self, width, debug=False):
+        self._debug = debug
+        self._log_debug('Encoding composition preview...')
+        if self._composition_layout is None:
+            self._log('No composition has been created.')
+            return None
+        return self._get_encoded_composition(width)
 
     def reindex_image(self, index_in, index_out, debug=False):
         self._debug = debug
         self._log_debug('Swapping images {} and {}'.format(index_in, index_out))
         if self._check_index(index_in) and self._check_index(index_out):
-            return self._reindex_image(index_in, index_out)
+            if self._reindex_image(index_in, index_out):
+                self._journal_entry({
+                    'op': 'reindex',
+                    'value': [index_in, index_out],
+                })
+                return True
         return False
     
     def check_index(self, index, debug=False):
@@ -110,7 +272,11 @@ class PctComposer(BaseComposer):
         if not self._check_index(index):
             self._log('Invalid index.')
             return False
-        return self._get_composer(index).fit(strength, debug)
+        composer = self._get_composer(index)
+        if composer.fit(strength, debug):
+            self._journal_operation(composer)
+            return True
+        return False
     
     def fit_all(self, strength, debug=False):
         self._debug = debug
@@ -123,12 +289,31 @@ class PctComposer(BaseComposer):
         if not self._check_index(index):
             self._log('Invalid index.')
             return False
-        return self._get_composer(index).rotate(angle, debug)
+        composer = self._get_composer(index)
+        if composer.rotate(angle, debug):
+            self._journal_operation(composer)
+            return True
+        return False
              
-    def save(self, filepath, metafile=None, debug=False):
+    def save(self, filepath, metafile=None, debug=False, height=None,
+             width=None, megapixels=None):
+        """
+        Saves the composition, at the size it was composed at unless an
+        output size is given, along with the edited cards.
+        """
         self._debug = debug
         self._log_debug('Saving {}'.format(filepath))
         
+        if (height, width, megapixels) != (None, None, None):
+            self._output_size = self._get_output_size(
+                height,
+                width,
+                megapixels,
+            )
+            if not self._create_composition():
+                self._log('No composition could be created.')
+                return False
+        
         # Composed
         if not self._save_composed(filepath):
             self._log('Unable to save {}'.format(filepath))
@@ -148,13 +333,36 @@ class PctComposer(BaseComposer):
             
         return True
     
+    def export(self, filepath, height=None, fps=None, card_seconds=None,
+               fade_seconds=None, debug=False):
+        self._debug = debug
+        self._log_debug('Exporting {}'.format(filepath))
+        if height is None:
+            height = get_setting('PCT_EXPORT_HEIGHT')
+        if fps is None:
+            fps = get_setting('PCT_EXPORT_FPS')
+        if card_seconds is None:
+            card_seconds = get_setting('PCT_EXPORT_CARD_SECONDS')
+        if fade_seconds is None:
+            fade_seconds = get_setting('PCT_EXPORT_FADE_SECONDS')
+        try:
+            return self._export(filepath, height, fps, card_seconds,
+                                fade_seconds)
+        except PctExportError as err:
+            self._log('Unable to export {}: {}'.format(filepath, err))
+            return False
+    
     def undo(self, index, debug=False):
         self._debug = debug
         self._log_debug('Undoing action on image {}.'.format(index))
         if not self._check_index(index):
             self._log('Invalid index.')
             return False
-        return self._get_composer(index).undo(debug)
+        composer = self._get_composer(index)
+        if composer.undo(debug):
+            self._journal_history(composer, 'undo')
+            return True
+        return False
     
     def redo(self, index, debug=False):
         self._debug = debug
@@ -162,7 +370,41 @@ class PctComposer(BaseComposer):
         if not self._check_index(index):
             self._log('Invalid index.')
             return False
-        return self._get_composer(index).redo(debug)
+        composer = self._get_composer(index)
+        if composer.redo(debug):
+            self._journal_history(composer, 'redo')
+            return True
+        return False
+    
+    def update_images(self, added=(), changed=(), removed=(), strength=None,
+                      debug=False):
+        """
+        Applies changes to the image files. Removed cards are dropped,
+        changed cards are reloaded without their history, and added cards
+        are inserted in filename order. Only reloaded and added cards are
+        decoded, and fitted if a strength is given.
+        """
+        self._debug = debug
+        self._log_debug('Updating images...')
+        return self._update_images(added, changed, removed, strength)
+    
+    def recover(self, debug=False):
+        self._debug = debug
+        self._log_debug('Recovering journaled edits...')
+        if self._journal is None:
+            return 0
+        return self._recover()
+    
+    def attach(self, journal, headless=False, debug=False):
+        """
+        Attaches the journal and windows of a composer that was prepared
+        headless and without a journal, e.g. on another thread. Journaled
+        edits replace the edits made since it was prepared, and are
+        returned; otherwise those edits are journaled.
+        """
+        self._debug = debug
+        self._log_debug('Attaching composer...')
+        return self._attach(journal, headless)
     
     def cleanup(self, debug=False):
         self._debug = debug
@@ -173,11 +415,30 @@ class PctComposer(BaseComposer):
     # Private
     #
     
-    def __init__(self, image_files, message_writer=None, debug_writer=None):
+    def __init__(self, image_files, message_writer=None, debug_writer=None,
+                 headless=False, image_loader=None, journal=None,
+                 image_fingerprint=None, image_operations=None,
+                 image_signatures=None):
         super(PctComposer, self).__init__(message_writer, debug_writer)
+        self._headless = headless
+        self._journal = journal
+        self.set_image_source(
+            image_loader,
+            image_fingerprint,
+            image_operations,
+            image_signatures,
+        )
         self._init_image_composers(image_files)
         
         self._composition = None
+        self._composition_key = None
+        self._composition_layout = None
+        self._composition_slots = {}
+        self._composition_preview = None
+        self._previous_composition = None
+        self._layout_mode = get_setting('PCT_LAYOUT_MODE')
+        self._output_size = self._get_output_size()
+        self._encoded_composition = None
         self._window = None
 
     def _init_image_composers(self, image_files):
@@ -185,12 +446,20 @@ class PctComposer(BaseComposer):
         self._image_composers = {}
         for index, image in enumerate(image_files):
             self._indexed_images[index] = image
-            self._image_composers[image] =  ImgComposer(
-                image,
-                self._message_writer,
-                self._debug_writer,
-            )
+            self._image_composers[image] = self._create_image_composer(image)
         return self._image_composers
+    
+    def _create_image_composer(self, image):
+        return ImgComposer(
+            image,
+            self._message_writer,
+            self._debug_writer,
+            self._headless,
+            self._image_loader,
+            self._image_fingerprint,
+            self._image_operations.get(image),
+            self._image_signatures.get(image),
+        )
 
     def _init_window(self, name=None):
         self._destroy_window()
@@ -232,22 +501,308 @@ class PctComposer(BaseComposer):
         self._indexed_images[index_out] = temp
         return True
     
+    def _get_image_order(self):
+        return [self._indexed_images[i] for i in sorted(self._indexed_images)]
+    
+    def _set_image_order(self, image_files):
+        self._indexed_images = dict(enumerate(image_files))
+    
+    def _insert_image(self, image):
+        # Goes right after the last card whose filename sorts before it, so
+        # cards the user has moved stay where they are
+        image_files = self._get_image_order()
+        position = 0
+        for index, f in enumerate(image_files):
+            if f < image:
+                position = index + 1
+        image_files.insert(position, image)
+        self._image_composers[image] = self._create_image_composer(image)
+        self._set_image_order(image_files)
+        return self._image_composers[image]
+    
+    def _replace_image(self, image):
+        self._image_composers.pop(image).cleanup(self._debug)
+        self._image_composers[image] = self._create_image_composer(image)
+        return self._image_composers[image]
+    
+    def _remove_image(self, image):
+        self._image_composers.pop(image).cleanup(self._debug)
+        self._set_image_order(
+            [f for f in self._get_image_order() if f != image]
+        )
+    
+    def _update_images(self, added, changed, removed, strength):
+        for image in removed:
+            if image in self._image_composers:
+                self._remove_image(image)
+        
+        composers = []
+        for image in changed:
+            if image in self._image_composers:
+                composers.append(self._replace_image(image))
+        for image in sorted(added):
+            if image not in self._image_composers:
+                composers.append(self._insert_image(image))
+        
+        for composer in composers:
+            composer.prepare(self._debug)
+        if strength is not None and composers:
+            self._fit_composers(composers, strength)
+        self._rewrite_journal()
+        return True
+    
+    def _get_output_size(self, height=None, width=None, megapixels=None):
+        if (height, width, megapixels) == (None, None, None):
+            return (
+                get_setting('PCT_OUTPUT_HEIGHT'),
+                get_setting('PCT_OUTPUT_WIDTH'),
+                get_setting('PCT_OUTPUT_MEGAPIXELS'),
+            )
+        return (height or 0, width or 0, megapixels or 0)
+    
+    def _compute_layout(self):
+        layout = compute_layout(
+            [c.get_size() for c in self._get_composers()],
+            self._layout_mode,
+            get_setting('PCT_BORDER_PIXELS'),
+            get_setting('PCT_LAYOUT_MAX_WIDTH'),
+            get_setting('PCT_LAYOUT_MAX_ASPECT'),
+        )
+        return scale_layout(
+            layout,
+            get_layout_scale(layout, *self._output_size),
+        )
+    
+    def _get_composition_recipe(self, layout):
+        # None when some card can't be fingerprinted, which disables caching
+        recipes = [c.get_recipe() for c in self._get_composers()]
+        if None in recipes:
+            return None
+        return {
+            'composition': recipes,
+            'layout': get_layout_geometry(layout),
+        }
+    
     def _create_composition(self):
-        images = [c.get_image() for c in self._get_composers()]
-        min_height = min([img.shape[0] for img in images])
-        self._composition = compose_images(images, min_height)
+        if not self._image_composers:
+            return False
+        layout = self._compute_layout()
+        recipe = self._get_composition_recipe(layout)
+        key = None if recipe is None else get_recipe_key(recipe)
+        if key is not None and key == self._composition_key:
+            return True
+        
+        # Nothing is rendered until it is needed: a full composition only
+        # to be saved, and otherwise just previews at their display size
+        if self._composition is not None:
+            self._previous_composition = (
+                self._composition,
+                self._composition_slots,
+            )
+        self._composition = None
+        self._composition_key = key
+        self._composition_layout = layout
+        self._composition_slots = {}
         return True
     
-    def _refresh_composition(self, width, x=0, y=0):
+    def _get_renders(self):
+        renders = [self._composition]
+        if self._previous_composition is not None:
+            renders.append(self._previous_composition[0])
+        if self._composition_preview is not None:
+            renders.append(self._composition_preview[2])
+        return [r for r in renders if r is not None]
+    
+    def _snapshot_layout(self, layout):
+        # What each slot is rendered from, captured on this thread so that
+        # previews can be rendered on another
+        return [
+            (composer.get_tile_key(slot.height, slot.width),
+             composer.get_image(False),
+             slot)
+            for composer, slot in zip(self._get_composers(), layout.slots)
+        ]
+    
+    def _render_layout(self, layout, snapshot, previous=None,
+                       previous_slots={}, tiles=None):
+        """
+        Renders each card straight into its slot of layout, and returns the
+        canvas and the slots by tile key. Cards that are unchanged since
+        the previous render are copied out of it rather than resized again,
+        and tiles can supply the others.
+        """
+        rendered = []
+        slots = {}
+        for index, (key, image, slot) in enumerate(snapshot):
+            copied = previous_slots.get(key) if key is not None else None
+            if previous is not None and copied is not None:
+                rendered.append(previous[
+                    copied.y:copied.y+copied.height,
+                    copied.x:copied.x+copied.width,
+                ])
+            elif tiles is not None:
+                rendered.append(tiles(index, slot))
+            else:
+                rendered.append(resize_image(image, slot.height, slot.width))
+            if key is not None:
+                slots[key] = slot
+        return render_layout(layout, rendered), slots
+    
+    def _render_composition(self):
+        # Tiles of a composition to be saved go through the render cache
+        composers = self._get_composers()
+        previous, previous_slots = self._previous_composition or (None, {})
+        self._previous_composition = None
+        composition, self._composition_slots = self._render_layout(
+            self._composition_layout,
+            self._snapshot_layout(self._composition_layout),
+            previous,
+            previous_slots,
+            lambda index, slot: composers[index].get_tile(
+                slot.height,
+                slot.width,
+                self._debug,
+            ),
+        )
+        return composition
+    
+    def _get_composition(self):
+        if self._composition is None and self._composition_layout is not None:
+            cache = get_render_cache()
+            extension = splitext(PCT_COMPOSED_IMAGE_FILENAME)[1]
+            if cache is not None and self._composition_key is not None \
+                    and cache.has(self._composition_key, extension):
+                self._composition = read_image(cache.get_filepath(
+                    self._composition_key,
+                    extension,
+                ))
+            if self._composition is None:
+                self._composition = get_scheduler().run(
+                    'compose',
+                    self._render_composition,
+                )
+            else:
+                self._composition_slots = {}
+                self._previous_composition = None
+        return self._composition
+    
+    def _get_preview_layout(self, width):
+        return scale_layout(
+            self._composition_layout,
+            width / self._composition_layout.width,
+        )
+    
+    def _get_cached_composition_preview(self, layout):
+        cached = self._composition_preview
+        if cached is not None and self._composition_key is not None \
+                and cached[0] == (self._composition_key, layout):
+            return cached[2]
+        return None
+    
+    def _render_composition_preview(self, layout, snapshot, previous=None):
+        # Only reads what it is given, so that it can run in the background
+        if previous is None:
+            return self._render_layout(layout, snapshot)
+        return self._render_layout(layout, snapshot, previous[2], previous[3])
+    
+    def _set_composition_preview(self, layout, rendered):
+        preview, slots = rendered
+        self._composition_preview = (
+            (self._composition_key, layout),
+            layout,
+            preview,
+            slots,
+        )
+        return preview
+    
+    def _get_composition_preview(self, width):
+        # Rendered at the display width straight from the cards, with no
+        # full-size composition in between
+        layout = self._get_preview_layout(width)
+        preview = self._get_cached_composition_preview(layout)
+        if preview is None:
+            preview = self._set_composition_preview(
+                layout,
+                get_scheduler().run(
+                    'compose',
+                    self._render_composition_preview,
+                    layout,
+                    self._snapshot_layout(layout),
+                    self._composition_preview,
+                ),
+            )
+        return preview
+    
+    def _refresh_composition(self, width, x=0, y=0, progressive=False):
+        if self._composition_layout is None:
+            return []
+        if self._headless:
+            # Rendered all the same, as card previews are, so that headless
+            # sessions (e.g. replays) do the work they would on screen
+            self._get_composition_preview(width)
+            return []
         self._init_window()
-        preview = resize_image_width(self._composition, width)
-        self._show_image(preview, x, y)
+        layout = self._get_preview_layout(width)
+        if not progressive \
+                or self._get_cached_composition_preview(layout) is not None:
+            self._show_image(self._get_composition_preview(width), x, y)
+            return []
+        
+        snapshot = self._snapshot_layout(layout)
+        self._show_image(
+            render_layout(layout, [
+                resize_image_nearest(
+                    composer.get_proxy(self._debug),
+                    slot.height,
+                    slot.width,
+                )
+                for composer, slot in zip(self._get_composers(), layout.slots)
+            ]),
+            x,
+            y,
+        )
+        source = self._composition_layout
+        previous = self._composition_preview
+        return [PctRefinement(
+            lambda: self._render_composition_preview(
+                layout,
+                snapshot,
+                previous,
+            ),
+            lambda rendered: self._refine_composition(
+                source,
+                layout,
+                rendered,
+                x,
+                y,
+            ),
+        )]
+    
+    def _refine_composition(self, source, layout, rendered, x, y):
+        # Stale once the cards were composed again, or the window closed
+        if source is not self._composition_layout or self._window is None:
+            return False
+        self._show_image(self._set_composition_preview(layout, rendered), x, y)
+        return True
+
+    def _get_encoded_composition(self, width):
+        # Cached against the preview it was encoded from
+        preview = self._get_composition_preview(width)
+        cached = self._encoded_composition
+        if cached is not None and cached[0] is preview:
+            return cached[1]
+        encoded = encode_image(preview)
+        if encoded is None:
+            return None
+        result = (encoded, sha1(encoded).hexdigest())
+        self._encoded_composition = (preview, result)
+        return result
     
     def _show_image(self, image, x=None, y=None):
         cv2.imshow(self._window, image)
         if x is not None and y is not None:
             cv2.moveWindow(self._window, x, y)
-        cv2.waitKey(PCT_HACK_WINDOW_DELAY)
+        cv2.waitKey(get_setting('PCT_HACK_WINDOW_DELAY'))
     
     def _save_changed_images(self):
         filepaths = []
@@ -256,8 +811,11 @@ class PctComposer(BaseComposer):
         return filepaths
     
     def _save_composed(self, filepath):
-        cv2.imwrite(filepath, self._composition)
-        return True
+        return self._save_render(
+            filepath,
+            self._composition_key,
+            self._get_composition,
+        )
     
     def _save_metadata(self, filepath, image_files, composed_file):
         fp = open(filepath, 'w')
@@ -267,10 +825,213 @@ class PctComposer(BaseComposer):
         fp.close()
         return True
     
+    def _export(self, filepath, height, fps, card_seconds, fade_seconds):
+        composers = self._get_composers()
+        if not composers:
+            return False
+        
+        # Frames are sized for the widest card; even sizes keep encoders happy
+        aspect = max([c.get_aspect() for c in composers])
+        height += height % 2
+        width = int(height * aspect)
+        width += width % 2
+        
+        hold_frames = max(1, int(round(card_seconds * fps)))
+        fade_frames = int(round(fade_seconds * fps))
+        
+        writer = PctAnimationWriter(
+            filepath,
+            width,
+            height,
+            fps,
+            get_setting('PCT_FFMPEG_BINARY'),
+        )
+        try:
+            # Only the previous and current frames are ever held
+            previous = None
+            for composer in composers:
+                frame = composer.get_frame(height, width, self._debug)
+                if previous is not None:
+                    for i in range(1, fade_frames + 1):
+                        alpha = i / (fade_frames + 1)
+                        writer.write(blend_images(previous, frame, alpha))
+                for _ in range(hold_frames):
+                    writer.write(frame)
+                previous = frame
+        except PctExportError:
+            writer.abort()
+            raise
+        return writer.close()
+    
     def _fit_all(self, strength):
+        return self._fit_composers(self._get_composers(), strength)
+    
+    def _fit_composers(self, composers, strength):
+        # Fit geometry is found for every card in one batch, then all of
+        # the deskew warps run in a second batch; crops are applied here
+        executor = get_executor()
+        operations = executor.map(
+            fit_operation,
+            [c.get_image(False) for c in composers],
+            strength,
+            get_setting('PCT_FIT_BUFFER'),
+            get_deskew_range(),
+        )
+        deskews = [
+            (c, operation[1]) for c, operation in zip(composers, operations)
+            if operation is not None and operation[0] == 'deskew'
+        ]
+        warped = executor.map_each(
+            deskew_operation,
+            [c.get_image(False) for c, _ in deskews],
+            [(geometry,) for _, geometry in deskews],
+        )
+        warped = {id(c): image for (c, _), image in zip(deskews, warped)}
+        
+        results = []
+        for c, operation in zip(composers, operations):
+            if operation is None:
+                fitted = False
+            elif operation[0] == 'deskew':
+                fitted = c.deskew(operation[1], warped[id(c)], self._debug)
+            else:
+                fitted = c.crop(operation[1], self._debug)
+            if fitted:
+                self._journal_operation(c)
+            results.append(fitted)
+        return all(results)
+    
+    def _get_journal_key(self, composer):
+        return get_image_name(composer.get_image_file())
+    
+    def _get_journal_header(self, image_files=None):
+        # Signed as the images were loaded, so that journals of images that
+        # have changed on disk since are discarded
+        if image_files is None:
+            image_files = [c.get_image_file() for c in self._get_composers()]
+        return {
+            'op': 'open',
+            'files': [get_image_name(f) for f in image_files],
+            'signatures': [
+                self._image_composers[f].get_signature() for f in image_files
+            ],
+        }
+    
+    def _journal_entry(self, entry):
+        if self._journal is not None:
+            self._journal.append(entry)
+    
+    def _journal_operation(self, composer):
+        operation, value = composer.get_operation()
+        self._journal_entry({
+            'op': operation,
+            'file': self._get_journal_key(composer),
+            'value': value,
+        })
+    
+    def _journal_history(self, composer, action):
+        self._journal_entry({
+            'op': action,
+            'file': self._get_journal_key(composer),
+        })
+    
+    def _rewrite_journal(self):
+        # Written as if the current images had been loaded fresh (in sorted
+        # order) and then edited into their current state and order
+        if self._journal is None:
+            return False
+        image_files = self.get_image_files()
+        loaded = sorted(image_files)
+        self._journal.reset(self._get_journal_header(loaded))
+        for composer in self._get_composers():
+            for operation, value in composer.get_journal_operations():
+                self._journal_entry({
+                    'op': operation,
+                    'file': self._get_journal_key(composer),
+                    'value': value,
+                })
+        for index, image in enumerate(image_files):
+            current = loaded.index(image)
+            if current != index:
+                loaded[index], loaded[current] = loaded[current], loaded[index]
+                self._journal_entry({
+                    'op': 'reindex',
+                    'value': [index, current],
+                })
+        return True
+    
+    def _recover(self):
+        edits = self._read_journal()
+        if edits is None:
+            self._journal.reset(self._get_journal_header())
+            return 0
+        if edits:
+            self._replay(edits)
+        return len(edits)
+    
+    def _read_journal(self):
+        # Returns the journaled edits, or None if the journal doesn't match
+        entries = self._journal.read()
+        if not entries or entries[0] != self._get_journal_header():
+            if entries:
+                self._log('The edit journal does not match the loaded '
+                          'images and was discarded.')
+            return None
+        return entries[1:]
+    
+    def _attach(self, journal, headless):
+        self._journal = journal
+        self._headless = headless
         for c in self._get_composers():
-            if not c.fit(strength, self._debug):
-                return False
+            c.attach(headless, self._debug)
+        
+        edits = self._read_journal()
+        if not edits:
+            self._rewrite_journal()
+            return 0
+        for c in self._get_composers():
+            c.revert(self._debug)
+        self._replay(edits)
+        return len(edits)
+    
+    def _replay(self, edits):
+        # The undo and redo stacks are resolved symbolically first, so only
+        # the operations that survive are applied to the pixels
+        composers = {
+            self._get_journal_key(c): c for c in self._get_composers()
+        }
+        stacks = {key: [] for key in composers}
+        redo_stacks = {key: [] for key in composers}
+        for edit in edits:
+            op = edit.get('op')
+            if op == 'reindex':
+                index_in, index_out = edit['value']
+                if self._check_index(index_in) and \
+                        self._check_index(index_out):
+                    self._reindex_image(index_in, index_out)
+                continue
+            key = edit.get('file')
+            if key not in composers:
+                continue
+            if op == 'undo':
+                if stacks[key]:
+                    redo_stacks[key].append(stacks[key].pop())
+            elif op == 'redo':
+                if redo_stacks[key]:
+                    stacks[key].append(redo_stacks[key].pop())
+            elif op in ('crop', 'rotate', 'deskew'):
+                stacks[key].append((op, edit['value']))
+                redo_stacks[key] = []
+        
+        for key, stack in stacks.items():
+            composer = composers[key]
+            for op, value in stack:
+                if op == 'crop':
+                    composer.crop(value, self._debug)
+                elif op == 'deskew':
+                    composer.deskew(value, debug=self._debug)
+                else:
+                    composer.rotate(value, self._debug)
         return True
     
     def _cleanup(self):
@@ -282,6 +1043,9 @@ class PctComposer(BaseComposer):
         # Cleans up any composed image
         self._destroy_window()
         
+        if self._journal is not None:
+            self._journal.close()
+        
         return True
     
 class ImgComposerError(BaseComposerError):
@@ -295,13 +1059,142 @@ class ImgComposer(BaseComposer):
         self._prepare_image()
         self._prepare_window()
     
-    def refresh_preview(self, x, y, width, debug=False):
+    def attach(self, headless=False, debug=False):
+        # Shows a card prepared headless
         self._debug = debug
-        preview = resize_image_width(self._current_image(), width)
-        self._show_image(preview, x, y)
+        self._headless = headless
+        self._prepare_window()
+    
+    def revert(self, debug=False):
+        # Drops every edit, back to the loaded image
+        self._debug = debug
+        self._log_debug('Reverting {}'.format(self._image_file))
+        del self._images[1:]
+        del self._operations[1:]
+        self._init_redo_images()
+        self._init_previews()
+        return True
+    
+    def refresh_preview(self, x, y, width, debug=False, progressive=False):
+        """
+        Shows the preview at the given width. When progressive, a preview
+        that isn't ready is shown as a quick proxy, and the refinement that
+        replaces it is returned; otherwise returns None.
+        """
+        self._debug = debug
+        if not progressive or self._headless \
+                or self._get_cached_preview(width) is not None:
+            preview = self._get_preview(width)
+            if not self._headless:
+                self._show_image(preview, x, y)
+            return None
+        
+        image = self._current_image()
+        self._show_image(
+            resize_image_nearest(
+                self._get_proxy(),
+                max(1, (width * image.shape[0]) // image.shape[1]),
+                width,
+            ),
+            x,
+            y,
+        )
+        return PctRefinement(
+            lambda: get_executor().run(resize_operation, image, width),
+            lambda preview: self._refine_preview(image, width, preview, x, y),
+        )
+    
+    def get_image(self, copy=True):
+        if copy:
+            return self._current_image().copy()
+        return self._current_image()
+    
+    def get_image_file(self):
+        return self._image_file
+    
+    def get_proxy(self, debug=False):
+        """
+        Returns the card scaled down to at most PCT_PROXY_WIDTH, made once
+        per edit, for the quick proxies of progressive refreshes.
+        """
+        self._debug = debug
+        return self._get_proxy()
+    
+    def get_arrays(self):
+        arrays = self._images + self._redo_images
+        if self._proxy is not None and self._proxy[1] is not self._proxy[0]:
+            arrays.append(self._proxy[1])
+        for cached in self._previews.values():
+            if isinstance(cached[1], PctPackedImage):
+                arrays.append(cached[1].bits)
+            else:
+                arrays.append(cached[1])
+        return arrays
+    
+    def spill(self, filepath, debug=False):
+        self._debug = debug
+        self._log_debug('Spilling {} to {}'.format(self._image_file, filepath))
+        save_raw_image(filepath, self._current_image())
+        return True
+    
+    def get_aspect(self):
+        image = self._current_image()
+        return image.shape[1] / image.shape[0]
+    
+    def get_height(self):
+        return self._current_image().shape[0]
+    
+    def get_operations(self):
+        return [o for o in self._operations if o is not None]
+    
+    def get_journal_operations(self):
+        return self._loaded_operations + self.get_operations()
+    
+    def get_signature(self):
+        # The file's signature when it was loaded, or None if it had none
+        return self._signature
+    
+    def get_recipe(self):
+        """
+        Returns what the current image is derived from: the source
+        fingerprint, the operations applied since loading it and the image
+        backends that ran them.
+        """
+        if self._fingerprint is None:
+            return None
+        return {
+            'source': self._fingerprint,
+            'channels': 1 if self._images[0].ndim == 2 else 3,
+            'operations': self.get_operations(),
+            'backends': get_backend_recipe(),
+        }
+    
+    def get_size(self):
+        return self._current_image().shape[:2]
+    
+    def get_tile(self, height, width, debug=False):
+        self._debug = debug
+        self._log_debug('Tiling {}'.format(self._image_file))
+        return self._get_tile(height, width)
+    
+    def get_tile_key(self, height, width):
+        recipe = self.get_recipe()
+        if recipe is None:
+            return None
+        return get_recipe_key({
+            'tile': recipe,
+            'size': [height, width],
+        })
     
-    def get_image(self):
-        return self._current_image().copy()
+    def get_frame(self, height, width, debug=False):
+        self._debug = debug
+        self._log_debug('Framing {}'.format(self._image_file))
+        return self._get_frame(height, width)
+    
+    def get_encoded_preview(self, width, debug=False):
+        self._debug = debug
+        self._log_debug('Encoding preview of {}'.format(self._image_file))
+        return self._get_encoded_preview(width)
     
     def get_window(self):
         return self._window
@@ -321,6 +1214,30 @@ class ImgComposer(BaseComposer):
             self._init_redo_images()
             return True
         return False
+    
+    def crop(self, bounds, debug=False):
+        self._debug = debug
+        self._log_debug('Cropping {}'.format(self._image_file))
+        if self._crop(bounds):
+            self._init_redo_images()
+            return True
+        return False
+    
+    def deskew(self, geometry, image=None, debug=False):
+        """
+        Rotates and crops in one transform; geometry is the angle followed
+        by the crop bounds in the rotated image. An image that was already
+        transformed elsewhere can be passed in.
+        """
+        self._debug = debug
+        self._log_debug('Deskewing {}'.format(self._image_file))
+        if self._deskew(geometry, image):
+            self._init_redo_images()
+            return True
+        return False
+    
+    def get_operation(self):
+        return self._current_operation()
         
     def save(self, debug=False):
         self._debug = debug
@@ -349,46 +1266,195 @@ class ImgComposer(BaseComposer):
     # Private
     #
     
-    def __init__(self, image_file, message_writer=None, debug_writer=None):
+    def __init__(self, image_file, message_writer=None, debug_writer=None,
+                 headless=False, image_loader=None, image_fingerprint=None,
+                 loaded_operations=None, loaded_signature=None):
         super(ImgComposer, self).__init__(message_writer, debug_writer)
         self._init_images()
         self._init_redo_images()
+        self._init_previews()
         
         self._image_file = image_file
+        self._headless = headless
+        self._image_loader = image_loader
+        self._image_fingerprint = image_fingerprint
+        # Operations already applied to the image the loader returns
+        self._loaded_operations = list(loaded_operations or [])
+        self._signature = loaded_signature
+        self._fingerprint = None
         self._window = None
     
     def _init_images(self):
+        # Each image is paired with the operation that produced it
         self._images = []
+        self._operations = []
     
     def _init_redo_images(self):
         self._redo_images = []
+        self._redo_operations = []
+    
+    def _init_previews(self):
+        # Maps width to (source image, preview, encoded preview); previews
+        # of single-channel cards may be held bit-packed. The proxy is a
+        # (source image, proxy) pair
+        self._previews = {}
+        self._proxy = None
         
-    def _add_image(self, image):
+    def _add_image(self, image, operation=None):
         self._images.append(image)
+        self._operations.append(operation)
     
-    def _add_redo_image(self, image):
+    def _add_redo_image(self, image, operation=None):
         self._redo_images.append(image)
+        self._redo_operations.append(operation)
     
     def _current_image(self):
         if len(self._images) < 1:
             return None
         return self._images[-1]
     
+    def _current_operation(self):
+        if len(self._operations) < 1:
+            return None
+        return self._operations[-1]
+    
+    def _current_redo_operation(self):
+        if len(self._redo_operations) < 1:
+            return None
+        return self._redo_operations[-1]
+    
     def _pop_image(self):
         if len(self._images) < 2:
             return None
+        self._operations.pop()
         return self._images.pop()
     
     def _pop_redo_image(self):
         if len(self._redo_images) < 1:
             return None
+        self._redo_operations.pop()
         return self._redo_images.pop()
     
+    def _get_cached_preview(self, key):
+        cached = self._previews.get(key)
+        if cached is None or cached[0] is not self._current_image():
+            return None
+        return cached
+    
+    def _get_preview(self, width):
+        cached = self._get_cached_preview(width)
+        if cached is not None:
+            return self._unpack_preview(cached[1])
+        image = self._current_image()
+        preview = self._pack_preview(
+            get_executor().run(resize_operation, image, width)
+        )
+        self._previews[width] = (image, preview, None)
+        return self._unpack_preview(preview)
+    
+    def _get_proxy(self):
+        image = self._current_image()
+        if self._proxy is not None and self._proxy[0] is image:
+            return self._proxy[1]
+        width = get_setting('PCT_PROXY_WIDTH')
+        proxy = image
+        if image.shape[1] > width:
+            proxy = get_executor().run(resize_operation, image, width)
+        self._proxy = (image, proxy)
+        return proxy
+    
+    def _refine_preview(self, image, width, preview, x, y):
+        # Stale once the image has changed, or the window was closed
+        if image is not self._current_image() or self._window is None:
+            return False
+        self._previews[width] = (image, self._pack_preview(preview), None)
+        self._show_image(preview, x, y)
+        return True
+    
+    def _pack_preview(self, preview):
+        if preview.ndim == 2 and get_setting('PCT_PACKED_PREVIEWS'):
+            return pack_image(preview)
+        return preview
+    
+    def _unpack_preview(self, preview):
+        if isinstance(preview, PctPackedImage):
+            return unpack_image(preview)
+        return preview
+    
+    def _get_encoded_preview(self, width):
+        preview = self._get_preview(width)
+        cached = self._previews[width]
+        if cached[2] is not None:
+            return cached[2]
+        encoded = get_executor().run(
+            encode_operation,
+            preview,
+            '.jpg',
+            get_setting('PCT_JPEG_QUALITY'),
+        )
+        if encoded is None:
+            return None
+        result = (encoded, sha1(encoded).hexdigest())
+        self._previews[width] = (cached[0], cached[1], result)
+        return result
+    
+    def _get_frame(self, height, width):
+        # Frames are downscaled from the smallest adequate cached preview
+        # if there is one, and are not cached themselves so that exports
+        # don't grow memory with the number of cards
+        source = self._current_image()
+        widths = [
+            key for key, cached in self._previews.items()
+            if isinstance(key, int) and key >= width and cached[0] is source
+            and not isinstance(cached[1], PctPackedImage)
+        ]
+        if widths:
+            source = self._previews[min(widths)][1]
+        return fit_image_to_frame(source, height, width)
+    
     def _prepare_image(self):
         self._log_debug('Preparing image {}'.format(self._image_file))
-        self._add_image(cv2.imread(self._image_file))
+        # Signed before reading, so that a change while it is read is seen
+        # as a change afterwards
+        if self._signature is None:
+            self._signature = self._get_signature()
+        if self._image_loader is not None:
+            image = self._image_loader(self._image_file)
+        else:
+            image = read_image(self._image_file)
+        self._add_image(compact_image(image))
+        self._fingerprint = self._get_fingerprint()
+    
+    def _get_fingerprint(self):
+        # Taken when the image is loaded, so later changes to the file
+        # can't be mistaken for what was loaded
+        if self._image_fingerprint is not None:
+            return self._image_fingerprint(self._image_file)
+        if self._signature is None:
+            return None
+        return [abspath(self._image_file), self._signature]
+    
+    def _get_signature(self):
+        try:
+            return get_file_signature(self._image_file)
+        except OSError:
+            return None
+    
+    def _get_tile(self, height, width):
+        # Resized once, straight from the current image to its slot
+        cache = get_render_cache()
+        key = self.get_tile_key(height, width)
+        if cache is None or key is None:
+            return resize_image(self._current_image(), height, width)
+        tile = cache.read_array(key)
+        if tile is None:
+            tile = resize_image(self._current_image(), height, width)
+            cache.write_array(key, tile)
+        return tile
         
     def _prepare_window(self):
+        if self._headless:
+            return
         self._log_debug('Preparing window for {}'.format(self._image_file))
         self._window = basename(self._image_file)
         cv2.namedWindow(self._window)
@@ -400,58 +1466,88 @@ class ImgComposer(BaseComposer):
         
     def _show_image(self, image=None, x=None, y=None):
         self._log_debug('Showing image {}'.format(self._image_file))
+        if self._window is None:
+            self._prepare_window()
         if image is None:
             cv2.imshow(self._window, self._current_image())
         else:
             cv2.imshow(self._window, image)
         if x is not None and y is not None:
             cv2.moveWindow(self._window, x, y)
-        cv2.waitKey(PCT_HACK_WINDOW_DELAY)
+        cv2.waitKey(get_setting('PCT_HACK_WINDOW_DELAY'))
 
     def _get_save_filepath(self):
         return get_edited_image_filepath(self._image_file)
     
     def _fit(self, strength):
-        contours = find_dominant_contours(self._current_image(), strength)
-        if contours is None:
-            return False
-        left, right, top, bottom = collected_extrema(contours)
-        fitted = crop_image(
+        operation = get_executor().run(
+            fit_operation,
             self._current_image(),
-            left,
-            right,
-            top,
-            bottom,
-            PCT_FIT_BUFFER,
+            strength,
+            get_setting('PCT_FIT_BUFFER'),
+            get_deskew_range(),
         )
-        if fitted is None:
+        if operation is None:
+            return False
+        if operation[0] == 'deskew':
+            return self._deskew(operation[1])
+        return self._crop(operation[1])
+    
+    def _deskew(self, geometry, image=None):
+        _, left, right, top, bottom = geometry
+        if right <= left or bottom <= top:
             return False
-        self._add_image(fitted)
+        if image is None:
+            image = get_executor().run(
+                deskew_operation,
+                self._current_image(),
+                geometry,
+            )
+        self._add_image(image, ('deskew', list(geometry)))
+        return True
+    
+    def _crop(self, bounds):
+        left, right, top, bottom = bounds
+        if right <= left or bottom <= top:
+            return False
+        fitted = crop_image(self._current_image(), left, right, top, bottom)
+        self._add_image(fitted, ('crop', [left, right, top, bottom]))
         return True
     
     def _rotate(self, angle):
-        rotated = rotate_image(self._current_image(), angle)
-        self._add_image(rotated)
+        rotated = get_executor().run(
+            rotate_operation,
+            self._current_image(),
+            angle,
+        )
+        self._add_image(rotated, ('rotate', angle))
         return True
 
     def _save(self, filepath=None):
-        cv2.imwrite(filepath, self._current_image())
-        return True
+        recipe = self.get_recipe()
+        return self._save_render(
+            filepath,
+            None if recipe is None else get_recipe_key({'edited': recipe}),
+            self._current_image,
+        )
     
     def _undo(self):
+        operation = self._current_operation()
         image = self._pop_image()
         if image is not None:
-            self._add_redo_image(image)
+            self._add_redo_image(image, operation)
             return True
         return False
     
     def _redo(self):
+        operation = self._current_redo_operation()
         image = self._pop_redo_image()
         if image is not None:
-            self._add_image(image)
+            self._add_image(image, operation)
             return True
         return False
 
     def _cleanup(self):
         self._destroy_window()
+        self._init_previews()
         return True
\ No newline at end of file
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+"""
+Near-duplicate detection for input images using perceptual hashes.
+
+Hashes only nominate candidates: a card is taken for a duplicate of an
+earlier one once their grayscale thumbnails are confirmed to correlate.
+"""
+
+import numpy
+
+from ..common.configuration import (
+    PCT_DUPLICATE_CORRELATION,
+    PCT_DUPLICATE_THRESHOLD,
+    PCT_HASH_CACHE_KEY,
+    PCT_THUMBNAIL_CACHE_KEY,
+    PCT_THUMBNAIL_SIZE,
+)
+from .imageprocessing import (
+    read_image_proxies,
+    compute_dhash,
+    compute_thumbnail,
+    correlate_thumbnails,
+    hamming_distances,
+)
+
+def get_image_hashes(filepaths, cache=None):
+    return get_image_values(
+        filepaths,
+        cache,
+        PCT_HASH_CACHE_KEY,
+        compute_dhash,
+    )
+
+def get_image_thumbnails(filepaths, cache=None):
+    # Only needed for candidates, so only cached for them
+    values = get_image_values(
+        filepaths,
+        cache,
+        PCT_THUMBNAIL_CACHE_KEY,
+        lambda proxy: compute_thumbnail(proxy).tobytes().hex(),
+    )
+    return [
+        None if v is None else numpy.frombuffer(
+            bytes.fromhex(v),
+            numpy.uint8,
+        ).reshape(PCT_THUMBNAIL_SIZE, PCT_THUMBNAIL_SIZE)
+        for v in values
+    ]
+
+def get_image_values(filepaths, cache, key, compute):
+    """
+    Returns a value computed from each image's proxy, None for unreadable
+    images. Images missing from the cache are read together, so the
+    members of an archive are read in a single pass.
+    """
+    values = {}
+    if cache is not None:
+        for f in filepaths:
+            values[f] = cache.get(f, key)
+    missing = [f for f in filepaths if values.get(f) is None]
+    for f, proxy in zip(missing, read_image_proxies(missing)):
+        if proxy is None:
+            continue
+        values[f] = compute(proxy)
+        if cache is not None:
+            cache.set(f, key, values[f])
+    return [values.get(f) for f in filepaths]
+
+def find_duplicate_images(filepaths, threshold=PCT_DUPLICATE_THRESHOLD,
+                          cache=None, correlation=PCT_DUPLICATE_CORRELATION):
+    """
+    Returns a dictionary mapping each near-duplicate file to the earlier
+    file it duplicates. Files are compared in the order given.
+    """
+    hashed = [
+        (f, h)
+        for f, h in zip(filepaths, get_image_hashes(filepaths, cache))
+        if h is not None
+    ]
+    if len(hashed) < 2:
+        return {}
+
+    # Thumbnails are read together, for the candidates only
+    distances = hamming_distances([h for _, h in hashed])
+    candidates = set()
+    for i in range(len(hashed)):
+        for j in range(i):
+            if distances[i, j] <= threshold:
+                candidates.update([hashed[i][0], hashed[j][0]])
+    candidates = [f for f, _ in hashed if f in candidates]
+    thumbnails = dict(zip(
+        candidates,
+        get_image_thumbnails(candidates, cache),
+    ))
+
+    duplicates = {}
+    originals = []
+    for i, (f, _) in enumerate(hashed):
+        for j in originals:
+            if distances[i, j] <= threshold and is_confirmed_duplicate(
+                    thumbnails[f],
+                    thumbnails[hashed[j][0]],
+                    correlation):
+                duplicates[f] = hashed[j][0]
+                break
+        else:
+            originals.append(i)
+    return duplicates
+
+def is_confirmed_duplicate(thumbnail, other,
+                           correlation=PCT_DUPLICATE_CORRELATION):
+    if thumbnail is None or other is None:
+        return False
+    return correlate_thumbnails(thumbnail, other) >= correlation
+
+def filter_duplicate_images(filepaths, policy,
+                            threshold=PCT_DUPLICATE_THRESHOLD, cache=None,
+                            correlation=PCT_DUPLICATE_CORRELATION):
+    """
+    Applies a duplicate policy ('off', 'warn' or 'skip') to the filepaths.
+    Returns the filepaths to load and the detected duplicates.
+    """
+    if policy == 'off':
+        return list(filepaths), {}
+    duplicates = find_duplicate_images(
+        filepaths,
+        threshold,
+        cache,
+        correlation,
+    )
+    if policy == 'skip':
+        return [f for f in filepaths if f not in duplicates], duplicates
+    return list(filepaths), duplicates
@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+
+"""
+Execution backends for image operations.
+
+The thread backend runs operations as jobs of the scheduler (see
+pct.common.scheduler), which only helps while OpenCV holds no GIL. The
+process backend runs them in a process pool with a worker per scheduler
+slot, and each waits for a slot before it is sent: images are handed to
+workers through shared memory blocks rather than pickled, and array
+results come back the same way. The backend is chosen with the
+PCT_EXECUTION_BACKEND setting.
+"""
+
+import atexit
+import threading
+
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy
+
+from ..common.configuration import (
+    PCT_EXECUTION_BACKENDS,
+)
+from ..common.scheduler import (
+    get_scheduler,
+    limit_library_threads,
+)
+from ..common.settings import (
+    get_setting,
+)
+from .imageprocessing import (
+    crop_bounds,
+    deskew_bounds,
+    deskew_image,
+    estimate_skew,
+    get_rectangularity,
+    encode_image,
+    resize_image_width,
+    rotate_image,
+    find_dominant_contours,
+    collected_extrema,
+)
+
+class PctExecutionError(Exception):
+    pass
+
+#
+# Operations (module level, so that they can be sent to worker processes)
+#
+
+def fit_operation(image, strength, buffer, deskew=None):
+    """
+    Returns the operation that fits image to its card: a crop, or with
+    deskew given as (minimum angle, maximum angle, minimum rectangularity),
+    a deskew whenever the card is skewed by an angle in that range and its
+    contours are rectangular enough to trust it. None if nothing was found.
+    """
+    contours = find_dominant_contours(image, strength)
+    if not contours:
+        return None
+    if deskew is not None and get_rectangularity(contours) >= deskew[2]:
+        angle = estimate_skew(contours)
+        if deskew[0] <= abs(angle) <= deskew[1]:
+            bounds = deskew_bounds(image, contours, angle, buffer)
+            return ('deskew', [angle] + list(bounds))
+    left, right, top, bottom = collected_extrema(contours)
+    return ('crop', list(crop_bounds(image, left, right, top, bottom, buffer)))
+
+def deskew_operation(image, geometry):
+    return deskew_image(image, *geometry)
+
+def rotate_operation(image, angle):
+    return rotate_image(image, angle)
+
+def resize_operation(image, width):
+    return resize_image_width(image, width)
+
+def encode_operation(image, extension, quality):
+    return encode_image(image, extension, quality)
+
+# Job kinds, for the scheduler's stats
+_OPERATION_KINDS = {
+    fit_operation: 'fit',
+    deskew_operation: 'fit',
+    rotate_operation: 'rotate',
+    resize_operation: 'resize',
+    encode_operation: 'encode',
+}
+
+def get_operation_kind(operation):
+    return _OPERATION_KINDS.get(operation, operation.__name__)
+
+#
+# Backends
+#
+
+class PctThreadExecutor:
+
+    def run(self, operation, image, *args):
+        return get_scheduler().run(
+            get_operation_kind(operation),
+            operation,
+            image,
+            *args
+        )
+
+    def map(self, operation, images, *args):
+        return self.map_each(operation, images, [args] * len(images))
+
+    def map_each(self, operation, images, args_list):
+        return get_scheduler().map(
+            get_operation_kind(operation),
+            lambda item: operation(item[0], *item[1]),
+            list(zip(images, args_list)),
+        )
+
+    def shutdown(self):
+        # The scheduler's workers are shared, and shut down at exit
+        pass
+
+class PctProcessExecutor:
+
+    def run(self, operation, image, *args):
+        return self.map(operation, [image], *args)[0]
+
+    def map(self, operation, images, *args):
+        return self.map_each(operation, images, [args] * len(images))
+
+    def map_each(self, operation, images, args_list):
+        blocks = []
+        try:
+            futures = []
+            for image, args in zip(images, args_list):
+                block, shared = _share_array(image, self._shared_memory)
+                blocks.append(block)
+                futures.append(get_scheduler().submit(
+                    get_operation_kind(operation),
+                    self._run_in_pool,
+                    operation,
+                    shared,
+                    args,
+                ))
+            return [_receive(f.result(), self._shared_memory) for f in futures]
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    #
+    # Private
+    #
+
+    def __init__(self):
+        try:
+            from multiprocessing import shared_memory
+        except ImportError:
+            raise PctExecutionError(
+                'The process backend requires Python 3.8 or later.'
+            )
+        self._shared_memory = shared_memory
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                scheduler = get_scheduler()
+                self._pool = ProcessPoolExecutor(
+                    max_workers=scheduler.get_slots(),
+                    initializer=_init_worker,
+                    initargs=(scheduler.get_threads_per_job(),),
+                )
+            return self._pool
+
+    def _run_in_pool(self, operation, shared, args):
+        # Holds a scheduler slot while the worker process runs
+        return self._get_pool().submit(
+            _run_shared,
+            operation,
+            shared,
+            args,
+        ).result()
+
+_BACKENDS = {
+    'thread': PctThreadExecutor,
+    'process': PctProcessExecutor,
+}
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+def get_executor(backend=None):
+    if backend is None:
+        backend = get_setting('PCT_EXECUTION_BACKEND')
+    if backend not in PCT_EXECUTION_BACKENDS:
+        raise PctExecutionError(
+            'Unknown execution backend {}.'.format(backend)
+        )
+    with _executors_lock:
+        executor = _executors.get(backend)
+        if executor is None:
+            executor = _BACKENDS[backend]()
+            _executors[backend] = executor
+        return executor
+
+def get_deskew_range():
+    # Resolved here so that worker processes never read settings
+    if not get_setting('PCT_DESKEW'):
+        return None
+    return (
+        get_setting('PCT_DESKEW_MIN_ANGLE'),
+        get_setting('PCT_DESKEW_MAX_ANGLE'),
+        get_setting('PCT_DESKEW_MIN_RECTANGULARITY'),
+    )
+
+def shutdown_executors():
+    with _executors_lock:
+        for executor in _executors.values():
+            executor.shutdown()
+        _executors.clear()
+
+atexit.register(shutdown_executors)
+
+#
+# Shared memory transport
+#
+
+_SharedArray = namedtuple('_SharedArray', ['name', 'shape', 'dtype'])
+
+def _share_array(image, shared_memory):
+    # Zero-sized blocks are not allowed
+    block = shared_memory.SharedMemory(create=True, size=max(1, image.nbytes))
+    shared = _SharedArray(block.name, image.shape, image.dtype.str)
+    numpy.ndarray(image.shape, image.dtype, buffer=block.buf)[...] = image
+    return block, shared
+
+def _receive(result, shared_memory):
+    if not isinstance(result, _SharedArray):
+        return result
+    block = shared_memory.SharedMemory(name=result.name)
+    try:
+        return numpy.ndarray(
+            result.shape,
+            result.dtype,
+            buffer=block.buf,
+        ).copy()
+    finally:
+        block.close()
+        block.unlink()
+
+def _init_worker(threads):
+    # Parallelism comes from the pool; library threads only get a slot's
+    # share of the budget
+    limit_library_threads(threads)
+
+def _run_shared(operation, shared, args):
+    from multiprocessing import shared_memory
+
+    block = shared_memory.SharedMemory(name=shared.name)
+    try:
+        return _apply_shared(operation, block, shared, args, shared_memory)
+    finally:
+        block.close()
+
+def _apply_shared(operation, block, shared, args, shared_memory):
+    # Views of the block must be released before it can be closed, so
+    # they only live in this frame
+    image = numpy.ndarray(shared.shape, shared.dtype, buffer=block.buf)
+    image.flags.writeable = False
+    result = operation(image, *args)
+    if isinstance(result, numpy.ndarray):
+        result_block, result = _share_array(result, shared_memory)
+        result_block.close()
+    return result
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+"""
+Streams frames into an ffmpeg process to build animated exports.
+"""
+
+import subprocess
+
+from os import path
+
+class PctExportError(Exception):
+    pass
+
+class PctAnimationWriter:
+
+    def write(self, frame):
+        try:
+            self._process.stdin.write(frame.tobytes())
+        except (BrokenPipeError, OSError):
+            raise PctExportError(self._read_error())
+
+    def close(self):
+        try:
+            self._process.stdin.close()
+        except (BrokenPipeError, OSError):
+            pass
+        if self._process.wait() != 0:
+            raise PctExportError(self._read_error())
+        return True
+
+    def abort(self):
+        self._process.kill()
+        self._process.wait()
+
+    #
+    # Private
+    #
+
+    def __init__(self, filepath, width, height, fps, binary='ffmpeg'):
+        command = [
+            binary,
+            '-y',
+            '-loglevel', 'error',
+            '-f', 'rawvideo',
+            '-pix_fmt', 'bgr24',
+            '-s', '{}x{}'.format(width, height),
+            '-r', str(fps),
+            '-i', '-',
+        ]
+        command += self._get_output_arguments(filepath)
+        command.append(filepath)
+        try:
+            self._process = subprocess.Popen(
+                command,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+            )
+        except OSError:
+            raise PctExportError('{} could not be started'.format(binary))
+
+    def _get_output_arguments(self, filepath):
+        extension = path.splitext(filepath)[1].lower()
+        if extension == '.mp4':
+            return [
+                '-c:v', 'libx264',
+                '-pix_fmt', 'yuv420p',
+                '-movflags', '+faststart',
+            ]
+        if extension == '.gif':
+            # The default gif palette keeps ffmpeg streaming; palettegen
+            # would buffer every frame before writing
+            return []
+        raise PctExportError('Unsupported format {}'.format(extension))
+
+    def _read_error(self):
+        try:
+            self._process.stdin.close()
+        except (BrokenPipeError, OSError):
+            pass
+        self._process.wait()
+        error = self._process.stderr.read().decode('utf-8', 'replace')
+        return error.strip() or 'ffmpeg failed'
@@ -4,26 +4,172 @@ import math
 import numpy
 import cv2
 
+from collections import namedtuple
+from os import path
+
+from ..common.scheduler import (
+    get_scheduler,
+)
+from ..common.settings import (
+    get_setting,
+)
+from ..datamanagement.archives import (
+    is_archive_member,
+    split_member_filepath,
+    read_archive_member,
+    read_archive_members,
+)
 from ..common.configuration import (
-    PCT_BORDER_PIXELS,
+    PCT_HASH_SIZE,
+    PCT_THUMBNAIL_SIZE,
+)
+from .backends import (
+    get_image_backend,
 )
 
-def crop_image(image, left, right, top, bottom, buffer=0):
+def get_encoded_pixels(size):
+    # A rough pixel count for an encoded image of size bytes, enough to
+    # pick a size class before decoding
+    return size * 4
+
+def decode_image(buffer, flags=cv2.IMREAD_COLOR):
+    if flags == cv2.IMREAD_COLOR:
+        backend = get_image_backend('decode', get_encoded_pixels(len(buffer)))
+        return backend.decode(buffer)
+    return cv2.imdecode(numpy.frombuffer(buffer, numpy.uint8), flags)
+
+def read_image(filepath, flags=cv2.IMREAD_COLOR):
+    # Archive members are decoded from memory, never extracted to disk
+    if is_archive_member(filepath):
+        archive, member = split_member_filepath(filepath)
+        return decode_image(read_archive_member(archive, member), flags)
+    if flags == cv2.IMREAD_COLOR:
+        return read_color_image(filepath)
+    return cv2.imread(filepath, flags)
+
+def read_color_image(filepath):
+    try:
+        pixels = get_encoded_pixels(path.getsize(filepath))
+    except OSError:
+        return None
+    backend = get_image_backend('decode', pixels)
+    if backend.name == 'opencv':
+        return cv2.imread(filepath)
+    try:
+        with open(filepath, 'rb') as fp:
+            buffer = fp.read()
+    except OSError:
+        return None
+    return backend.decode(buffer)
+
+def read_images(filepaths, workers=None, flags=cv2.IMREAD_COLOR):
+    """
+    Decodes images in parallel, as decode jobs of the scheduler, and
+    returns them in the order given. Members of the same archive are read
+    together, with a single pass over tars.
+    """
+    if workers is None:
+        workers = get_scheduler().get_slots()
+
+    members = {}
+    for filepath in filepaths:
+        if is_archive_member(filepath):
+            archive, member = split_member_filepath(filepath)
+            members.setdefault(archive, []).append(member)
+    buffers = {}
+    for archive in members:
+        for member, buffer in read_archive_members(
+                archive, members[archive], workers).items():
+            buffers[archive, member] = buffer
+
+    def read(filepath):
+        if is_archive_member(filepath):
+            buffer = buffers.get(split_member_filepath(filepath))
+            return None if buffer is None else decode_image(buffer, flags)
+        if flags == cv2.IMREAD_COLOR:
+            return read_color_image(filepath)
+        return cv2.imread(filepath, flags)
+
+    return get_scheduler().map('decode', read, filepaths)
+
+PctPackedImage = namedtuple('PctPackedImage', ['bits', 'shape'])
+
+def is_near_grayscale(image, tolerance=None, outliers=None):
+    if image.ndim == 2:
+        return True
+    if tolerance is None:
+        tolerance = get_setting('PCT_GRAYSCALE_TOLERANCE')
+    if outliers is None:
+        outliers = get_setting('PCT_GRAYSCALE_OUTLIERS')
+    # A sparse sample is plenty to tell line art from a colored card
+    sample = image[::4, ::4].astype(numpy.int16)
+    spread = sample.max(axis=2) - sample.min(axis=2)
+    return numpy.count_nonzero(spread > tolerance) <= outliers * spread.size
+
+def compact_image(image):
+    """
+    Returns a single-channel copy of near-grayscale images when grayscale
+    storage is enabled, and the image itself otherwise.
+    """
+    if image is None or image.ndim == 2:
+        return image
+    if not get_setting('PCT_GRAYSCALE_CARDS') or not is_near_grayscale(image):
+        return image
+    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+def to_grayscale(image):
+    if image.ndim == 2:
+        return image
+    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+def to_color(image):
+    if image.ndim == 3:
+        return image
+    return cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+
+def pack_image(image):
+    # Binarizes single-channel images to one bit per pixel
+    _, binary = cv2.threshold(
+        image,
+        0,
+        255,
+        cv2.THRESH_BINARY + cv2.THRESH_OTSU,
+    )
+    return PctPackedImage(numpy.packbits(binary > 0), image.shape)
+
+def unpack_image(packed):
+    count = packed.shape[0] * packed.shape[1]
+    bits = numpy.unpackbits(packed.bits)[:count]
+    return (bits * 255).astype(numpy.uint8).reshape(packed.shape)
+
+def save_raw_image(filepath, image):
+    numpy.save(filepath, image, allow_pickle=False)
+
+def load_raw_image(filepath):
+    return numpy.load(filepath, allow_pickle=False)
+
+def crop_bounds(image, left, right, top, bottom, buffer=0):
     top = max(0, top-buffer)
     bottom = min(image.shape[0], bottom+buffer)
     left = max(0, left-buffer)
     right = min(image.shape[1], right+buffer)
+    return int(left), int(right), int(top), int(bottom)
+
+def crop_image(image, left, right, top, bottom, buffer=0):
+    left, right, top, bottom = crop_bounds(
+        image,
+        left,
+        right,
+        top,
+        bottom,
+        buffer,
+    )
     return image[top:bottom, left:right].copy()
 
 def resize_image(image, height, width):
-    current_height = image.shape[0]
-    current_width = image.shape[1]
-    
-    if (height * width) < (current_height * current_width):
-        interp = cv2.INTER_AREA
-    else:
-        interp = cv2.INTER_LINEAR
-    return cv2.resize(image, (width, height), interpolation=interp)
+    # Area averaging when shrinking, bilinear otherwise, in every backend
+    backend = get_image_backend('resize', image.shape[0] * image.shape[1])
+    return backend.resize(image, height, width)
 
 def resize_image_height(image, height):
     current_height = image.shape[0]
@@ -32,12 +178,7 @@ def resize_image_height(image, height):
     
     current_width = image.shape[1]
     width = (height * current_width) // current_height
-    
-    if height < current_height:
-        interp = cv2.INTER_AREA
-    else:
-        interp = cv2.INTER_LINEAR
-    return cv2.resize(image, (width, height), interpolation=interp)
+    return resize_image(image, height, width)
 
 def resize_image_width(image, width):
     current_width = image.shape[1]
@@ -46,51 +187,175 @@ def resize_image_width(image, width):
     
     current_height = image.shape[0]
     height = (width * current_height) // current_width
+    return resize_image(image, height, width)
+
+def resize_image_nearest(image, height, width):
+    # Only for quick proxies: fast at any scale, but aliased when shrinking
+    return cv2.resize(image, (width, height), interpolation=cv2.INTER_NEAREST)
+
+def fit_image_to_frame(image, height, width):
+    current_height = image.shape[0]
+    current_width = image.shape[1]
+    scale = min(height / current_height, width / current_width)
+    fitted_height = max(1, int(current_height * scale))
+    fitted_width = max(1, int(current_width * scale))
+    fitted = resize_image(image, fitted_height, fitted_width)
     
-    if width < current_width:
-        interp = cv2.INTER_AREA
-    else:
-        interp = cv2.INTER_LINEAR
-    return cv2.resize(image, (width, height), interpolation=interp)
+    top = (height - fitted_height) // 2
+    left = (width - fitted_width) // 2
+    frame = numpy.zeros((height, width, 3), dtype=image.dtype)
+    if fitted.ndim == 2:
+        fitted = fitted[:, :, None]
+    frame[top:top+fitted_height, left:left+fitted_width] = fitted
+    return frame
+
+def blend_images(image0, image1, alpha):
+    return cv2.addWeighted(image0, 1 - alpha, image1, alpha, 0)
 
 def rotate_image(image, angle):
-    rows, cols, _ = image.shape
-    M = cv2.getRotationMatrix2D((cols // 2, rows // 2), -angle, 1)
-    return cv2.warpAffine(image, M, (cols,rows))
+    # About the same center as get_rotation_matrix
+    backend = get_image_backend('rotate', image.shape[0] * image.shape[1])
+    return backend.rotate(image, angle)
+
+def get_rotation_matrix(image, angle):
+    # Positive angles turn the image clockwise
+    rows, cols = image.shape[:2]
+    return cv2.getRotationMatrix2D((cols // 2, rows // 2), -angle, 1)
+
+def estimate_skew(contours):
+    """
+    Returns the clockwise rotation, in degrees, that squares up the minimum
+    area rectangle around the contours.
+    """
+    points = numpy.concatenate(contours)
+    box = cv2.boxPoints(cv2.minAreaRect(points))
+    dx, dy = box[1] - box[0]
+    angle = math.degrees(math.atan2(dy, dx))
+    # The rectangle's edges are a quarter turn apart; the smallest
+    # correction is wanted whichever edge came first
+    while angle > 45:
+        angle -= 90
+    while angle <= -45:
+        angle += 90
+    return round(-angle, 2)
+
+def get_rectangularity(contours):
+    """
+    Returns how much of the minimum area rectangle around the contours
+    their convex hull fills: close to 1 for a card's outline, and lower
+    for scattered contents, whose rectangle's angle means little.
+    """
+    points = numpy.concatenate(contours)
+    width, height = cv2.minAreaRect(points)[1]
+    if width * height == 0:
+        return 0.0
+    return cv2.contourArea(cv2.convexHull(points)) / (width * height)
+
+def deskew_bounds(image, contours, angle, buffer=0):
+    """
+    Returns the crop bounds of the contours once image is rotated by angle.
+    """
+    points = numpy.concatenate(contours).reshape(1, -1, 2)
+    rotated = cv2.transform(
+        points.astype(numpy.float32),
+        get_rotation_matrix(image, angle),
+    )[0]
+    left, top = numpy.floor(rotated.min(axis=0))
+    right, bottom = numpy.ceil(rotated.max(axis=0))
+    return crop_bounds(image, left, right, top, bottom, buffer)
+
+def deskew_image(image, angle, left, right, top, bottom):
+    """
+    Rotates and crops image in a single warp; equivalent to rotate_image
+    followed by crop_image (up to rounding), without the intermediate
+    image.
+    """
+    M = get_rotation_matrix(image, angle)
+    M[0, 2] -= left
+    M[1, 2] -= top
+    return cv2.warpAffine(image, M, (right - left, bottom - top))
 
 def add_image_border(image, noleft=False):
+    border = get_setting('PCT_BORDER_PIXELS')
     if noleft:
         left_pixels = 0
     else:
-        left_pixels = PCT_BORDER_PIXELS
+        left_pixels = border
     return cv2.copyMakeBorder(
         image,
-        PCT_BORDER_PIXELS,
-        PCT_BORDER_PIXELS,
+        border,
+        border,
         left_pixels,
-        PCT_BORDER_PIXELS,
+        border,
         cv2.BORDER_CONSTANT,
     )
 
-def compose_images(images, height):
-    resized_images = [resize_image_height(img, height) for img in images]
-    
-    # Image borders are a little hacky
-    bordered_images = []
-    for index, img in enumerate(resized_images):
-        if index == 0:
-            bordered_images.append(add_image_border(img))
-        else:
-            bordered_images.append(add_image_border(img, True))
-            
-    return numpy.concatenate(bordered_images, axis=1)
+def write_image(filepath, image):
+    """
+    Writes image like cv2.imwrite, and returns the encoded bytes, or None
+    if the image couldn't be encoded or written.
+    """
+    backend = get_image_backend('encode', image.shape[0] * image.shape[1])
+    encoded = backend.encode(image, path.splitext(filepath)[1])
+    if encoded is None:
+        return None
+    try:
+        with open(filepath, 'wb') as fp:
+            fp.write(encoded)
+    except OSError:
+        return None
+    return encoded
+
+def encode_image(image, extension='.jpg', quality=None):
+    if quality is None:
+        quality = get_setting('PCT_JPEG_QUALITY')
+    backend = get_image_backend('encode', image.shape[0] * image.shape[1])
+    return backend.encode(image, extension, quality)
+
+def read_image_proxies(filepaths, workers=None):
+    # Lets the decoder skip most of the work for small grayscale proxies
+    return read_images(filepaths, workers, cv2.IMREAD_REDUCED_GRAYSCALE_8)
+
+def compute_dhash(image, hash_size=PCT_HASH_SIZE):
+    image = to_grayscale(image)
+    small = cv2.resize(
+        image,
+        (hash_size + 1, hash_size),
+        interpolation=cv2.INTER_AREA,
+    )
+    return numpy.packbits(small[:, 1:] > small[:, :-1]).tobytes().hex()
+
+def compute_thumbnail(image, size=PCT_THUMBNAIL_SIZE):
+    return cv2.resize(
+        to_grayscale(image),
+        (size, size),
+        interpolation=cv2.INTER_AREA,
+    )
+
+def correlate_thumbnails(thumbnail, other):
+    # Independent of brightness and contrast; 0 when either is flat
+    a = thumbnail.astype(numpy.float64) - thumbnail.mean()
+    b = other.astype(numpy.float64) - other.mean()
+    norm = math.sqrt((a * a).sum() * (b * b).sum())
+    if norm == 0:
+        return 0.0
+    return float((a * b).sum() / norm)
+
+def hamming_distances(hashes):
+    packed = numpy.array(
+        [bytearray.fromhex(h) for h in hashes],
+        dtype=numpy.uint8,
+    ).reshape(len(hashes), -1)
+    differing = packed[:, None, :] ^ packed[None, :, :]
+    return numpy.unpackbits(differing, axis=2).sum(axis=2)
 
 def find_dominant_contours(image, strength):
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    gray = to_grayscale(image)
+    pixels = gray.shape[0] * gray.shape[1]
     blur_str = 1 + 2 * strength
-    blurred = cv2.GaussianBlur(gray, (blur_str, blur_str), 0)
+    blurred = get_image_backend('blur', pixels).blur(gray, blur_str)
     edge_str = 250 // math.sqrt(strength)
-    edged = cv2.Canny(blurred, 0, edge_str)
+    edged = get_image_backend('edges', pixels).edges(blurred, 0, edge_str)
     _, contours, _ = cv2.findContours(
         edged,
         cv2.RETR_LIST,
@@ -99,7 +364,7 @@ def find_dominant_contours(image, strength):
     return contours
 
 def draw_contours(image, contours):
-    new_image = image.copy()
+    new_image = to_color(image).copy()
     cv2.drawContours(new_image, contours, -1, (0, 255, 0), 10)
     return new_image
 
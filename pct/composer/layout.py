@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+
+"""
+Layout of cards on the composition canvas.
+
+The geometry is computed from card sizes alone, before anything is
+rendered, so that each card is resized once, straight into its slot:
+
+- strip: a single row, scaled to the shortest card
+- rows:  the strip split into balanced rows, in card order
+- grid:  uniform cells, with each card centered in its cell
+
+Rows and grids use as few rows as fit under the maximum canvas width, or
+without one, under the maximum canvas aspect ratio (width over height).
+A layout can then be scaled to an output size, so that cards are resized
+straight to their final slots rather than through a full-size canvas.
+"""
+
+import math
+
+from collections import namedtuple
+
+import numpy
+
+from ..common.configuration import (
+    PCT_LAYOUT_MODES,
+)
+
+PctSlot = namedtuple('PctSlot', ['x', 'y', 'width', 'height'])
+PctLayout = namedtuple('PctLayout', ['width', 'height', 'slots'])
+
+class PctLayoutError(Exception):
+    pass
+
+def compute_layout(sizes, mode, border, max_width=0, max_aspect=0.0):
+    """
+    Returns the layout of cards of the given (height, width) sizes, in
+    order. Cards are scaled to the height of the shortest one and
+    separated by border pixels, as are the canvas edges.
+    """
+    if mode not in PCT_LAYOUT_MODES:
+        raise PctLayoutError('Unknown layout mode {}.'.format(mode))
+    if not sizes:
+        return None
+    height = min([s[0] for s in sizes])
+    widths = [max(1, (height * w) // h) for h, w in sizes]
+    if mode == 'grid':
+        return _grid_layout(widths, height, border, max_width, max_aspect)
+    if mode == 'rows':
+        return _rows_layout(widths, height, border, max_width, max_aspect)
+    return _place_rows([widths], height, border)
+
+def get_layout_scale(layout, height=0, width=0, megapixels=0):
+    """
+    Returns the factor that scales layout to the given output height, or
+    else width, or else down to at most the given megapixels. Sizes of 0
+    are ignored, and without any the layout keeps its size.
+    """
+    if height:
+        return height / layout.height
+    if width:
+        return width / layout.width
+    if megapixels:
+        return min(1.0, math.sqrt(
+            megapixels * 1000000 / (layout.width * layout.height)
+        ))
+    return 1.0
+
+def scale_layout(layout, scale):
+    # Slot edges are scaled and rounded, rather than slot sizes, so that
+    # scaled slots never overlap or leave the canvas
+    if scale == 1.0:
+        return layout
+    def edge(value):
+        return int(round(value * scale))
+    return PctLayout(
+        max(1, edge(layout.width)),
+        max(1, edge(layout.height)),
+        [
+            PctSlot(
+                edge(s.x),
+                edge(s.y),
+                max(1, edge(s.x + s.width) - edge(s.x)),
+                max(1, edge(s.y + s.height) - edge(s.y)),
+            )
+            for s in layout.slots
+        ],
+    )
+
+def get_layout_geometry(layout):
+    # What the canvas looks like, for recipes
+    return [layout.width, layout.height, [list(s) for s in layout.slots]]
+
+def render_layout(layout, tiles, dtype=numpy.uint8):
+    """
+    Copies tiles, sized like their slots, into a black canvas.
+    Single-channel tiles are promoted to color as they are copied.
+    """
+    canvas = numpy.zeros((layout.height, layout.width, 3), dtype=dtype)
+    for slot, tile in zip(layout.slots, tiles):
+        region = canvas[slot.y:slot.y+slot.height, slot.x:slot.x+slot.width]
+        if tile.ndim == 2:
+            region[...] = tile[:, :, None]
+        else:
+            region[...] = tile
+    return canvas
+
+def _fits(width, height, max_width, max_aspect):
+    if max_width:
+        return width <= max_width
+    if max_aspect:
+        return width <= height * max_aspect
+    return True
+
+def _row_width(widths, border):
+    return border + sum([w + border for w in widths])
+
+def _place_rows(rows, height, border):
+    slots = []
+    y = border
+    for row in rows:
+        x = border
+        for width in row:
+            slots.append(PctSlot(x, y, width, height))
+            x += width + border
+        y += height + border
+    return PctLayout(
+        max([_row_width(row, border) for row in rows]),
+        y,
+        slots,
+    )
+
+def _split_rows(widths, border, limit):
+    # Greedy split under a row width limit, or None if a card is too wide
+    rows = [[]]
+    for width in widths:
+        if border + width + border > limit:
+            return None
+        if rows[-1] and _row_width(rows[-1] + [width], border) > limit:
+            rows.append([])
+        rows[-1].append(width)
+    return rows
+
+def _balance_rows(widths, border, count):
+    """
+    Splits widths into at most count rows, in order, such that the widest
+    row is as narrow as possible.
+    """
+    low = max(widths) + 2 * border
+    high = _row_width(widths, border)
+    while low < high:
+        middle = (low + high) // 2
+        rows = _split_rows(widths, border, middle)
+        if rows is not None and len(rows) <= count:
+            high = middle
+        else:
+            low = middle + 1
+    return _split_rows(widths, border, low)
+
+def _rows_layout(widths, height, border, max_width, max_aspect):
+    layout = None
+    for count in range(1, len(widths) + 1):
+        layout = _place_rows(
+            _balance_rows(widths, border, count),
+            height,
+            border,
+        )
+        if _fits(layout.width, layout.height, max_width, max_aspect):
+            break
+    return layout
+
+def _grid_layout(widths, height, border, max_width, max_aspect):
+    # Most columns first, so the grid is only as tall as it has to be
+    cell = max(widths)
+    for columns in range(len(widths), 0, -1):
+        rows = -(-len(widths) // columns)
+        width = border + columns * (cell + border)
+        canvas_height = border + rows * (height + border)
+        if _fits(width, canvas_height, max_width, max_aspect):
+            break
+    slots = []
+    for index, card_width in enumerate(widths):
+        row, column = divmod(index, columns)
+        slots.append(PctSlot(
+            border + column * (cell + border) + (cell - card_width) // 2,
+            border + row * (height + border),
+            card_width,
+            height,
+        ))
+    return PctLayout(width, canvas_height, slots)
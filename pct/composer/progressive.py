@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+"""
+Progressive refresh of previews and compositions.
+
+A progressive refresh shows a quick nearest-neighbor proxy right away and
+returns refinements: a render, which only reads the images it was given
+and so runs as a scheduler job behind interactive work, and a commit,
+which stores and shows the result and so runs on the thread that owns the
+windows. Commits check that what they refine is still current, so
+cancelled or overtaken refinements are simply dropped.
+"""
+
+import threading
+
+from collections import namedtuple
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    wait,
+)
+
+from ..common.scheduler import (
+    get_scheduler,
+)
+
+PctRefinement = namedtuple('PctRefinement', ['render', 'commit'])
+
+class PctRefiner:
+
+    def submit(self, refinements):
+        with self._lock:
+            for refinement in refinements:
+                self._pending.append((
+                    refinement,
+                    get_scheduler().submit(
+                        'preview',
+                        refinement.render,
+                        priority='refine',
+                    ),
+                ))
+
+    def poll(self, timeout=0):
+        """
+        Commits the refinements that are done, in order, on the calling
+        thread, waiting at most timeout seconds for the next one. Returns
+        True once nothing is pending.
+        """
+        with self._lock:
+            pending = list(self._pending)
+        if not pending:
+            return True
+        wait([f for _, f in pending], timeout, FIRST_COMPLETED)
+        committed = 0
+        for refinement, future in pending:
+            if not future.done():
+                break
+            if not future.cancelled() and future.exception() is None:
+                refinement.commit(future.result())
+            committed += 1
+        with self._lock:
+            del self._pending[:committed]
+            return not self._pending
+
+    def cancel(self):
+        # A render that has already started runs to the end, but is never
+        # committed
+        with self._lock:
+            for _, future in self._pending:
+                future.cancel()
+            self._pending = []
+
+    def is_done(self):
+        with self._lock:
+            return not self._pending
+
+    def shutdown(self):
+        self.cancel()
+
+    #
+    # Private
+    #
+
+    def __init__(self):
+        self._pending = []
+        self._lock = threading.Lock()
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+"""
+Reading images straight out of zip and tar archives.
+
+Archive members are addressed as '<archive><separator><member>', e.g.
+'game.zip::cards/card1.jpg', so they can be used wherever a filepath is.
+"""
+
+import tarfile
+import zipfile
+
+from fnmatch import fnmatch
+from os import path
+
+from ..common.configuration import (
+    PCT_ARCHIVE_EXTENSIONS,
+    PCT_ARCHIVE_SEPARATOR,
+)
+from ..common.scheduler import (
+    get_scheduler,
+)
+
+def is_archive(filepath):
+    if not path.isfile(filepath):
+        return False
+    for extension in PCT_ARCHIVE_EXTENSIONS:
+        if fnmatch(filepath.lower(), '*.{}'.format(extension)):
+            return True
+    return False
+
+def is_archive_member(filepath):
+    return PCT_ARCHIVE_SEPARATOR in filepath
+
+def get_member_filepath(archive, member):
+    return archive + PCT_ARCHIVE_SEPARATOR + member
+
+def split_member_filepath(filepath):
+    archive, member = filepath.split(PCT_ARCHIVE_SEPARATOR, 1)
+    return archive, member
+
+def get_archive_stem(archive):
+    filename = path.basename(archive)
+    for extension in sorted(PCT_ARCHIVE_EXTENSIONS, key=len, reverse=True):
+        if filename.lower().endswith('.' + extension):
+            return filename[:-len(extension) - 1]
+    return filename
+
+def list_archive_members(archive):
+    if zipfile.is_zipfile(archive):
+        with zipfile.ZipFile(archive) as zf:
+            return [i.filename for i in zf.infolist() if not i.is_dir()]
+    with tarfile.open(archive) as tf:
+        return [m.name for m in tf.getmembers() if m.isfile()]
+
+def read_archive_member(archive, member):
+    if zipfile.is_zipfile(archive):
+        with zipfile.ZipFile(archive) as zf:
+            return zf.read(member)
+    with tarfile.open(archive) as tf:
+        return tf.extractfile(member).read()
+
+def read_archive_members(archive, members, workers=1):
+    """
+    Returns a dictionary mapping members to their bytes. Zip members are
+    read in parallel, each worker with its own handle; tar archives are
+    streamed once, since compressed tars can't be read at random.
+    """
+    if not zipfile.is_zipfile(archive):
+        wanted = set(members)
+        buffers = {}
+        with tarfile.open(archive, 'r|*') as tf:
+            for m in tf:
+                if m.name in wanted:
+                    buffers[m.name] = tf.extractfile(m).read()
+        return buffers
+
+    def read(chunk):
+        with zipfile.ZipFile(archive) as zf:
+            return [(member, zf.read(member)) for member in chunk]
+
+    workers = max(1, min(workers, len(members)))
+    chunks = [members[i::workers] for i in range(workers)]
+    buffers = {}
+    for chunk in get_scheduler().map('decode', read, chunks):
+        buffers.update(chunk)
+    return buffers
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+"""
+A small per-directory cache of values derived from input images.
+
+Entries are keyed by image name (the filename, or the full path of an
+archive member) and invalidated whenever the file's modification time or
+size changes.
+"""
+
+import json
+import os
+
+from .files import (
+    get_file_signature,
+    get_image_name,
+)
+
+class PctLoadCache:
+
+    def get(self, filepath, key):
+        entry = self._entries.get(get_image_name(filepath))
+        if entry is None:
+            return None
+        if entry.get('signature') != self._get_signature(filepath):
+            return None
+        return entry.get(key)
+
+    def set(self, filepath, key, value):
+        signature = self._get_signature(filepath)
+        if signature is None:
+            return False
+        name = get_image_name(filepath)
+        entry = self._entries.get(name)
+        if entry is None or entry.get('signature') != signature:
+            entry = {'signature': signature}
+            self._entries[name] = entry
+        entry[key] = value
+        self._dirty = True
+        return True
+
+    def save(self):
+        if not self._dirty:
+            return True
+        temp_filepath = self._filepath + '.tmp'
+        try:
+            with open(temp_filepath, 'w') as fp:
+                json.dump(self._entries, fp)
+            os.replace(temp_filepath, self._filepath)
+        except OSError:
+            return False
+        self._dirty = False
+        return True
+
+    #
+    # Private
+    #
+
+    def __init__(self, filepath):
+        self._filepath = filepath
+        self._entries = self._load()
+        self._dirty = False
+
+    def _load(self):
+        try:
+            with open(self._filepath) as fp:
+                entries = json.load(fp)
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(entries, dict):
+            return {}
+        return entries
+
+    def _get_signature(self, filepath):
+        try:
+            return get_file_signature(filepath)
+        except OSError:
+            return None
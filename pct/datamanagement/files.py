@@ -1,10 +1,15 @@
 # -*- coding: utf-8 -*-
 
+import tarfile
+import zipfile
+
 from fnmatch import fnmatch
 
 from os import (
     path,
     listdir,
+    makedirs,
+    stat,
 )
 
 from ..common.configuration import (
@@ -13,6 +18,20 @@ from ..common.configuration import (
     PCT_EDITED_IMAGE_PREFIX,
     PCT_COMPOSED_IMAGE_FILENAME,
     PCT_COMPOSED_METADATA_FILENAME,
+    PCT_ANIMATION_FILENAME,
+    PCT_LOAD_CACHE_FILENAME,
+    PCT_JOURNAL_FILENAME,
+)
+from ..common.settings import (
+    get_setting,
+)
+from .archives import (
+    is_archive,
+    is_archive_member,
+    get_member_filepath,
+    split_member_filepath,
+    get_archive_stem,
+    list_archive_members,
 )
 
 def is_pct(filename):
@@ -25,6 +44,8 @@ def is_image(filename):
     return False
 
 def get_input_image_filepaths(directory):
+    if is_archive(directory):
+        return get_archive_image_filepaths(directory)
     filepaths = []
     for f in listdir(directory):
         if is_image(f) and not is_pct(f):
@@ -33,14 +54,112 @@ def get_input_image_filepaths(directory):
                 filepaths.append(full_f)
     return filepaths
 
+def get_archive_image_filepaths(archive):
+    filepaths = []
+    for member in list_archive_members(archive):
+        f = member.rsplit('/', 1)[-1]
+        # Skips resource forks and other hidden files added by archivers
+        if f.startswith('.') or '__MACOSX/' in member:
+            continue
+        if is_image(f) and not is_pct(f):
+            filepaths.append(get_member_filepath(archive, member))
+    return filepaths
+
+def get_uncomposed_directories(parent):
+    """
+    Returns the directories and archives directly under parent that hold
+    input images but have no composed image yet, sorted by name.
+    """
+    directories = []
+    for f in sorted(listdir(parent)):
+        full_f = path.join(parent, f)
+        if f.startswith('.') or is_pct(f):
+            continue
+        if not path.isdir(full_f) and not is_archive(full_f):
+            continue
+        if is_composed(full_f):
+            continue
+        try:
+            filepaths = get_input_image_filepaths(full_f)
+        except (OSError, tarfile.TarError, zipfile.BadZipFile):
+            # Unreadable archives are left for load to report
+            continue
+        if filepaths:
+            directories.append(full_f)
+    return directories
+
+def is_composed(directory):
+    return path.isfile(path.join(
+        get_output_directory(directory, create=False),
+        PCT_COMPOSED_IMAGE_FILENAME,
+    ))
+
+def get_output_directory(directory, create=True):
+    """
+    Outputs for a directory go into it; outputs for an archive go into a
+    directory named after it, next to the archive or under the configured
+    archive output directory.
+    """
+    if not is_archive(directory):
+        return directory
+    parent = get_setting('PCT_ARCHIVE_OUTPUT_DIRECTORY')
+    if not parent:
+        parent = path.dirname(directory)
+    output_directory = path.join(parent, get_archive_stem(directory))
+    if create:
+        makedirs(output_directory, exist_ok=True)
+    return output_directory
+
 def get_output_image_filepath(directory):
-    return path.join(directory, PCT_COMPOSED_IMAGE_FILENAME)
+    return path.join(
+        get_output_directory(directory),
+        PCT_COMPOSED_IMAGE_FILENAME
+    )
 
 def get_output_metadata_filepath(directory):
-    return path.join(directory, PCT_COMPOSED_METADATA_FILENAME)
+    return path.join(
+        get_output_directory(directory),
+        PCT_COMPOSED_METADATA_FILENAME
+    )
+
+def get_output_animation_filepath(directory, extension):
+    return path.join(
+        get_output_directory(directory),
+        '{}.{}'.format(PCT_ANIMATION_FILENAME, extension)
+    )
+
+def get_load_cache_filepath(directory):
+    return path.join(get_output_directory(directory), PCT_LOAD_CACHE_FILENAME)
+
+def get_journal_filepath(directory):
+    return path.join(get_output_directory(directory), PCT_JOURNAL_FILENAME)
+
+def get_file_signature(filepath):
+    if is_archive_member(filepath):
+        filepath = split_member_filepath(filepath)[0]
+    status = stat(filepath)
+    return [status.st_mtime_ns, status.st_size]
+
+def get_image_name(filepath):
+    """
+    Names an image uniquely among the images of its directory or archive:
+    its filename, or the full path of an archive member, since members of
+    different folders of an archive can share a filename.
+    """
+    if is_archive_member(filepath):
+        return split_member_filepath(filepath)[1]
+    return path.basename(filepath)
 
 def get_edited_image_filepath(filepath):
-    directory, filename = path.split(filepath)
+    # Archive members are saved under their folders within the archive
+    if is_archive_member(filepath):
+        archive, member = split_member_filepath(filepath)
+        parts = [p for p in member.split('/') if p not in ('', '.', '..')]
+        directory = path.join(get_output_directory(archive), *parts[:-1])
+        makedirs(directory, exist_ok=True)
+        filename = parts[-1]
+    else:
+        directory, filename = path.split(filepath)
     return path.join(
         directory,
         PCT_EDITED_IMAGE_PREFIX + filename
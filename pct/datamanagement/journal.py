@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+"""
+A write-ahead journal of edits, one JSON entry per line.
+
+Every entry is flushed and synced before the call returns, so a crash
+loses at most the edit in progress. A torn final line is ignored when the
+journal is read back.
+"""
+
+import json
+import os
+
+class PctJournal:
+
+    def append(self, entry):
+        if self._fp is None:
+            self._fp = open(self._filepath, 'a')
+        self._fp.write(json.dumps(entry) + '\n')
+        self._fp.flush()
+        os.fsync(self._fp.fileno())
+        return True
+
+    def read(self):
+        entries = []
+        try:
+            with open(self._filepath) as fp:
+                for line in fp:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        break
+        except OSError:
+            return []
+        return entries
+
+    def reset(self, header):
+        # The new journal replaces the old one in a single step, so a crash
+        # leaves one or the other
+        self.close()
+        temporary = self._filepath + '.tmp'
+        with open(temporary, 'w') as fp:
+            fp.write(json.dumps(header) + '\n')
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(temporary, self._filepath)
+        return True
+
+    def clear(self):
+        self.close()
+        try:
+            os.remove(self._filepath)
+        except OSError:
+            pass
+        return True
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+        self._fp = None
+
+    #
+    # Private
+    #
+
+    def __init__(self, filepath):
+        self._filepath = filepath
+        self._fp = None
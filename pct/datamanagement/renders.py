@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+
+"""
+A content-addressed cache of rendered outputs.
+
+Renders are stored under the hash of the recipe that produced them: the
+source fingerprints, edit geometry, order and output parameters. Any
+process that arrives at the same recipe can reuse them. The cache is
+bounded in size, least recently used renders being removed first.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+from os import path
+
+from ..common.configuration import (
+    PCT_RENDER_VERSION,
+)
+from ..common.settings import (
+    get_setting,
+)
+
+MEGABYTE = 1024 * 1024
+
+_render_cache = None
+_render_cache_lock = threading.Lock()
+
+def get_recipe_key(recipe):
+    encoded = json.dumps(
+        [PCT_RENDER_VERSION, recipe],
+        sort_keys=True,
+        separators=(',', ':'),
+    )
+    return hashlib.sha1(encoded.encode('utf-8')).hexdigest()
+
+def get_render_cache():
+    """
+    Returns the shared render cache, or None if it is disabled.
+    """
+    global _render_cache
+    directory = get_setting('PCT_RENDER_CACHE_DIRECTORY')
+    if not directory:
+        return None
+    directory = path.expanduser(directory)
+    with _render_cache_lock:
+        if _render_cache is None or _render_cache.get_directory() != directory:
+            _render_cache = PctRenderCache(
+                directory,
+                get_setting('PCT_RENDER_CACHE_MB') * MEGABYTE,
+            )
+        return _render_cache
+
+class PctRenderCache:
+
+    def get_directory(self):
+        return self._directory
+
+    def get_filepath(self, key, extension):
+        return path.join(self._directory, key[:2], key + extension)
+
+    def has(self, key, extension):
+        return self._touch(self.get_filepath(key, extension))
+
+    def copy(self, key, extension, filepath):
+        source = self.get_filepath(key, extension)
+        if not self._touch(source):
+            return False
+        try:
+            shutil.copyfile(source, filepath)
+        except OSError:
+            return False
+        return True
+
+    def write(self, key, extension, data):
+        return self._write(
+            self.get_filepath(key, extension),
+            lambda fp: fp.write(data),
+        )
+
+    def read_array(self, key):
+        import numpy
+
+        filepath = self.get_filepath(key, '.npy')
+        if not self._touch(filepath):
+            return None
+        try:
+            return numpy.load(filepath, allow_pickle=False)
+        except (OSError, ValueError):
+            return None
+
+    def write_array(self, key, array):
+        import numpy
+
+        return self._write(
+            self.get_filepath(key, '.npy'),
+            lambda fp: numpy.save(fp, array, allow_pickle=False),
+        )
+
+    def prune(self):
+        entries = []
+        total = 0
+        for root, _, filenames in os.walk(self._directory):
+            for filename in filenames:
+                filepath = path.join(root, filename)
+                try:
+                    status = os.stat(filepath)
+                except OSError:
+                    continue
+                entries.append((status.st_mtime, status.st_size, filepath))
+                total += status.st_size
+        entries.sort()
+        removed = 0
+        for _, size, filepath in entries:
+            if total <= self._max_bytes:
+                break
+            try:
+                os.remove(filepath)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        return removed
+
+    #
+    # Private
+    #
+
+    def __init__(self, directory, max_bytes):
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self._written = None
+        self._lock = threading.Lock()
+
+    def _touch(self, filepath):
+        # Hits refresh the modification time, which pruning orders by
+        try:
+            os.utime(filepath)
+        except OSError:
+            return False
+        return True
+
+    def _write(self, filepath, writer):
+        # Written under a temporary name so other processes never see a
+        # partial render
+        directory = path.dirname(filepath)
+        try:
+            os.makedirs(directory, exist_ok=True)
+            handle, temp_filepath = tempfile.mkstemp(dir=directory)
+        except OSError:
+            return False
+        try:
+            with os.fdopen(handle, 'wb') as fp:
+                writer(fp)
+            os.replace(temp_filepath, filepath)
+        except OSError:
+            try:
+                os.remove(temp_filepath)
+            except OSError:
+                pass
+            return False
+        self._after_write(path.getsize(filepath))
+        return True
+
+    def _after_write(self, size):
+        # Hits never scan the cache; it is pruned on a process's first write,
+        # since short runs may never write enough, and then once enough is
+        with self._lock:
+            if self._written is not None:
+                self._written += size
+                if self._written * 16 < self._max_bytes:
+                    return
+            self._written = 0
+        self.prune()
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+"""
+Recorded interactor sessions, one JSON entry per line.
+
+Each entry holds a command line as it was entered and when, in seconds
+since recording started, so that real sessions can be replayed as
+benchmark workloads. A torn final line is ignored when a trace is read.
+"""
+
+import json
+
+from time import time
+
+class PctTraceRecorder:
+
+    def record(self, line, now=None):
+        if now is None:
+            now = self._clock()
+        self._fp.write(json.dumps({
+            'time': round(now - self._started, 3),
+            'line': line,
+        }) + '\n')
+        self._fp.flush()
+        return True
+
+    def get_filepath(self):
+        return self._filepath
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+        self._fp = None
+
+    #
+    # Private
+    #
+
+    def __init__(self, filepath, clock=time):
+        self._filepath = filepath
+        self._clock = clock
+        self._started = clock()
+        self._fp = open(filepath, 'w')
+
+def read_trace(filepath):
+    entries = []
+    with open(filepath) as fp:
+        for line in fp:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                break
+            entries.append(entry)
+    return entries
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+"""
+Polls a directory for added, changed and removed image files.
+
+Changes are debounced: they are only reported once the directory has
+looked the same for the debounce period, so a burst of writes (or a large
+file still being copied) produces a single update.
+"""
+
+from time import time
+
+from .files import (
+    get_input_image_filepaths,
+    get_file_signature,
+)
+
+class PctDirectoryChanges:
+
+    def get_added(self):
+        return self._added
+
+    def get_changed(self):
+        return self._changed
+
+    def get_removed(self):
+        return self._removed
+
+    def is_empty(self):
+        return not (self._added or self._changed or self._removed)
+
+    #
+    # Private
+    #
+
+    def __init__(self, added, changed, removed):
+        self._added = sorted(added)
+        self._changed = sorted(changed)
+        self._removed = sorted(removed)
+
+class PctDirectoryWatcher:
+
+    def poll(self, now=None):
+        """
+        Returns the changes since the last report once they have settled,
+        and None otherwise.
+        """
+        if now is None:
+            now = self._clock()
+        snapshot = self._scan()
+        if snapshot != self._observed:
+            self._observed = snapshot
+            self._observed_at = now
+            return None
+        if snapshot == self._known:
+            return None
+        if now - self._observed_at < self._debounce:
+            return None
+
+        known = self._known
+        self._known = snapshot
+        return PctDirectoryChanges(
+            [f for f in snapshot if f not in known],
+            [f for f in snapshot if f in known and known[f] != snapshot[f]],
+            [f for f in known if f not in snapshot],
+        )
+
+    def get_directory(self):
+        return self._directory
+
+    #
+    # Private
+    #
+
+    def __init__(self, directory, debounce, signatures=None, clock=time):
+        # Known signatures, by file, that differ from the files' current
+        # ones are reported as changes; None if it was never signed
+        self._directory = directory
+        self._debounce = debounce
+        self._clock = clock
+        if signatures is None:
+            self._known = self._scan()
+        else:
+            self._known = dict(signatures)
+        self._observed = self._known
+        self._observed_at = clock()
+
+    def _scan(self):
+        try:
+            filepaths = get_input_image_filepaths(self._directory)
+        except OSError:
+            filepaths = []
+        return self._sign(filepaths)
+
+    def _sign(self, filepaths):
+        # Files that vanish mid-scan are simply left out
+        snapshot = {}
+        for filepath in filepaths:
+            try:
+                snapshot[filepath] = get_file_signature(filepath)
+            except OSError:
+                pass
+        return snapshot
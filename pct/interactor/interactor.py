@@ -1,36 +1,67 @@
 # -*- coding: utf-8 -*-
 
 import cmd
+import select
+import shlex
+import threading
 import traceback
 
 from sys import stdout
 from os import path
+from time import (
+    sleep,
+    time,
+)
 
 from ..common.configuration import (
-    PCT_DEFAULT_DEBUG,
-    
-    PCT_PREVIEW_START_X,
-    PCT_PREVIEW_START_Y,
-    PCT_PREVIEW_MARGIN,
-    PCT_PREVIEW_WIDTH,
-    
-    PCT_DEFAULT_AUTOMAGIC,
-    PCT_DEFAULT_ROTATION,
-    PCT_DEFAULT_FIT,
-    
-    PCT_COMPOSITION_START_X,
-    PCT_COMPOSITION_START_Y,
-    PCT_COMPOSITION_WIDTH,
+    PCT_DUPLICATE_POLICIES,
+    PCT_LAYOUT_MODES,
+    PCT_EXPORT_FORMATS,
+    PCT_DEFAULT_EXPORT_FORMAT,
+    PCT_SCHEDULER_PRIORITIES,
+)
+from ..common.scheduler import (
+    get_scheduler,
+)
+from ..common.settings import (
+    get_setting,
 )
 from ..datamanagement.files import (
+    get_file_signature,
     get_input_image_filepaths,
+    get_uncomposed_directories,
     get_output_image_filepath,
     get_output_metadata_filepath,
+    get_output_animation_filepath,
+    get_load_cache_filepath,
+    get_image_name,
+)
+from ..datamanagement.archives import (
+    is_archive,
+)
+from ..datamanagement.cache import (
+    PctLoadCache,
 )
-from ..composer.composer import (
-    PctComposer,
+from ..datamanagement.traces import (
+    PctTraceRecorder,
+)
+from ..datamanagement.watcher import (
+    PctDirectoryWatcher,
+)
+from ..composer.progressive import (
+    PctRefiner,
+)
+from .sessions import (
+    PctSessionManager,
+)
+from .workqueue import (
+    PctPreparedDirectory,
+    PctWorkQueue,
 )
 
+# The composer package pulls in OpenCV and NumPy, which dominate startup
+# time, so it is only imported by the commands that need it.
+
 class AnsiColors:
     HEADER = '\033[95m'
     OKBLUE = '\033[94m'
@@ -51,18 +82,43 @@ class PctInteractorWriter:
             self._prefix,
             string.replace('\n', '\n' + self._prefix)
         )
-        stdout.write(self._color_string(output))
-        stdout.write('\n')
+        self._stream.write(self._color_string(output))
+        self._stream.write('\n')
         
-    def __init__(self, prefix='', color=None):
+    def __init__(self, prefix='', color=None, stream=None):
         self._prefix = prefix
         self._color = color
+        self._stream = stream or stdout
     
     def _color_string(self, string):
         if self._color is None:
             return string
         return self._color + string + AnsiColors.ENDC
 
+class PctDeferredWriter:
+
+    def write(self, string):
+        with self._lock:
+            if self._held:
+                self._buffer.append(string)
+                return
+        self._writer.write(string)
+
+    def release(self):
+        # Writes what was held, and passes everything through from then on
+        with self._lock:
+            buffered = self._buffer
+            self._buffer = []
+            self._held = False
+        for string in buffered:
+            self._writer.write(string)
+
+    def __init__(self, writer):
+        self._writer = writer
+        self._buffer = []
+        self._held = True
+        self._lock = threading.Lock()
+
 class PctInteractorError(Exception):
     pass
 
@@ -75,7 +131,17 @@ class PctInteractor(cmd.Cmd):
     def precmd(self, line):
         if not line:
             return ''
-        return line.strip()
+        line = line.strip()
+        if self._recorder is not None and line \
+                and line.split()[0] != 'record':
+            self._recorder.record(line)
+        return line
+    
+    def postcmd(self, stop, line):
+        # Refinements run until they are done or the next command arrives
+        if not stop:
+            self._refine()
+        return stop
     
     def preloop(self):
         self._output_response('Welcome to the Pictionary Telephone composer.')
@@ -115,20 +181,56 @@ class PctInteractor(cmd.Cmd):
         except Exception:
             self._output_response(traceback.format_exc(), True)
 
+    def do_calibrate(self, line):
+        """
+        calibrate
+        Benchmarks this host and writes a tuned settings profile.
+        """
+        try:
+            from ..benchmarks.calibrate import calibrate_and_save
+            
+            self._output_response('Calibrating...')
+            filepath, report = calibrate_and_save()
+            self._output_response('\n'.join(report))
+            self._output_response('Wrote {}'.format(filepath))
+        except PctInteractorError as err:
+            self._output_response(str(err), True)
+        except Exception:
+            self._output_response(traceback.format_exc(), True)
+    
+    def do_close(self, line):
+        """
+        close [session]
+        Closes a session, or the current one if none is given.
+        """
+        try:
+            name = line or self._get_session_name()
+            if name is None or not self._close_session(name):
+                self._output_response('{}: Unknown session'.format(line))
+                return
+            self._output_response('Closed {}'.format(name))
+        except PctInteractorError as err:
+            self._output_response(str(err), True)
+        except Exception:
+            self._output_response(traceback.format_exc(), True)
+    
     def do_c(self, line):
         return self.do_compose(line)
     
     def do_compose(self, line):
         """
-        compose
-        Composes the images into a single image.
+        compose [height|width|megapixels VALUE]
+        Composes the images into a single image, optionally scaled to an
+        output height or width, or to at most a number of megapixels.
         """
         try:
             self._output_response('Composing images...')
             self._validate_composer()
+            size = self._parse_output_size(line)
             self._refresh_images()
-            self._compose_images()
+            self._compose_images(size)
             self._refresh_composition()
+            self._enforce_memory_budget()
         except PctInteractorError as err:
             self._output_response(str(err), True)
         except Exception:
@@ -151,6 +253,67 @@ class PctInteractor(cmd.Cmd):
         except Exception:
             self._output_response(traceback.format_exc(), True)
     
+    def do_discard(self, line):
+        """
+        discard
+        Discards the edit journal of the current session and reloads its
+        directory from the original images.
+        """
+        try:
+            self._validate_composer()
+            directory = self._loaded_directory
+            session = self._sessions.get_active()
+            self._close_session(session.get_name())
+            session.get_journal().clear()
+            self._output_response('Discarded edits for {}'.format(directory))
+            self.do_load(directory)
+        except PctInteractorError as err:
+            self._output_response(str(err), True)
+        except Exception:
+            self._output_response(traceback.format_exc(), True)
+    
+    def do_duplicates(self, line):
+        """
+        duplicates [off|warn|skip]
+        Sets how near-duplicate images are handled when a directory is
+        loaded. Without an argument, reports the current policy.
+        """
+        try:
+            if not line:
+                self._output_response(
+                    'Duplicate policy: {}'.format(self._duplicate_policy)
+                )
+                return
+            if line not in PCT_DUPLICATE_POLICIES:
+                self._output_response(
+                    '{}: Invalid duplicate policy'.format(line)
+                )
+                return
+            self._duplicate_policy = line
+            self._output_response('Duplicate policy: {}'.format(line))
+        except PctInteractorError as err:
+            self._output_response(str(err), True)
+        except Exception:
+            self._output_response(traceback.format_exc(), True)
+    
+    def do_export(self, line):
+        """
+        export [gif|mp4]
+        Exports an animation that plays the images one after another.
+        """
+        try:
+            self._validate_composer()
+            extension = line or PCT_DEFAULT_EXPORT_FORMAT
+            if extension not in PCT_EXPORT_FORMATS:
+                self._output_response('{}: Invalid export format'.format(line))
+                return
+            self._output_response('Exporting animation...')
+            self._export(extension)
+        except PctInteractorError as err:
+            self._output_response(str(err), True)
+        except Exception:
+            self._output_response(traceback.format_exc(), True)
+    
     def do_f(self, line):
         """
         f
@@ -167,7 +330,7 @@ class PctInteractor(cmd.Cmd):
             self._output_response('Fitting image...')
             self._validate_composer()
             if not line:
-                strength = PCT_DEFAULT_FIT
+                strength = get_setting('PCT_DEFAULT_FIT')
             else:
                 strength = int(line)
             if self._fit(strength):
@@ -223,23 +386,60 @@ class PctInteractor(cmd.Cmd):
         """
         return self.do_load(line)
     
+    def do_layout(self, line):
+        """
+        layout [strip|rows|grid]
+        Sets how cards are laid out when they are composed. Without an
+        argument, reports the current layout.
+        """
+        try:
+            if not line:
+                self._output_response(
+                    'Layout: {}'.format(self._layout_mode)
+                )
+                return
+            if line not in PCT_LAYOUT_MODES:
+                self._output_response('{}: Invalid layout'.format(line))
+                return
+            self._layout_mode = line
+            self._output_response('Layout: {}'.format(line))
+            if self._composer is not None:
+                self.do_compose('')
+        except PctInteractorError as err:
+            self._output_response(str(err), True)
+        except Exception:
+            self._output_response(traceback.format_exc(), True)
+    
     def do_load(self, line):
         """
         load
-        Loads a directory for processing.
+        Loads a directory or archive for processing in a new session. If it
+        is already open, switches to its session instead.
         """
         try:
+            session = self._sessions.find(line)
+            if session is not None:
+                self._output_response(
+                    'Switching to open session {}'.format(session.get_name())
+                )
+                self._switch_session(session.get_name())
+                return
+            
             self._output_response('Loading ' + line)
             try:
                 filepaths = get_input_image_filepaths(line)
-                self._set_loaded_directory(line)
             except FileNotFoundError:
                 self._output_response('Directory does not exist.')
                 return
             
-            self._init_composer(sorted(filepaths))
+            filepaths = self._filter_duplicates(line, sorted(filepaths))
+            recovered = self._init_composer(line, filepaths)
+            if recovered:
+                self._output_response(
+                    'Recovered {} journaled edits.'.format(recovered)
+                )
             self.do_compose('')
-            if self._automagic:
+            if self._automagic and not recovered:
                 self.do_magic('')
                 
         except PctInteractorError as err:
@@ -263,7 +463,7 @@ class PctInteractor(cmd.Cmd):
             self._output_response('Performing magic...')
             self._validate_composer()
             if not line:
-                strength = PCT_DEFAULT_FIT
+                strength = get_setting('PCT_DEFAULT_FIT')
             else:
                 strength = int(line)
             if self._magic(strength):
@@ -273,6 +473,38 @@ class PctInteractor(cmd.Cmd):
         except Exception:
             self._output_response(traceback.format_exc(), True)
             
+    def do_next(self, line):
+        """
+        next
+        Switches to the next directory in the queue. It opens at once when
+        it has finished loading in the background.
+        """
+        try:
+            self._next_directory()
+        except PctInteractorError as err:
+            self._output_response(str(err), True)
+        except Exception:
+            self._output_response(traceback.format_exc(), True)
+
+    def do_progressive(self, line):
+        """
+        progressive
+        Toggles progressive refresh. If on, previews and the composition
+        are shown as quick proxies first and refined in the background,
+        until the next command is entered.
+        """
+        try:
+            if self._progressive:
+                self._progressive = False
+                self._output_response('Progressive refresh disabled.')
+                return
+            self._progressive = True
+            self._output_response('Progressive refresh enabled.')
+        except PctInteractorError as err:
+            self._output_response(str(err), True)
+        except Exception:
+            self._output_response(traceback.format_exc(), True)
+    
     def do_q(self, line):
         """
         q
@@ -280,6 +512,21 @@ class PctInteractor(cmd.Cmd):
         """
         return self.do_quit(line)
     
+    def do_queue(self, line):
+        """
+        queue [DIRECTORY ...|scan PARENT|off]
+        Queues directories or archives to work through in order, or with
+        scan, those under PARENT that haven't been composed yet. While one
+        is edited, the next is loaded, decoded and fitted in the
+        background. Without arguments, shows the queue.
+        """
+        try:
+            self._set_queue(line)
+        except PctInteractorError as err:
+            self._output_response(str(err), True)
+        except Exception:
+            self._output_response(traceback.format_exc(), True)
+
     def do_quit(self, line):
         """
         quit
@@ -288,6 +535,33 @@ class PctInteractor(cmd.Cmd):
         self._quit()
         return True
     
+    def do_record(self, line):
+        """
+        record [FILE|off]
+        Records the commands entered from now on, with their timings, to a
+        trace file that can be replayed with pct.benchmarks.replay. Without
+        an argument, reports where commands are being recorded.
+        """
+        try:
+            if not line:
+                if self._recorder is None:
+                    self._output_response('Not recording.')
+                else:
+                    self._output_response('Recording to {}'.format(
+                        self._recorder.get_filepath()
+                    ))
+                return
+            self._stop_recording()
+            if line == 'off':
+                self._output_response('Stopped recording.')
+                return
+            self._start_recording(path.expanduser(line))
+            self._output_response('Recording to {}'.format(line))
+        except PctInteractorError as err:
+            self._output_response(str(err), True)
+        except Exception:
+            self._output_response(traceback.format_exc(), True)
+    
     def do_uu(self, line):
         """
         uu
@@ -326,7 +600,7 @@ class PctInteractor(cmd.Cmd):
             self._output_response('Rotating image...')
             self._validate_composer()
             if not line:
-                angle = PCT_DEFAULT_ROTATION
+                angle = get_setting('PCT_DEFAULT_ROTATION')
             else:
                 angle = int(line)
             if self._rotate(angle):
@@ -336,6 +610,43 @@ class PctInteractor(cmd.Cmd):
         except Exception:
             self._output_response(traceback.format_exc(), True)
 
+    def do_sessions(self, line):
+        """
+        sessions
+        Lists the open sessions.
+        """
+        try:
+            self._list_sessions()
+        except PctInteractorError as err:
+            self._output_response(str(err), True)
+        except Exception:
+            self._output_response(traceback.format_exc(), True)
+
+    def do_stats(self, line):
+        """
+        stats
+        Shows the CPU budget, queued jobs and how busy the workers are.
+        """
+        try:
+            self._report_stats()
+        except PctInteractorError as err:
+            self._output_response(str(err), True)
+        except Exception:
+            self._output_response(traceback.format_exc(), True)
+    
+    def do_switch(self, line):
+        """
+        switch <session>
+        Switches to another open session without reloading it.
+        """
+        try:
+            if not self._switch_session(line):
+                self._output_response('{}: Unknown session'.format(line))
+        except PctInteractorError as err:
+            self._output_response(str(err), True)
+        except Exception:
+            self._output_response(traceback.format_exc(), True)
+    
     def do_s(self, line):
         """
         s
@@ -345,13 +656,14 @@ class PctInteractor(cmd.Cmd):
     
     def do_save(self, line):
         """
-        save
-        Saves currently composed images.
+        save [height|width|megapixels VALUE]
+        Saves currently composed images, optionally composing them again
+        at an output height or width, or at most a number of megapixels.
         """
         try:
             self._output_response('Saving images and metadata...')
             self._validate_composer()
-            self._save()
+            self._save(self._parse_output_size(line))
         except PctInteractorError as err:
             self._output_response(str(err), True)
         except Exception:
@@ -378,18 +690,51 @@ class PctInteractor(cmd.Cmd):
             self._output_response(str(err), True)
         except Exception:
             self._output_response(traceback.format_exc(), True)
+    
+    def do_watch(self, line):
+        """
+        watch [seconds]
+        Watches the loaded directory and updates the composition as images
+        are added, changed or removed. Runs until interrupted with Ctrl-C,
+        or for the given number of seconds.
+        """
+        try:
+            self._validate_composer()
+            duration = float(line) if line else None
+            self._output_response(
+                'Watching {} (Ctrl-C to stop)...'.format(
+                    self._loaded_directory
+                )
+            )
+            self._watch(duration)
+            self._output_response('Stopped watching.')
+        except PctInteractorError as err:
+            self._output_response(str(err), True)
+        except Exception:
+            self._output_response(traceback.format_exc(), True)
 
     #
     # Private
     #
 
-    def __init__(self):
-        super(PctInteractor, self).__init__()
+    def __init__(self, stdout=None, headless=False):
+        super(PctInteractor, self).__init__(stdout=stdout)
         
-        self._debug = PCT_DEFAULT_DEBUG
-        self._automagic = PCT_DEFAULT_AUTOMAGIC
+        self._debug = get_setting('PCT_DEFAULT_DEBUG')
+        self._automagic = get_setting('PCT_DEFAULT_AUTOMAGIC')
+        self._duplicate_policy = get_setting('PCT_DEFAULT_DUPLICATE_POLICY')
+        self._layout_mode = get_setting('PCT_LAYOUT_MODE')
+        self._progressive = get_setting('PCT_PROGRESSIVE_PREVIEWS')
         
-        self._init_writers('    ')
+        self._init_writers('    ', stdout)
+        self._sessions = PctSessionManager(
+            self._message_writer,
+            self._debug_writer,
+            headless=headless,
+        )
+        self._recorder = None
+        self._refiner = PctRefiner()
+        self._queue = None
         self._output_spacer = '    '
         self.doc_header = """Documented commands (type help <topic>):"""
         self._loaded_directory = None
@@ -398,9 +743,13 @@ class PctInteractor(cmd.Cmd):
         
         self._composer = None
     
-    def _init_writers(self, spacer):
-        self._message_writer = PctInteractorWriter(spacer)
-        self._debug_writer = PctInteractorWriter(spacer, AnsiColors.OKGREEN)
+    def _init_writers(self, spacer, stream=None):
+        self._message_writer = PctInteractorWriter(spacer, None, stream)
+        self._debug_writer = PctInteractorWriter(
+            spacer,
+            AnsiColors.OKGREEN,
+            stream,
+        )
     
     def _report_state(self):
         if self._debug:
@@ -411,6 +760,8 @@ class PctInteractor(cmd.Cmd):
             self._output_response('Automagic enabled.')
         else:
             self._output_response('Automagic disabled.')
+        if self._progressive:
+            self._output_response('Progressive refresh enabled.')
 
     def _output_debug(self, msg):
         if self._debug and msg:
@@ -426,21 +777,150 @@ class PctInteractor(cmd.Cmd):
         else:
             self._message_writer.write(response)
    
-    def _init_composer(self, filepaths):
-        self._destroy_composer()
-        self._working_image = None
-        self._composer = PctComposer(
+    def _filter_duplicates(self, directory, filepaths, writer=None):
+        from ..composer.duplicates import filter_duplicate_images
+        
+        if writer is None:
+            writer = self._message_writer
+        if self._duplicate_policy == 'off':
+            return filepaths
+        
+        cache = PctLoadCache(get_load_cache_filepath(directory))
+        filepaths, duplicates = filter_duplicate_images(
             filepaths,
-            self._message_writer,
-            self._debug_writer,
+            self._duplicate_policy,
+            get_setting('PCT_DUPLICATE_THRESHOLD'),
+            cache,
+            get_setting('PCT_DUPLICATE_CORRELATION'),
         )
-        self._composer.prepare(self._debug)
+        cache.save()
+        for duplicate in sorted(duplicates):
+            message = '{} looks like a duplicate of {}'.format(
+                get_image_name(duplicate),
+                get_image_name(duplicates[duplicate]),
+            )
+            if self._duplicate_policy == 'skip':
+                message += ' (skipped)'
+            writer.write(message)
+        return filepaths
+    
+    def _init_composer(self, directory, filepaths):
+        session = self._sessions.open(directory, filepaths, self._debug)
+        self._activate_session(session.get_name())
+        return session.get_recovered()
     
     def _destroy_composer(self):
-        if self._composer is not None:
-            self._composer.cleanup(self._debug)
+        self._sessions.close_all(self._debug)
         self._composer = None
         self._working_image = None
+        self._set_loaded_directory(None)
+    
+    def _get_session_name(self):
+        session = self._sessions.get_active()
+        if session is None:
+            return None
+        return session.get_name()
+    
+    def _activate_session(self, name):
+        current = self._sessions.get_active()
+        if current is not None:
+            current.set_working_image(self._working_image)
+            if current.get_name() != name:
+                self._sessions.deactivate(self._debug)
+        
+        session = self._sessions.activate(name, self._debug)
+        if session is None:
+            self._composer = None
+            self._working_image = None
+            self._set_loaded_directory(None)
+            return False
+        
+        self._composer = session.get_composer()
+        self._working_image = session.get_working_image()
+        self._set_loaded_directory(session.get_directory())
+        return True
+    
+    def _switch_session(self, name):
+        if self._sessions.get(name) is None:
+            return False
+        if not self._activate_session(name):
+            return False
+        self._output_response('Switched to {}'.format(name))
+        self.do_compose('')
+        return True
+    
+    def _close_session(self, name):
+        active = self._get_session_name()
+        if not self._sessions.close(name, self._debug):
+            return False
+        if name != active:
+            return True
+        
+        # The most recently used remaining session takes over
+        remaining = sorted(
+            self._sessions.list(),
+            key=lambda s: s.get_last_used(),
+        )
+        self._composer = None
+        self._working_image = None
+        self._set_loaded_directory(None)
+        if remaining:
+            self._switch_session(remaining[-1].get_name())
+        return True
+    
+    def _enforce_memory_budget(self):
+        for session in self._sessions.enforce_budget(self._debug):
+            self._output_response('Evicted {}'.format(session.get_name()))
+    
+    def _list_sessions(self):
+        sessions = self._sessions.list()
+        if not sessions:
+            self._output_response('No open sessions.')
+            return
+        active = self._sessions.get_active()
+        for session in sessions:
+            if session is active:
+                state = 'active'
+            elif session.is_loaded():
+                state = 'loaded'
+            else:
+                state = 'evicted'
+            self._output_response('{} {}: {} images, {}, {:.1f} MB'.format(
+                '*' if session is active else ' ',
+                session.get_name(),
+                len(session.get_image_files()),
+                state,
+                self._sessions.get_session_nbytes(session) / (1024 * 1024),
+            ))
+        self._output_response('Total: {:.1f} MB'.format(
+            self._sessions.get_nbytes() / (1024 * 1024)
+        ))
+
+    def _report_stats(self):
+        stats = get_scheduler().get_stats()
+        self._output_response(
+            'CPU budget {}: {} slots of {} threads, {} running, '
+            '{:.0%} utilized'.format(
+                stats['budget'],
+                stats['slots'],
+                stats['threads_per_job'],
+                stats['running'],
+                stats['utilization'],
+            )
+        )
+        self._output_response('Queued: {}'.format(', '.join(
+            '{} {}'.format(name, stats['queued'][name])
+            for name in PCT_SCHEDULER_PRIORITIES
+        )))
+        for kind, job in sorted(stats['jobs'].items()):
+            self._output_response(
+                '{:<8} {:>6} jobs {:8.2f} s running {:8.2f} s queued'.format(
+                    kind,
+                    job['count'],
+                    job['seconds'],
+                    job['waited'],
+                )
+            )
         
     def _validate_composer(self):
         if self._composer is None:
@@ -450,19 +930,21 @@ class PctInteractor(cmd.Cmd):
         if self._loaded_directory is None:
             self.prompt = '> '
             return
-        self.prompt = path.split(self._loaded_directory)[1]
+        self.prompt = self._get_session_name() or \
+            path.split(self._loaded_directory)[1]
         if self._working_image is not None:
             self.prompt += ': image {}'.format(self._working_image)
         self.prompt += '> '
 
     def _refresh_images(self):
-        self._composer.refresh_previews(
-            PCT_PREVIEW_WIDTH,
-            PCT_PREVIEW_START_X,
-            PCT_PREVIEW_START_Y,
-            PCT_PREVIEW_MARGIN,
+        self._refiner.submit(self._composer.refresh_previews(
+            get_setting('PCT_PREVIEW_WIDTH'),
+            get_setting('PCT_PREVIEW_START_X'),
+            get_setting('PCT_PREVIEW_START_Y'),
+            get_setting('PCT_PREVIEW_MARGIN'),
             self._debug,
-        )
+            self._progressive,
+        ))
     
     def _set_loaded_directory(self, directory):
         self._loaded_directory = directory
@@ -493,16 +975,52 @@ class PctInteractor(cmd.Cmd):
         
         return self._composer.reindex_image(index0, index1)
     
-    def _compose_images(self):
-        return self._composer.compose(self._debug)
+    def _parse_output_size(self, line):
+        tokens = line.split()
+        if not tokens:
+            return {}
+        try:
+            if len(tokens) != 2 \
+                    or tokens[0] not in ('height', 'width', 'megapixels'):
+                raise ValueError()
+            value = float(tokens[1])
+            if value <= 0:
+                raise ValueError()
+        except ValueError:
+            raise PctInteractorError('{}: Invalid output size'.format(line))
+        if tokens[0] != 'megapixels':
+            value = int(value)
+        return {tokens[0]: value}
+    
+    def _compose_images(self, size={}):
+        self._composer.set_layout_mode(self._layout_mode)
+        return self._composer.compose(self._debug, **size)
     
     def _refresh_composition(self):
-        self._composer.refresh_composition(
-            PCT_COMPOSITION_WIDTH,
-            PCT_COMPOSITION_START_X,
-            PCT_COMPOSITION_START_Y,
+        self._refiner.submit(self._composer.refresh_composition(
+            get_setting('PCT_COMPOSITION_WIDTH'),
+            get_setting('PCT_COMPOSITION_START_X'),
+            get_setting('PCT_COMPOSITION_START_Y'),
             self._debug,
-        )
+            self._progressive,
+        ))
+    
+    def _refine(self):
+        poll = get_setting('PCT_REFINE_POLL_SECONDS')
+        while not self._refiner.is_done():
+            if self._input_pending():
+                self._refiner.cancel()
+                return False
+            self._refiner.poll(poll)
+        return True
+    
+    def _input_pending(self):
+        # Streams that can't be polled, e.g. consoles on Windows, never
+        # interrupt refinement
+        try:
+            return bool(select.select([self.stdin], [], [], 0)[0])
+        except (OSError, ValueError, TypeError):
+            return False
     
     def _fit(self, strength):
         if self._working_image is None:
@@ -519,13 +1037,70 @@ class PctInteractor(cmd.Cmd):
             return False
         return self._composer.rotate(self._working_image, angle, self._debug)
         
-    def _save(self):
+    def _save(self, size={}):
         self._composer.save(
             get_output_image_filepath(self._loaded_directory),
             get_output_metadata_filepath(self._loaded_directory),
             self._debug,
+            **size
         )
      
+    def _export(self, extension):
+        filepath = get_output_animation_filepath(
+            self._loaded_directory,
+            extension,
+        )
+        if self._composer.export(filepath, debug=self._debug):
+            self._output_response('Exported {}'.format(filepath))
+            return True
+        return False
+     
+    def _watch(self, duration=None):
+        if is_archive(self._loaded_directory):
+            raise PctInteractorError('Only directories can be watched.')
+        # Starts from the cards as they were loaded, so that cards added,
+        # changed or removed since are picked up
+        watcher = PctDirectoryWatcher(
+            self._loaded_directory,
+            get_setting('PCT_WATCH_DEBOUNCE'),
+            signatures=self._composer.get_signatures(),
+        )
+        deadline = None if duration is None else time() + duration
+        try:
+            while deadline is None or time() < deadline:
+                changes = watcher.poll()
+                if changes is not None and not changes.is_empty():
+                    self._apply_changes(changes)
+                sleep(get_setting('PCT_WATCH_INTERVAL'))
+        except KeyboardInterrupt:
+            pass
+    
+    def _apply_changes(self, changes):
+        for label, filepaths in (
+                ('Added', changes.get_added()),
+                ('Changed', changes.get_changed()),
+                ('Removed', changes.get_removed())):
+            for filepath in filepaths:
+                self._output_response(
+                    '{} {}'.format(label, path.basename(filepath))
+                )
+        
+        strength = None
+        if self._automagic:
+            strength = get_setting('PCT_DEFAULT_FIT')
+        self._composer.update_images(
+            changes.get_added(),
+            changes.get_changed(),
+            changes.get_removed(),
+            strength,
+            self._debug,
+        )
+        if self._working_image is not None and \
+                not self._composer.check_index(self._working_image):
+            self._working_image = None
+            self._set_prompt()
+        self.do_compose('')
+    
     def _undo(self):
         if self._working_image is None:
             self._output_response('No working image to undo.')
@@ -538,7 +1113,177 @@ class PctInteractor(cmd.Cmd):
             return False
         return self._composer.redo(self._working_image, self._debug)
     
+    def _start_recording(self, filepath):
+        try:
+            self._recorder = PctTraceRecorder(filepath)
+        except OSError as err:
+            raise PctInteractorError('Unable to record: {}'.format(err))
+        # Replays start from the directory that is loaded now
+        if self._loaded_directory is not None:
+            self._recorder.record('load ' + self._loaded_directory)
+    
+    def _stop_recording(self):
+        if self._recorder is not None:
+            self._recorder.close()
+            self._recorder = None
+    
+    def _set_queue(self, line):
+        arguments = shlex.split(line)
+        if not arguments:
+            self._report_queue()
+            return
+        if arguments == ['off']:
+            self._stop_queue()
+            self._output_response('Queue cleared.')
+            return
+        if arguments[0] == 'scan':
+            if len(arguments) != 2:
+                raise PctInteractorError('Usage: queue scan PARENT')
+            try:
+                directories = get_uncomposed_directories(arguments[1])
+            except FileNotFoundError:
+                raise PctInteractorError('Directory does not exist.')
+        else:
+            directories = arguments
+        if not directories:
+            self._output_response('Nothing to queue.')
+            return
+        
+        self._stop_queue()
+        self._queue = PctWorkQueue(directories, self._discard_prepared)
+        self._output_response(
+            'Queued {} directories. Type next to start.'.format(
+                len(directories)
+            )
+        )
+        self._prepare_next()
+    
+    def _report_queue(self):
+        if self._queue is None:
+            self._output_response('No queue.')
+            return
+        position = self._queue.get_position()
+        for index, directory in enumerate(self._queue.get_directories()):
+            if index < position:
+                state = 'done'
+            elif index == position:
+                state = 'current'
+            else:
+                state = self._queue.get_state(directory) or 'waiting'
+            self._output_response('{} {}: {}'.format(
+                '*' if index == position else ' ',
+                directory,
+                state,
+            ))
+    
+    def _stop_queue(self):
+        if self._queue is not None:
+            self._queue.shutdown()
+        self._queue = None
+    
+    def _prepare_next(self):
+        directory = self._queue.peek()
+        if directory is None or self._sessions.find(directory) is not None:
+            return
+        self._queue.prepare(directory, self._prepare_directory)
+    
+    def _prepare_directory(self, directory):
+        # Runs in the background, headless and without its journal (which is
+        # attached when it is opened), so messages are held until next
+        writers = (
+            PctDeferredWriter(self._message_writer),
+            PctDeferredWriter(self._debug_writer),
+        )
+        filepaths = sorted(get_input_image_filepaths(directory))
+        signatures = [get_file_signature(f) for f in filepaths]
+        session = self._sessions.prepare(
+            directory,
+            self._filter_duplicates(directory, filepaths, writers[0]),
+            self._debug,
+            *writers,
+            detached=True
+        )
+        fitted = False
+        if self._automagic:
+            fitted = session.get_composer().fit_all(
+                get_setting('PCT_DEFAULT_FIT'),
+                self._debug,
+            )
+        return PctPreparedDirectory(
+            session,
+            filepaths,
+            signatures,
+            fitted,
+            writers,
+        )
+    
+    def _is_prepared_current(self, directory, prepared):
+        # Cards may have been added or changed since it was prepared
+        try:
+            filepaths = sorted(get_input_image_filepaths(directory))
+            signatures = [get_file_signature(f) for f in filepaths]
+        except OSError:
+            return False
+        return filepaths == prepared.filepaths \
+            and signatures == prepared.signatures
+    
+    def _discard_prepared(self, prepared):
+        prepared.session.cleanup(self._debug)
+    
+    def _next_directory(self):
+        if self._queue is None:
+            raise PctInteractorError('No queue. Queue directories first.')
+        directory, future = self._queue.advance()
+        if directory is None:
+            self._stop_queue()
+            self._output_response('The queue is done.')
+            return
+        
+        prepared = None
+        if future is not None:
+            if not future.done():
+                self._output_response('Waiting for {} to load...'.format(
+                    directory
+                ))
+            try:
+                prepared = future.result()
+            except FileNotFoundError:
+                pass
+            except Exception:
+                self._output_response(traceback.format_exc(), True)
+        if prepared is not None and (
+                self._sessions.find(directory) is not None
+                or not self._is_prepared_current(directory, prepared)):
+            self._discard_prepared(prepared)
+            prepared = None
+        
+        if prepared is None:
+            self.do_load(directory)
+        else:
+            self._open_prepared(directory, prepared)
+        remaining = self._queue.get_remaining()
+        self._output_response('{} left in the queue.'.format(remaining))
+        self._prepare_next()
+    
+    def _open_prepared(self, directory, prepared):
+        self._output_response('Loading ' + directory)
+        for writer in prepared.writers:
+            writer.release()
+        session = self._sessions.add(prepared.session, self._debug)
+        self._activate_session(session.get_name())
+        recovered = session.get_recovered()
+        if recovered:
+            self._output_response(
+                'Recovered {} journaled edits.'.format(recovered)
+            )
+        self.do_compose('')
+        if self._automagic and not recovered and not prepared.fitted:
+            self.do_magic('')
+    
     def _quit(self):
+        self._stop_queue()
+        self._refiner.shutdown()
+        self._stop_recording()
         self._destroy_composer()
         
 if __name__ == '__main__':
@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+
+"""
+Named composer sessions for the interactor.
+
+Sessions share one decoded image cache and one memory budget. When the
+budget is exceeded, inactive sessions are evicted in least-recently-used
+order: the current state of each card is spilled to disk and the composer
+is released. Evicted sessions are restored from the spill on demand, at
+the cost of their undo history.
+"""
+
+import shutil
+import tempfile
+import threading
+
+from os import (
+    path,
+    remove,
+)
+from time import time
+
+from ..common.settings import (
+    get_setting,
+)
+from ..datamanagement.files import (
+    get_file_signature,
+    get_journal_filepath,
+)
+from ..datamanagement.journal import (
+    PctJournal,
+)
+
+MEGABYTE = 1024 * 1024
+
+class PctSession:
+
+    def get_name(self):
+        return self._name
+
+    def set_name(self, name):
+        self._name = name
+
+    def get_directory(self):
+        return self._directory
+
+    def get_composer(self):
+        return self._composer
+
+    def get_image_files(self):
+        if self._composer is not None:
+            return self._composer.get_image_files()
+        return list(self._image_files)
+
+    def get_journal(self):
+        return self._journal
+
+    def get_recovered(self):
+        return self._recovered
+
+    def is_attached(self):
+        return self._journal is not None
+
+    def attach(self, journal, debug=False):
+        self._journal = journal
+        self._recovered = self._composer.attach(journal, self._headless, debug)
+        return self._recovered
+
+    def get_working_image(self):
+        return self._working_image
+
+    def set_working_image(self, index):
+        self._working_image = index
+
+    def get_last_used(self):
+        return self._last_used
+
+    def is_loaded(self):
+        return self._composer is not None
+
+    def touch(self):
+        self._last_used = time()
+
+    def evict(self, spill_files, debug=False):
+        self._composer.spill(spill_files, debug)
+        self._composer.cleanup(debug)
+        self._image_files = self._composer.get_image_files()
+        self._spill_files = spill_files
+        self._spill_operations = self._composer.get_journal_operations()
+        self._spill_signatures = self._composer.get_signatures()
+        self._composer = None
+
+    def restore(self, composer):
+        self._composer = composer
+        self._remove_spill()
+
+    def get_spill_files(self):
+        return self._spill_files
+
+    def get_spill_operations(self):
+        return self._spill_operations
+
+    def get_spill_signatures(self):
+        return self._spill_signatures
+
+    def cleanup(self, debug=False):
+        if self._composer is not None:
+            self._composer.cleanup(debug)
+        self._remove_spill()
+
+    #
+    # Private
+    #
+
+    def __init__(self, name, directory, composer, journal, recovered=0,
+                 headless=False):
+        self._name = name
+        self._directory = directory
+        self._composer = composer
+        self._journal = journal
+        self._recovered = recovered
+        self._headless = headless
+        self._image_files = composer.get_image_files()
+        self._working_image = None
+        self._spill_files = None
+        self._spill_operations = None
+        self._spill_signatures = None
+        self._last_used = time()
+
+    def _remove_spill(self):
+        if self._spill_files is None:
+            return
+        for filepath in self._spill_files.values():
+            try:
+                remove(filepath)
+            except OSError:
+                pass
+        self._spill_files = None
+        self._spill_operations = None
+        self._spill_signatures = None
+
+class PctSessionManager:
+
+    def open(self, directory, filepaths, debug=False):
+        return self.add(self.prepare(directory, filepaths, debug), debug)
+
+    def prepare(self, directory, filepaths, debug=False, message_writer=None,
+                debug_writer=None, detached=False):
+        """
+        Decodes and prepares a session for directory without opening it.
+        Detached sessions are prepared headless and without their journal,
+        so that they can be prepared on another thread; they are attached
+        when opened with add, on the thread that shows them.
+        """
+        from ..composer.composer import PctComposer
+
+        journal = None
+        if not detached:
+            journal = PctJournal(get_journal_filepath(directory))
+        self._get_image_cache().prefetch(filepaths)
+        composer = PctComposer(
+            filepaths,
+            message_writer or self._message_writer,
+            debug_writer or self._debug_writer,
+            headless=self._headless or detached,
+            image_loader=self._get_image_cache().load,
+            journal=journal,
+        )
+        composer.prepare(debug)
+        recovered = composer.recover(debug)
+        return PctSession(
+            None,
+            directory,
+            composer,
+            journal,
+            recovered,
+            self._headless,
+        )
+
+    def add(self, session, debug=False):
+        if not session.is_attached():
+            session.attach(
+                PctJournal(get_journal_filepath(session.get_directory())),
+                debug,
+            )
+        session.set_name(self._unique_name(session.get_directory()))
+        self._sessions[session.get_name()] = session
+        return session
+
+    def find(self, directory):
+        directory = path.abspath(directory)
+        for session in self._sessions.values():
+            if path.abspath(session.get_directory()) == directory:
+                return session
+        return None
+
+    def get(self, name):
+        return self._sessions.get(name)
+
+    def get_active(self):
+        return self._active
+
+    def list(self):
+        return list(self._sessions.values())
+
+    def activate(self, name, debug=False):
+        session = self._sessions.get(name)
+        if session is None:
+            return None
+        if not session.is_loaded():
+            self._restore(session, debug)
+        session.touch()
+        self._active = session
+        self.enforce_budget(debug)
+        return session
+
+    def deactivate(self, debug=False):
+        # Inactive sessions keep their images but release their windows
+        if self._active is not None and self._active.is_loaded():
+            self._active.get_composer().cleanup(debug)
+        self._active = None
+
+    def close(self, name, debug=False):
+        session = self._sessions.pop(name, None)
+        if session is None:
+            return False
+        if session is self._active:
+            self._active = None
+        session.cleanup(debug)
+        return True
+
+    def close_all(self, debug=False):
+        for name in list(self._sessions.keys()):
+            self.close(name, debug)
+        if self._image_cache is not None:
+            self._image_cache.clear()
+        if self._spill_directory is not None:
+            shutil.rmtree(self._spill_directory, ignore_errors=True)
+            self._spill_directory = None
+
+    def get_session_nbytes(self, session):
+        if not session.is_loaded():
+            return 0
+        return self._count_nbytes(session.get_composer().get_arrays())
+
+    def get_nbytes(self):
+        arrays = []
+        for session in self._sessions.values():
+            if session.is_loaded():
+                arrays.extend(session.get_composer().get_arrays())
+        if self._image_cache is not None:
+            arrays.extend(self._image_cache.get_arrays())
+        return self._count_nbytes(arrays)
+
+    def enforce_budget(self, debug=False):
+        evicted = []
+        candidates = sorted(
+            [
+                s for s in self._sessions.values()
+                if s.is_loaded() and s is not self._active
+            ],
+            key=lambda s: s.get_last_used(),
+        )
+        for session in candidates:
+            if self.get_nbytes() <= self._budget:
+                break
+            self._evict(session, debug)
+            evicted.append(session)
+        return evicted
+
+    #
+    # Private
+    #
+
+    def __init__(self, message_writer=None, debug_writer=None,
+                 budget_mb=None, cache_mb=None, headless=False):
+        if budget_mb is None:
+            budget_mb = get_setting('PCT_SESSION_MEMORY_BUDGET_MB')
+        if cache_mb is None:
+            cache_mb = get_setting('PCT_DECODE_CACHE_MB')
+        self._message_writer = message_writer
+        self._debug_writer = debug_writer
+        self._headless = headless
+        self._budget = budget_mb * MEGABYTE
+        self._cache_bytes = cache_mb * MEGABYTE
+        self._sessions = {}
+        self._active = None
+        self._image_cache = None
+        self._spill_directory = None
+        self._lock = threading.Lock()
+
+    def _get_image_cache(self):
+        # Created on first use so that OpenCV is only imported when needed;
+        # sessions may be prepared on another thread
+        with self._lock:
+            if self._image_cache is None:
+                from ..composer.cache import PctImageCache
+                self._image_cache = PctImageCache(self._cache_bytes)
+            return self._image_cache
+
+    def _get_spill_directory(self):
+        if self._spill_directory is None:
+            self._spill_directory = tempfile.mkdtemp(prefix='pct-sessions-')
+        return self._spill_directory
+
+    def _unique_name(self, directory):
+        base = path.basename(path.normpath(directory)) or directory
+        name = base
+        suffix = 2
+        while name in self._sessions:
+            name = '{}-{}'.format(base, suffix)
+            suffix += 1
+        return name
+
+    def _count_nbytes(self, arrays):
+        # Arrays shared between sessions and the cache are counted once
+        unique = {id(a): a.nbytes for a in arrays}
+        return sum(unique.values())
+
+    def _evict(self, session, debug=False):
+        spill_files = {}
+        for index, filepath in enumerate(session.get_image_files()):
+            spill_files[filepath] = path.join(
+                self._get_spill_directory(),
+                '{}-{}.npy'.format(id(session), index),
+            )
+        session.evict(spill_files, debug)
+
+    def _restore(self, session, debug=False):
+        from ..composer.composer import PctComposer
+        from ..composer.imageprocessing import load_raw_image
+
+        spill_files = session.get_spill_files()
+        composer = PctComposer(
+            session.get_image_files(),
+            self._message_writer,
+            self._debug_writer,
+            headless=self._headless,
+            image_loader=lambda f: load_raw_image(spill_files[f]),
+            journal=session.get_journal(),
+            image_fingerprint=lambda f: [
+                spill_files[f],
+                get_file_signature(spill_files[f]),
+            ],
+            image_operations=session.get_spill_operations(),
+            image_signatures=session.get_spill_signatures(),
+        )
+        composer.prepare(debug)
+        # The spill is removed once restored, so images the watcher reloads
+        # come from their files
+        composer.set_image_source(self._get_image_cache().load)
+        session.restore(composer)
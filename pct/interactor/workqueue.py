@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+"""
+A queue of directories for the interactor to work through in order.
+
+While the current directory is being edited, the next one is prepared in
+the background: listed, decoded and fitted, with its image work queued
+behind interactive jobs (see pct.common.scheduler). Preparations that are
+never used are handed to a discard callback once they finish.
+"""
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from ..common.scheduler import (
+    prioritized,
+)
+
+# A session prepared for a directory, with the listing and file signatures
+# it was prepared from, whether it was fitted, and the writers holding its
+# messages
+PctPreparedDirectory = namedtuple(
+    'PctPreparedDirectory',
+    ['session', 'filepaths', 'signatures', 'fitted', 'writers'],
+)
+
+class PctWorkQueue:
+
+    def get_directories(self):
+        return list(self._directories)
+
+    def get_position(self):
+        # -1 until the first directory is taken
+        return self._position
+
+    def get_remaining(self):
+        return len(self._directories) - self._position - 1
+
+    def peek(self):
+        index = self._position + 1
+        if index < len(self._directories):
+            return self._directories[index]
+        return None
+
+    def get_state(self, directory):
+        if self._preparing is None or self._preparing[0] != directory:
+            return None
+        future = self._preparing[1]
+        if not future.done():
+            return 'loading'
+        if future.exception() is not None:
+            return 'failed'
+        return 'ready'
+
+    def prepare(self, directory, prepare):
+        """
+        Runs prepare(directory) in the background, at background priority,
+        unless it is already being prepared.
+        """
+        if self._preparing is not None and self._preparing[0] == directory:
+            return
+        self._discard_preparing()
+        self._preparing = (
+            directory,
+            self._get_pool().submit(_run_in_background, prepare, directory),
+        )
+
+    def advance(self):
+        """
+        Moves on to the next directory, and returns it with the future of
+        its preparation, or None if it wasn't prepared.
+        """
+        directory = self.peek()
+        if directory is None:
+            return None, None
+        self._position += 1
+        future = None
+        if self._preparing is not None and self._preparing[0] == directory:
+            future = self._preparing[1]
+            self._preparing = None
+        return directory, future
+
+    def shutdown(self):
+        self._discard_preparing()
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
+
+    #
+    # Private
+    #
+
+    def __init__(self, directories, discard=None):
+        self._directories = list(directories)
+        self._position = -1
+        self._discard = discard
+        self._preparing = None
+        self._pool = None
+
+    def _get_pool(self):
+        # One directory at a time; its image work is spread by the scheduler
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=1)
+        return self._pool
+
+    def _discard_preparing(self):
+        if self._preparing is None:
+            return
+        future = self._preparing[1]
+        self._preparing = None
+        if not future.cancel():
+            future.add_done_callback(self._discard_result)
+
+    def _discard_result(self, future):
+        if self._discard is not None and future.exception() is None:
+            self._discard(future.result())
+
+def _run_in_background(function, *args):
+    with prioritized('background'):
+        return function(*args)
@@ -0,0 +1,725 @@
+# -*- coding: utf-8 -*-
+
+"""
+A small HTTP service exposing PctComposer sessions to a web form.
+
+The service logic (PctService) is independent of sockets, so it can be
+exercised offline by calling dispatch() directly. The HTTP layer runs
+requests on a bounded worker pool.
+"""
+
+import json
+import sys
+import threading
+import traceback
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from http.server import (
+    BaseHTTPRequestHandler,
+    HTTPServer,
+)
+from os import path
+from time import time
+from urllib.parse import (
+    urlparse,
+    parse_qs,
+)
+from uuid import uuid4
+
+from ..common.configuration import (
+    PCT_DUPLICATE_POLICIES,
+    PCT_EXPORT_FORMATS,
+    PCT_LAYOUT_MODES,
+    PCT_DEFAULT_EXPORT_FORMAT,
+)
+from ..common.scheduler import (
+    get_scheduler,
+)
+from ..common.settings import (
+    get_setting,
+)
+from ..datamanagement.files import (
+    get_input_image_filepaths,
+    get_output_image_filepath,
+    get_output_metadata_filepath,
+    get_output_animation_filepath,
+    get_load_cache_filepath,
+    get_journal_filepath,
+    get_image_name,
+)
+from ..datamanagement.cache import (
+    PctLoadCache,
+)
+from ..datamanagement.journal import (
+    PctJournal,
+)
+from ..composer.composer import (
+    PctComposer,
+)
+from ..composer.duplicates import (
+    filter_duplicate_images,
+)
+from ..composer.imageprocessing import (
+    read_images,
+)
+
+class PctServiceWriter:
+
+    def write(self, string):
+        if not string:
+            return
+        with self._lock:
+            self._lines.append(string)
+
+    def flush(self):
+        with self._lock:
+            lines = self._lines
+            self._lines = []
+        return lines
+
+    #
+    # Private
+    #
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._lines = []
+
+class PctServiceResponse:
+
+    def get_status(self):
+        return self._status
+
+    def get_headers(self):
+        return self._headers
+
+    def get_body(self):
+        return self._body
+
+    #
+    # Private
+    #
+
+    def __init__(self, status, body=b'', headers=None):
+        self._status = status
+        self._body = body
+        self._headers = headers if headers is not None else {}
+
+class PctServiceError(Exception):
+
+    def get_status(self):
+        return self._status
+
+    #
+    # Private
+    #
+
+    def __init__(self, status, message):
+        super(PctServiceError, self).__init__(message)
+        self._status = status
+
+class PctServiceSession:
+
+    def get_id(self):
+        return self._id
+
+    def get_directory(self):
+        return self._directory
+
+    def get_composer(self):
+        return self._composer
+
+    def get_lock(self):
+        return self._lock
+
+    @contextmanager
+    def locked(self):
+        # Sessions can be closed or evicted between being looked up and
+        # being locked, so they are checked again once they are locked
+        with self._lock:
+            if self._closed:
+                raise PctServiceError(404, 'Unknown session.')
+            yield self
+
+    def get_messages(self):
+        return self._writer.flush()
+
+    def touch(self):
+        self._last_used = time()
+
+    def idle_time(self):
+        return time() - self._last_used
+
+    def cleanup(self):
+        self._closed = True
+        self._composer.cleanup()
+
+    #
+    # Private
+    #
+
+    def __init__(self, directory, composer, writer):
+        self._id = uuid4().hex
+        self._directory = directory
+        self._composer = composer
+        self._writer = writer
+        self._lock = threading.Lock()
+        self._last_used = time()
+        self._closed = False
+
+class PctServiceSessions:
+
+    def create(self, directory, automagic, strength, duplicates):
+        # A directory has one edit journal, so it is open in one session
+        # at a time
+        key = path.abspath(directory)
+        with self._lock:
+            if key in self._directories:
+                raise PctServiceError(
+                    409,
+                    'Directory is already open in another session.',
+                )
+            self._directories.add(key)
+        try:
+            session = self._create(directory, automagic, strength, duplicates)
+        except Exception:
+            with self._lock:
+                self._directories.discard(key)
+            raise
+        with self._lock:
+            self._sessions[session.get_id()] = session
+        self._evict_excess()
+        return session
+
+    def get(self, session_id):
+        with self._lock:
+            session = self._sessions.get(session_id)
+        if session is None:
+            raise PctServiceError(404, 'Unknown session.')
+        session.touch()
+        return session
+
+    def list(self):
+        with self._lock:
+            return list(self._sessions.values())
+
+    def close(self, session_id):
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+        if session is None:
+            raise PctServiceError(404, 'Unknown session.')
+        with session.get_lock():
+            self._cleanup(session)
+        return True
+
+    def close_all(self):
+        with self._lock:
+            sessions = list(self._sessions.values())
+            self._sessions = {}
+        for session in sessions:
+            with session.get_lock():
+                self._cleanup(session)
+
+    def evict_idle(self):
+        expired = [
+            s for s in self.list() if s.idle_time() > self._timeout
+        ]
+        return len([s for s in expired if self._evict(s)])
+
+    #
+    # Private
+    #
+
+    def __init__(self, max_sessions, timeout):
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._directories = set()
+        self._max_sessions = max_sessions
+        self._timeout = timeout
+
+    def _create(self, directory, automagic, strength, duplicates):
+        try:
+            filepaths = get_input_image_filepaths(directory)
+        except FileNotFoundError:
+            raise PctServiceError(404, 'Directory does not exist.')
+        if not filepaths:
+            raise PctServiceError(400, 'Directory contains no images.')
+
+        writer = PctServiceWriter()
+        filepaths = self._filter_duplicates(
+            directory,
+            sorted(filepaths),
+            duplicates,
+            writer,
+        )
+        images = dict(zip(filepaths, read_images(filepaths)))
+        composer = PctComposer(
+            filepaths,
+            writer,
+            None,
+            True,
+            image_loader=images.get,
+            journal=PctJournal(get_journal_filepath(directory)),
+        )
+        composer.prepare()
+        recovered = composer.recover()
+        if recovered:
+            writer.write('Recovered {} journaled edits.'.format(recovered))
+        elif automagic:
+            composer.fit_all(strength)
+        composer.compose()
+
+        return PctServiceSession(directory, composer, writer)
+
+    def _filter_duplicates(self, directory, filepaths, policy, writer):
+        if policy not in PCT_DUPLICATE_POLICIES:
+            raise PctServiceError(400, 'Invalid duplicate policy.')
+        if policy == 'off':
+            return filepaths
+        cache = PctLoadCache(get_load_cache_filepath(directory))
+        filepaths, duplicates = filter_duplicate_images(
+            filepaths,
+            policy,
+            get_setting('PCT_DUPLICATE_THRESHOLD'),
+            cache,
+            get_setting('PCT_DUPLICATE_CORRELATION'),
+        )
+        cache.save()
+        for duplicate in sorted(duplicates):
+            writer.write('{} looks like a duplicate of {}'.format(
+                get_image_name(duplicate),
+                get_image_name(duplicates[duplicate]),
+            ))
+        return filepaths
+
+    def _cleanup(self, session):
+        session.cleanup()
+        with self._lock:
+            self._directories.discard(path.abspath(session.get_directory()))
+
+    def _evict(self, session):
+        # Sessions that are busy are left alone until their next check
+        lock = session.get_lock()
+        if not lock.acquire(blocking=False):
+            return False
+        try:
+            with self._lock:
+                if self._sessions.pop(session.get_id(), None) is None:
+                    return False
+            self._cleanup(session)
+            return True
+        finally:
+            lock.release()
+
+    def _evict_excess(self):
+        sessions = sorted(self.list(), key=lambda s: -s.idle_time())
+        excess = len(sessions) - self._max_sessions
+        for session in sessions:
+            if excess <= 0:
+                break
+            if self._evict(session):
+                excess -= 1
+
+class PctService:
+
+    def dispatch(self, method, url, headers=None, body=b''):
+        headers = headers if headers is not None else {}
+        try:
+            self._sessions.evict_idle()
+            parsed = urlparse(url)
+            parts = [p for p in parsed.path.split('/') if p]
+            query = {k: v[-1] for k, v in parse_qs(parsed.query).items()}
+            return self._route(method, parts, query, headers, body)
+        except PctServiceError as err:
+            return self._json_response({'error': str(err)}, err.get_status())
+        except Exception:
+            # Details stay in the server's log
+            sys.stderr.write('{} {}\n{}'.format(
+                method,
+                url,
+                traceback.format_exc(),
+            ))
+            return self._json_response(
+                {'error': 'Internal server error.'},
+                500,
+            )
+
+    def evict_idle(self):
+        return self._sessions.evict_idle()
+
+    def shutdown(self):
+        self._sessions.close_all()
+
+    #
+    # Private
+    #
+
+    def __init__(self, max_sessions=None, timeout=None):
+        if max_sessions is None:
+            max_sessions = get_setting('PCT_SERVER_MAX_SESSIONS')
+        if timeout is None:
+            timeout = get_setting('PCT_SERVER_SESSION_TIMEOUT')
+        self._sessions = PctServiceSessions(max_sessions, timeout)
+        self._actions = {
+            'fit': self._fit,
+            'magic': self._magic,
+            'rotate': self._rotate,
+            'reindex': self._reindex,
+            'undo': self._undo,
+            'redo': self._redo,
+            'compose': self._compose,
+            'save': self._save,
+            'export': self._export,
+        }
+
+    def _route(self, method, parts, query, headers, body):
+        if parts == ['stats']:
+            if method != 'GET':
+                raise PctServiceError(405, 'Method not allowed.')
+            return self._json_response(get_scheduler().get_stats())
+
+        if not parts or parts[0] != 'sessions':
+            raise PctServiceError(404, 'Not found.')
+
+        if len(parts) == 1:
+            if method == 'GET':
+                return self._json_response({
+                    'sessions': [
+                        self._describe(s) for s in self._sessions.list()
+                    ],
+                })
+            if method == 'POST':
+                return self._create(self._parse_body(body))
+            raise PctServiceError(405, 'Method not allowed.')
+
+        session = self._sessions.get(parts[1])
+        if len(parts) == 2:
+            if method == 'GET':
+                with session.locked():
+                    description = self._describe(session)
+                return self._json_response(description)
+            if method == 'DELETE':
+                self._sessions.close(session.get_id())
+                return self._json_response({'closed': session.get_id()})
+            raise PctServiceError(405, 'Method not allowed.')
+
+        if method == 'GET' and parts[2] == 'composition.jpg':
+            width = self._get_int(
+                query,
+                'width',
+                get_setting('PCT_COMPOSITION_WIDTH'),
+            )
+            with session.locked():
+                encoded = session.get_composer().get_encoded_composition(width)
+            return self._image_response(encoded, headers)
+
+        if method == 'GET' and parts[2] == 'images' and len(parts) == 4:
+            index = self._parse_int(path.splitext(parts[3])[0], 'index')
+            width = self._get_int(
+                query,
+                'width',
+                get_setting('PCT_PREVIEW_WIDTH'),
+            )
+            with session.locked():
+                encoded = session.get_composer().get_encoded_preview(
+                    index,
+                    width,
+                )
+            return self._image_response(encoded, headers)
+
+        if method == 'POST' and parts[2] in self._actions:
+            params = self._parse_body(body)
+            with session.locked():
+                success = self._actions[parts[2]](session, params)
+                description = self._describe(session, success)
+            return self._json_response(description)
+
+        raise PctServiceError(404, 'Not found.')
+
+    def _create(self, params):
+        directory = params.get('directory')
+        if not directory:
+            raise PctServiceError(400, 'A directory is required.')
+        session = self._sessions.create(
+            directory,
+            self._get_bool(
+                params,
+                'magic',
+                get_setting('PCT_DEFAULT_AUTOMAGIC'),
+            ),
+            self._get_int(params, 'strength', get_setting('PCT_DEFAULT_FIT')),
+            params.get(
+                'duplicates',
+                get_setting('PCT_DEFAULT_DUPLICATE_POLICY'),
+            ),
+        )
+        return self._json_response(self._describe(session, True), 201)
+
+    def _describe(self, session, success=None):
+        description = {
+            'session': session.get_id(),
+            'directory': session.get_directory(),
+            'images': [
+                get_image_name(f)
+                for f in session.get_composer().get_image_files()
+            ],
+            'messages': session.get_messages(),
+        }
+        if success is not None:
+            description['success'] = bool(success)
+        return description
+
+    def _parse_body(self, body):
+        if not body:
+            return {}
+        try:
+            params = json.loads(body.decode('utf-8'))
+        except ValueError:
+            raise PctServiceError(400, 'Invalid JSON body.')
+        if not isinstance(params, dict):
+            raise PctServiceError(400, 'Expected a JSON object.')
+        return params
+
+    def _json_response(self, data, status=200):
+        return PctServiceResponse(
+            status,
+            json.dumps(data).encode('utf-8'),
+            {'Content-Type': 'application/json'},
+        )
+
+    def _image_response(self, encoded, headers):
+        if encoded is None:
+            raise PctServiceError(404, 'No image available.')
+        image, etag = encoded
+        etag = '"{}"'.format(etag)
+        response_headers = {
+            'Content-Type': 'image/jpeg',
+            'ETag': etag,
+            'Cache-Control': 'no-cache',
+        }
+        if headers.get('If-None-Match') == etag:
+            return PctServiceResponse(304, b'', response_headers)
+        return PctServiceResponse(200, image, response_headers)
+
+    def _get_index(self, params):
+        if 'index' not in params:
+            raise PctServiceError(400, 'An image index is required.')
+        return self._get_int(params, 'index')
+
+    def _get_int(self, params, name, default=None):
+        return self._parse_int(params.get(name, default), name)
+
+    def _parse_int(self, value, name):
+        # Integers may come as JSON numbers or as strings, e.g. from a query
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+        if isinstance(value, int) and not isinstance(value, bool):
+            return value
+        if isinstance(value, str):
+            try:
+                return int(value)
+            except ValueError:
+                pass
+        raise PctServiceError(400, 'Invalid {}.'.format(name))
+
+    def _get_bool(self, params, name, default=None):
+        value = params.get(name, default)
+        if isinstance(value, bool):
+            return value
+        if isinstance(value, int) and value in (0, 1):
+            return bool(value)
+        if isinstance(value, str):
+            if value.lower() in ('true', 'yes', 'on', '1'):
+                return True
+            if value.lower() in ('false', 'no', 'off', '0'):
+                return False
+        raise PctServiceError(400, 'Invalid {}.'.format(name))
+
+    def _recompose(self, session, success):
+        if success:
+            session.get_composer().compose()
+        return success
+
+    def _fit(self, session, params):
+        return self._recompose(session, session.get_composer().fit(
+            self._get_index(params),
+            self._get_int(params, 'strength', get_setting('PCT_DEFAULT_FIT')),
+        ))
+
+    def _magic(self, session, params):
+        return self._recompose(session, session.get_composer().fit_all(
+            self._get_int(params, 'strength', get_setting('PCT_DEFAULT_FIT')),
+        ))
+
+    def _rotate(self, session, params):
+        return self._recompose(session, session.get_composer().rotate(
+            self._get_index(params),
+            self._get_int(
+                params,
+                'angle',
+                get_setting('PCT_DEFAULT_ROTATION'),
+            ),
+        ))
+
+    def _reindex(self, session, params):
+        if 'index_in' not in params or 'index_out' not in params:
+            raise PctServiceError(400, 'Two image indices are required.')
+        return self._recompose(session, session.get_composer().reindex_image(
+            self._get_int(params, 'index_in'),
+            self._get_int(params, 'index_out'),
+        ))
+
+    def _undo(self, session, params):
+        return self._recompose(
+            session,
+            session.get_composer().undo(self._get_index(params)),
+        )
+
+    def _redo(self, session, params):
+        return self._recompose(
+            session,
+            session.get_composer().redo(self._get_index(params)),
+        )
+
+    def _compose(self, session, params):
+        layout = params.get('layout')
+        if layout is not None:
+            if layout not in PCT_LAYOUT_MODES:
+                raise PctServiceError(400, 'Invalid layout mode.')
+            session.get_composer().set_layout_mode(layout)
+        return session.get_composer().compose(
+            **self._get_output_size(params)
+        )
+
+    def _save(self, session, params):
+        directory = session.get_directory()
+        return session.get_composer().save(
+            get_output_image_filepath(directory),
+            get_output_metadata_filepath(directory),
+            **self._get_output_size(params)
+        )
+
+    def _get_output_size(self, params):
+        size = {}
+        for name in ('height', 'width', 'megapixels'):
+            if name not in params:
+                continue
+            try:
+                value = float(params[name])
+            except (TypeError, ValueError):
+                value = 0
+            if value <= 0:
+                raise PctServiceError(
+                    400,
+                    'Invalid output {}.'.format(name),
+                )
+            size[name] = value if name == 'megapixels' else int(value)
+        return size
+
+    def _export(self, session, params):
+        extension = params.get('format', PCT_DEFAULT_EXPORT_FORMAT)
+        if extension not in PCT_EXPORT_FORMATS:
+            raise PctServiceError(400, 'Invalid export format.')
+        return session.get_composer().export(get_output_animation_filepath(
+            session.get_directory(),
+            extension,
+        ))
+
+class PctHTTPServer(HTTPServer):
+
+    def get_service(self):
+        return self._service
+
+    def process_request(self, request, client_address):
+        # Blocks the accept loop once the pool and its queue are full
+        self._slots.acquire()
+        try:
+            self._pool.submit(self._process, request, client_address)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def server_close(self):
+        super(PctHTTPServer, self).server_close()
+        self._pool.shutdown(wait=True)
+
+    #
+    # Private
+    #
+
+    def __init__(self, address, service, workers=None, queue=None):
+        if workers is None:
+            workers = get_setting('PCT_SERVER_WORKERS')
+        if queue is None:
+            queue = get_setting('PCT_SERVER_QUEUE')
+        super(PctHTTPServer, self).__init__(address, PctRequestHandler)
+        self._service = service
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._slots = threading.BoundedSemaphore(workers + queue)
+
+    def _process(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._slots.release()
+
+class PctRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_DELETE(self):
+        self._dispatch('DELETE')
+
+    #
+    # Private
+    #
+
+    def _dispatch(self, method):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        response = self.server.get_service().dispatch(
+            method,
+            self.path,
+            self.headers,
+            body,
+        )
+        self.send_response(response.get_status())
+        for key, value in response.get_headers().items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(response.get_body())))
+        self.end_headers()
+        self.wfile.write(response.get_body())
+
+def serve(host=None, port=None, workers=None, queue=None):
+    if host is None:
+        host = get_setting('PCT_SERVER_HOST')
+    if port is None:
+        port = get_setting('PCT_SERVER_PORT')
+    service = PctService()
+    server = PctHTTPServer((host, port), service, workers, queue)
+
+    stop = threading.Event()
+    def reap():
+        while not stop.wait(get_setting('PCT_SERVER_REAP_INTERVAL')):
+            service.evict_idle()
+    reaper = threading.Thread(target=reap, daemon=True)
+    reaper.start()
+
+    print('Serving Pictionary Telephone composer on {}:{}'.format(host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        server.server_close()
+        service.shutdown()
+    return 0
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests of archive members that share a filename in different folders.
+"""
+
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+import zipfile
+
+import cv2
+import numpy
+
+from pct.common.settings import (
+    reload_settings,
+)
+from pct.composer.duplicates import (
+    find_duplicate_images,
+)
+from pct.datamanagement.cache import (
+    PctLoadCache,
+)
+from pct.datamanagement.files import (
+    get_edited_image_filepath,
+    get_image_name,
+    get_input_image_filepaths,
+    get_load_cache_filepath,
+)
+
+MEMBERS = ['ch1/01.jpg', 'ch2/01.jpg']
+
+def write_members(directory):
+    filepaths = []
+    for index, member in enumerate(MEMBERS):
+        image = numpy.full((300, 200, 3), 255, numpy.uint8)
+        cv2.rectangle(
+            image,
+            (20 + index * 40, 30),
+            (150, 260 - index * 80),
+            (0, 0, 0),
+            3,
+        )
+        filepath = os.path.join(directory, member.replace('/', '_'))
+        cv2.imwrite(filepath, image)
+        filepaths.append(filepath)
+    return filepaths
+
+class PctArchiveMembersTest(unittest.TestCase):
+
+    def setUp(self):
+        self._previous = os.environ.get('PCT_ARCHIVE_OUTPUT_DIRECTORY')
+        os.environ['PCT_ARCHIVE_OUTPUT_DIRECTORY'] = ''
+        reload_settings()
+        self._directory = tempfile.mkdtemp()
+        self._sources = write_members(self._directory)
+
+    def tearDown(self):
+        shutil.rmtree(self._directory, ignore_errors=True)
+        if self._previous is None:
+            os.environ.pop('PCT_ARCHIVE_OUTPUT_DIRECTORY', None)
+        else:
+            os.environ['PCT_ARCHIVE_OUTPUT_DIRECTORY'] = self._previous
+        reload_settings()
+
+    def write_zip(self):
+        archive = os.path.join(self._directory, 'game.zip')
+        with zipfile.ZipFile(archive, 'w') as zf:
+            for source, member in zip(self._sources, MEMBERS):
+                zf.write(source, member)
+        return archive
+
+    def write_tar(self):
+        archive = os.path.join(self._directory, 'game.tar.gz')
+        with tarfile.open(archive, 'w:gz') as tf:
+            for source, member in zip(self._sources, MEMBERS):
+                tf.add(source, member)
+        return archive
+
+    def check_archive(self, archive):
+        filepaths = sorted(get_input_image_filepaths(archive))
+        self.assertEqual([get_image_name(f) for f in filepaths], MEMBERS)
+
+        output_directory = os.path.join(self._directory, 'game')
+        self.assertEqual(
+            [get_edited_image_filepath(f) for f in filepaths],
+            [
+                os.path.join(output_directory, 'ch1', '_pct_edit_01.jpg'),
+                os.path.join(output_directory, 'ch2', '_pct_edit_01.jpg'),
+            ],
+        )
+
+        cache = PctLoadCache(get_load_cache_filepath(archive))
+        self.assertEqual(find_duplicate_images(filepaths, 64, cache), {})
+        self.assertEqual(sorted(cache._entries), MEMBERS)
+        hashes = [cache.get(f, 'dhash') for f in filepaths]
+        self.assertNotEqual(hashes[0], hashes[1])
+
+    def test_zip_members(self):
+        self.check_archive(self.write_zip())
+
+    def test_tar_members(self):
+        self.check_archive(self.write_tar())
+
+if __name__ == '__main__':
+    unittest.main()
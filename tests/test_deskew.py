@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests of skew detection and of the fit operation's choice between a
+deskew and a plain crop. Contours are built directly, as findContours
+would return them, so the tests don't depend on edge detection.
+"""
+
+import unittest
+
+from unittest import mock
+
+import cv2
+import numpy
+
+from pct.composer.execution import (
+    fit_operation,
+)
+from pct.composer.imageprocessing import (
+    estimate_skew,
+    get_rectangularity,
+    get_rotation_matrix,
+)
+
+IMAGE = numpy.zeros((300, 400, 3), numpy.uint8)
+DESKEW = (0.5, 15.0, 0.95)
+
+def make_outline(angle, center=(200, 150), size=(240, 160)):
+    # A card's outline, found as one contour per edge
+    corners = cv2.boxPoints((center, size, angle))
+    contours = []
+    for start, end in zip(corners, numpy.roll(corners, -1, axis=0)):
+        points = [start + (end - start) * t for t in numpy.linspace(0, 1, 60)]
+        contours.append(
+            numpy.round(points).astype(numpy.int32).reshape(-1, 1, 2)
+        )
+    return contours
+
+def make_scribbles():
+    # Contents with no outline: a triangle fills half of its rectangle
+    return [numpy.array(
+        [[[60, 60]], [[340, 60]], [[60, 240]]],
+        numpy.int32,
+    )]
+
+def rotate_contours(contours, angle):
+    matrix = get_rotation_matrix(IMAGE, angle)
+    return [
+        cv2.transform(c.astype(numpy.float32), matrix).astype(numpy.int32)
+        for c in contours
+    ]
+
+class PctDeskewTest(unittest.TestCase):
+
+    def test_straight_card(self):
+        self.assertAlmostEqual(estimate_skew(make_outline(0)), 0, delta=0.1)
+        self.assertAlmostEqual(estimate_skew(make_outline(90)), 0, delta=0.1)
+
+    def test_skew_is_squared_up(self):
+        for skew in (-12, -3, -0.7, 0.7, 3, 12):
+            contours = make_outline(skew)
+            angle = estimate_skew(contours)
+            self.assertAlmostEqual(abs(angle), abs(skew), delta=0.2)
+            # Rotating by the estimate leaves the card straight
+            straightened = rotate_contours(contours, angle)
+            self.assertAlmostEqual(
+                estimate_skew(straightened),
+                0,
+                delta=0.2,
+            )
+
+    def test_opposite_skews(self):
+        self.assertAlmostEqual(
+            estimate_skew(make_outline(4)),
+            -estimate_skew(make_outline(-4)),
+            delta=0.1,
+        )
+
+    def test_rectangularity(self):
+        for skew in (0, 3, 12):
+            self.assertGreater(get_rectangularity(make_outline(skew)), 0.95)
+        self.assertAlmostEqual(
+            get_rectangularity(make_scribbles()),
+            0.5,
+            delta=0.05,
+        )
+        line = [numpy.array([[[10, 10]], [[100, 10]]], numpy.int32)]
+        self.assertEqual(get_rectangularity(line), 0.0)
+
+    def fit(self, contours, deskew=DESKEW, buffer=0):
+        with mock.patch(
+                'pct.composer.execution.find_dominant_contours',
+                return_value=contours):
+            return fit_operation(IMAGE, 3, buffer, deskew)
+
+    def test_fit_deskews_skewed_cards(self):
+        operation, value = self.fit(make_outline(3))
+        self.assertEqual(operation, 'deskew')
+        self.assertAlmostEqual(abs(value[0]), 3, delta=0.2)
+        left, right, top, bottom = value[1:]
+        # The straightened card is about its own size, not its skewed box
+        self.assertAlmostEqual(right - left, 240, delta=4)
+        self.assertAlmostEqual(bottom - top, 160, delta=4)
+
+    def test_fit_crops_outside_the_deskew_range(self):
+        for skew in (0, 0.3, 20):
+            operation, _ = self.fit(make_outline(skew))
+            self.assertEqual(operation, 'crop', skew)
+
+    def test_fit_crops_without_an_outline(self):
+        operation, _ = self.fit(rotate_contours(make_scribbles(), 5))
+        self.assertEqual(operation, 'crop')
+
+    def test_fit_without_deskew(self):
+        operation, value = self.fit(make_outline(3), deskew=None, buffer=5)
+        self.assertEqual(operation, 'crop')
+        points = numpy.concatenate(make_outline(3))[:, 0]
+        self.assertEqual(value, [
+            int(points[:, 0].min()) - 5,
+            int(points[:, 0].max()) + 5,
+            int(points[:, 1].min()) - 5,
+            int(points[:, 1].max()) + 5,
+        ])
+
+    def test_fit_without_contours(self):
+        self.assertIsNone(self.fit([]))
+
+if __name__ == '__main__':
+    unittest.main()
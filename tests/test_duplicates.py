@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests of near-duplicate detection on near-duplicate and on distinct but
+similar line-art cards.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import cv2
+import numpy
+
+from pct.composer.duplicates import (
+    filter_duplicate_images,
+    find_duplicate_images,
+)
+from pct.datamanagement.cache import (
+    PctLoadCache,
+)
+
+def make_card(seed, height=1200, width=900):
+    # A frame, a title and a few strokes, like the line art of a card
+    generator = numpy.random.RandomState(seed)
+    image = numpy.full((height, width, 3), 250, numpy.uint8)
+    cv2.rectangle(image, (40, 40), (width - 40, height - 40), (0, 0, 0), 6)
+    cv2.putText(
+        image,
+        'Round 3',
+        (80, 140),
+        cv2.FONT_HERSHEY_SIMPLEX,
+        2.5,
+        (0, 0, 0),
+        5,
+    )
+    for _ in range(6):
+        points = generator.randint(200, height - 200, (5, 2))
+        points[:, 0] = points[:, 0] * width // height
+        cv2.polylines(
+            image,
+            [points.reshape(-1, 1, 2).astype(numpy.int32)],
+            False,
+            (0, 0, 0),
+            4,
+        )
+    return image
+
+def make_variants(image):
+    # The same card scanned again: smaller, darker and slightly rotated
+    height, width = image.shape[:2]
+    matrix = cv2.getRotationMatrix2D((width / 2, height / 2), 0.7, 1)
+    return [
+        cv2.resize(image, None, fx=0.8, fy=0.8, interpolation=cv2.INTER_AREA),
+        numpy.clip(image.astype(int) - 12, 0, 255).astype(numpy.uint8),
+        cv2.warpAffine(
+            image,
+            matrix,
+            (width, height),
+            borderValue=(250, 250, 250),
+        ),
+    ]
+
+class PctDuplicatesTest(unittest.TestCase):
+
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._directory, ignore_errors=True)
+
+    def write(self, name, image):
+        filepath = os.path.join(self._directory, name)
+        cv2.imwrite(filepath, image, [cv2.IMWRITE_JPEG_QUALITY, 60])
+        return filepath
+
+    def write_distinct(self, count=12):
+        return [
+            self.write('card{:02d}.jpg'.format(seed), make_card(seed))
+            for seed in range(count)
+        ]
+
+    def test_near_duplicates_are_found(self):
+        original = self.write('card.jpg', make_card(0))
+        variants = [
+            self.write('variant{}.jpg'.format(index), image)
+            for index, image in enumerate(make_variants(make_card(0)))
+        ]
+        duplicates = find_duplicate_images([original] + variants)
+        self.assertEqual(duplicates, {v: original for v in variants})
+
+    def test_distinct_cards_are_not_duplicates(self):
+        filepaths = self.write_distinct()
+        self.assertEqual(find_duplicate_images(filepaths), {})
+
+    def test_hash_matches_require_confirmation(self):
+        # Every pair is a hash candidate; only the thumbnails tell them apart
+        filepaths = self.write_distinct()
+        self.assertEqual(find_duplicate_images(filepaths, threshold=64), {})
+        duplicates = find_duplicate_images(
+            filepaths,
+            threshold=64,
+            correlation=-1,
+        )
+        self.assertEqual(len(duplicates), len(filepaths) - 1)
+
+    def test_skip_drops_only_confirmed_duplicates(self):
+        filepaths = self.write_distinct(4)
+        variant = self.write('variant.jpg', make_variants(make_card(2))[0])
+        cache = PctLoadCache(os.path.join(self._directory, 'cache.json'))
+        loaded, duplicates = filter_duplicate_images(
+            filepaths + [variant],
+            'skip',
+            threshold=64,
+            cache=cache,
+        )
+        self.assertEqual(loaded, filepaths)
+        self.assertEqual(duplicates, {variant: filepaths[2]})
+
+        # Cached hashes and thumbnails give the same answer
+        loaded, duplicates = filter_duplicate_images(
+            filepaths + [variant],
+            'skip',
+            threshold=64,
+            cache=cache,
+        )
+        self.assertEqual(loaded, filepaths)
+
+    def test_warn_and_off_keep_everything(self):
+        filepaths = [
+            self.write('card.jpg', make_card(0)),
+            self.write('variant.jpg', make_variants(make_card(0))[1]),
+        ]
+        loaded, duplicates = filter_duplicate_images(filepaths, 'warn')
+        self.assertEqual(loaded, filepaths)
+        self.assertEqual(duplicates, {filepaths[1]: filepaths[0]})
+        self.assertEqual(
+            filter_duplicate_images(filepaths, 'off'),
+            (filepaths, {}),
+        )
+
+if __name__ == '__main__':
+    unittest.main()
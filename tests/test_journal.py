@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the edit journal and of recovering edits from it after a crash.
+"""
+
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from contextlib import redirect_stdout
+from unittest import mock
+
+import cv2
+import numpy
+
+from pct.common.settings import (
+    reload_settings,
+)
+from pct.composer.composer import (
+    PctComposer,
+)
+from pct.datamanagement.journal import (
+    PctJournal,
+)
+
+def write_card(filepath, index, height=120, width=80):
+    image = numpy.full((height, width, 3), 255, numpy.uint8)
+    cv2.rectangle(image, (10 + index, 10), (width - 10, height - 10), 0, 2)
+    cv2.imwrite(filepath, image)
+
+class PctJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+        self._filepath = os.path.join(self._directory, 'journal.jsonl')
+        self._journal = PctJournal(self._filepath)
+
+    def tearDown(self):
+        self._journal.close()
+        shutil.rmtree(self._directory, ignore_errors=True)
+
+    def test_append_and_read(self):
+        self.assertEqual(self._journal.read(), [])
+        self._journal.append({'op': 'open'})
+        self._journal.append({'op': 'rotate', 'value': 90})
+        self.assertEqual(self._journal.read(), [
+            {'op': 'open'},
+            {'op': 'rotate', 'value': 90},
+        ])
+
+    def test_torn_entry_is_ignored(self):
+        self._journal.append({'op': 'open'})
+        self._journal.close()
+        with open(self._filepath, 'a') as fp:
+            fp.write('{"op": "rot')
+        self.assertEqual(self._journal.read(), [{'op': 'open'}])
+
+    def test_reset(self):
+        self._journal.append({'op': 'open'})
+        self._journal.append({'op': 'rotate', 'value': 90})
+        self._journal.reset({'op': 'open', 'files': []})
+        self.assertEqual(self._journal.read(), [{'op': 'open', 'files': []}])
+        self.assertFalse(os.path.exists(self._filepath + '.tmp'))
+        self._journal.append({'op': 'undo'})
+        self.assertEqual(len(self._journal.read()), 2)
+
+    def test_reset_is_atomic(self):
+        # A crash before the new journal replaces the old one leaves the
+        # old one whole
+        self._journal.append({'op': 'open'})
+        self._journal.append({'op': 'rotate', 'value': 90})
+        with mock.patch('os.replace', side_effect=OSError('crash')):
+            with self.assertRaises(OSError):
+                self._journal.reset({'op': 'open', 'files': []})
+        self.assertEqual(self._journal.read(), [
+            {'op': 'open'},
+            {'op': 'rotate', 'value': 90},
+        ])
+
+class PctJournalRecoveryTest(unittest.TestCase):
+
+    def setUp(self):
+        self._previous = os.environ.get('PCT_RENDER_CACHE_DIRECTORY')
+        os.environ['PCT_RENDER_CACHE_DIRECTORY'] = ''
+        reload_settings()
+        self._directory = tempfile.mkdtemp()
+        self._filepaths = []
+        for index in range(3):
+            filepath = os.path.join(
+                self._directory,
+                'card{}.jpg'.format(index),
+            )
+            write_card(filepath, index)
+            self._filepaths.append(filepath)
+        self._journal_filepath = os.path.join(
+            self._directory,
+            'journal.jsonl',
+        )
+        self._composers = []
+
+    def tearDown(self):
+        for composer in self._composers:
+            composer.cleanup()
+        shutil.rmtree(self._directory, ignore_errors=True)
+        if self._previous is None:
+            os.environ.pop('PCT_RENDER_CACHE_DIRECTORY', None)
+        else:
+            os.environ['PCT_RENDER_CACHE_DIRECTORY'] = self._previous
+        reload_settings()
+
+    def load(self):
+        # A fresh composer, as a new process would load after a crash
+        composer = PctComposer(
+            self._filepaths,
+            headless=True,
+            journal=PctJournal(self._journal_filepath),
+        )
+        composer.prepare()
+        self._composers.append(composer)
+        return composer
+
+    def get_state(self, composer):
+        return (
+            composer.get_image_files(),
+            [c.get_operations() for c in composer._get_composers()],
+            [c.get_image(False).shape for c in composer._get_composers()],
+        )
+
+    def edit(self, composer):
+        composer.recover()
+        composer.rotate(0, 90)
+        composer.rotate(1, 90)
+        composer.rotate(1, 180)
+        composer.undo(1)
+        composer.rotate(2, 90)
+        composer.undo(2)
+        composer.redo(2)
+        composer.reindex_image(0, 2)
+
+    def test_replay(self):
+        composer = self.load()
+        self.edit(composer)
+        state = self.get_state(composer)
+
+        recovered = self.load()
+        self.assertEqual(recovered.recover(), 8)
+        self.assertEqual(self.get_state(recovered), state)
+
+    def test_nothing_to_recover(self):
+        composer = self.load()
+        self.assertEqual(composer.recover(), 0)
+        self.assertEqual(
+            PctJournal(self._journal_filepath).read(),
+            [composer._get_journal_header()],
+        )
+
+    def test_signature_mismatch_discards_journal(self):
+        composer = self.load()
+        self.edit(composer)
+        write_card(self._filepaths[1], 1, height=160)
+
+        recovered = self.load()
+        with redirect_stdout(io.StringIO()):
+            self.assertEqual(recovered.recover(), 0)
+        self.assertEqual(
+            [c.get_operations() for c in recovered._get_composers()],
+            [[], [], []],
+        )
+        self.assertEqual(
+            PctJournal(self._journal_filepath).read(),
+            [recovered._get_journal_header()],
+        )
+
+    def test_file_mismatch_discards_journal(self):
+        composer = self.load()
+        self.edit(composer)
+        os.remove(self._filepaths[2])
+        del self._filepaths[2]
+
+        recovered = self.load()
+        with redirect_stdout(io.StringIO()):
+            self.assertEqual(recovered.recover(), 0)
+        with open(self._journal_filepath) as fp:
+            lines = fp.readlines()
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(
+            json.loads(lines[0])['files'],
+            ['card0.jpg', 'card1.jpg'],
+        )
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the composition layout geometry.
+"""
+
+import unittest
+
+import numpy
+
+from pct.composer.layout import (
+    PctLayout,
+    PctLayoutError,
+    PctSlot,
+    compute_layout,
+    get_layout_scale,
+    render_layout,
+    scale_layout,
+)
+
+class PctLayoutTest(unittest.TestCase):
+
+    def assertSlots(self, layout, slots):
+        self.assertEqual(
+            [(s.x, s.y, s.width, s.height) for s in layout.slots],
+            slots,
+        )
+
+    def test_invalid(self):
+        with self.assertRaises(PctLayoutError):
+            compute_layout([(100, 100)], 'circle', 10)
+        self.assertIsNone(compute_layout([], 'strip', 10))
+
+    def test_strip(self):
+        # Cards are scaled to the shortest card
+        sizes = [(200, 100), (100, 100), (100, 50)]
+        layout = compute_layout(sizes, 'strip', 10)
+        self.assertEqual((layout.width, layout.height), (240, 120))
+        self.assertSlots(layout, [
+            (10, 10, 50, 100),
+            (70, 10, 100, 100),
+            (180, 10, 50, 100),
+        ])
+
+    def test_rows_under_max_width(self):
+        layout = compute_layout([(100, 100)] * 4, 'rows', 10, max_width=230)
+        self.assertEqual((layout.width, layout.height), (230, 230))
+        self.assertSlots(layout, [
+            (10, 10, 100, 100),
+            (120, 10, 100, 100),
+            (10, 120, 100, 100),
+            (120, 120, 100, 100),
+        ])
+
+        layout = compute_layout([(100, 100)] * 3, 'rows', 10, max_width=340)
+        self.assertEqual((layout.width, layout.height), (340, 120))
+        layout = compute_layout([(100, 100)] * 3, 'rows', 10, max_width=339)
+        self.assertEqual((layout.width, layout.height), (230, 230))
+
+    def test_rows_are_balanced(self):
+        # A greedy split would put four narrow cards and the wide one in
+        # the first row
+        sizes = [(100, 50)] * 4 + [(100, 200)]
+        layout = compute_layout(sizes, 'rows', 0, max_width=399)
+        self.assertEqual((layout.width, layout.height), (200, 200))
+        self.assertEqual([s.y for s in layout.slots], [0, 0, 0, 0, 100])
+
+    def test_rows_under_max_aspect(self):
+        layout = compute_layout([(100, 100)] * 4, 'rows', 10, max_aspect=1.0)
+        self.assertEqual((layout.width, layout.height), (230, 230))
+        layout = compute_layout([(100, 100)] * 4, 'rows', 10, max_aspect=4.0)
+        self.assertEqual((layout.width, layout.height), (450, 120))
+
+    def test_grid(self):
+        # Cards are centered in cells as wide as the widest card
+        sizes = [(100, 50), (100, 100), (100, 80)]
+        layout = compute_layout(sizes, 'grid', 10)
+        self.assertEqual((layout.width, layout.height), (340, 120))
+        self.assertSlots(layout, [
+            (35, 10, 50, 100),
+            (120, 10, 100, 100),
+            (240, 10, 80, 100),
+        ])
+
+        layout = compute_layout(sizes, 'grid', 10, max_aspect=1.0)
+        self.assertEqual((layout.width, layout.height), (230, 230))
+        self.assertSlots(layout, [
+            (35, 10, 50, 100),
+            (120, 10, 100, 100),
+            (20, 120, 80, 100),
+        ])
+
+    def test_layout_scale(self):
+        layout = PctLayout(1000, 500, [])
+        self.assertEqual(get_layout_scale(layout, height=250), 0.5)
+        self.assertEqual(get_layout_scale(layout, width=2000), 2.0)
+        self.assertEqual(get_layout_scale(layout, 250, 2000), 0.5)
+        self.assertAlmostEqual(
+            get_layout_scale(layout, megapixels=0.125),
+            0.5,
+        )
+        self.assertEqual(get_layout_scale(layout, megapixels=10), 1.0)
+        self.assertEqual(get_layout_scale(layout), 1.0)
+
+    def test_scaled_slots_stay_apart(self):
+        layout = compute_layout([(100, 100)] * 7, 'rows', 7, max_width=400)
+        self.assertIs(scale_layout(layout, 1.0), layout)
+        for scale in (1 / 3, 0.37, 0.5, 1.9):
+            scaled = scale_layout(layout, scale)
+            slots = sorted(scaled.slots, key=lambda s: (s.y, s.x))
+            for slot, following in zip(slots, slots[1:]):
+                if slot.y == following.y:
+                    self.assertLessEqual(slot.x + slot.width, following.x)
+                else:
+                    self.assertLessEqual(slot.y + slot.height, following.y)
+            for slot in slots:
+                self.assertLessEqual(slot.x + slot.width, scaled.width)
+                self.assertLessEqual(slot.y + slot.height, scaled.height)
+
+    def test_render(self):
+        layout = PctLayout(30, 20, [
+            PctSlot(0, 0, 10, 20),
+            PctSlot(15, 5, 10, 10),
+        ])
+        canvas = render_layout(layout, [
+            numpy.full((20, 10, 3), 200, numpy.uint8),
+            numpy.full((10, 10), 100, numpy.uint8),
+        ])
+        self.assertEqual(canvas.shape, (20, 30, 3))
+        self.assertTrue((canvas[:, :10] == 200).all())
+        self.assertTrue((canvas[5:15, 15:25] == 100).all())
+        self.assertEqual(int(canvas[:, 10:15].max()), 0)
+        self.assertEqual(int(canvas[:5, 15:].max()), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the size bound of PctRenderCache.
+"""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from pct.datamanagement.renders import (
+    PctRenderCache,
+)
+
+def get_key(index):
+    return '{:040x}'.format(index)
+
+class PctRenderCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._directory, ignore_errors=True)
+
+    def fill(self, count, size=1000):
+        cache = PctRenderCache(self._directory, count * size)
+        for index in range(count):
+            self.assertTrue(cache.write(get_key(index), '.jpg', b'x' * size))
+            # Modification times order pruning
+            filepath = cache.get_filepath(get_key(index), '.jpg')
+            os.utime(filepath, (time.time() - 100 + index,) * 2)
+        return cache
+
+    def test_first_write_prunes(self):
+        # Each process writes far less than a sixteenth of the bound, but
+        # the cache stays bounded
+        self.fill(40, 100)
+        for index in range(40, 44):
+            cache = PctRenderCache(self._directory, 4000)
+            cache.write(get_key(index), '.jpg', b'x' * 100)
+        kept = [
+            index for index in range(44)
+            if os.path.isfile(cache.get_filepath(get_key(index), '.jpg'))
+        ]
+        self.assertEqual(kept, list(range(4, 44)))
+
+    def test_least_recently_used_are_removed(self):
+        cache = self.fill(4)
+        self.assertTrue(cache.has(get_key(0), '.jpg'))
+        cache = PctRenderCache(self._directory, 3000)
+        self.assertEqual(cache.prune(), 1)
+        self.assertFalse(cache.has(get_key(1), '.jpg'))
+        for index in (0, 2, 3):
+            self.assertTrue(cache.has(get_key(index), '.jpg'), index)
+
+if __name__ == '__main__':
+    unittest.main()
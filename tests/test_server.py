@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests of PctService.dispatch, which need no socket.
+"""
+
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from contextlib import redirect_stderr
+
+import cv2
+import numpy
+
+from pct.common.settings import (
+    reload_settings,
+)
+from pct.server.server import (
+    PctService,
+)
+
+def make_cards(directory, count=2, height=300, width=200):
+    os.makedirs(directory)
+    for index in range(count):
+        image = numpy.full((height, width, 3), 255, numpy.uint8)
+        cv2.rectangle(
+            image,
+            (20 + index * 5, 30),
+            (width - 30, height - 40),
+            (0, 0, 200),
+            3,
+        )
+        cv2.imwrite(
+            os.path.join(directory, 'card{}.jpg'.format(index)),
+            image,
+        )
+
+class PctServiceTest(unittest.TestCase):
+
+    def setUp(self):
+        self._previous = os.environ.get('PCT_RENDER_CACHE_DIRECTORY')
+        os.environ['PCT_RENDER_CACHE_DIRECTORY'] = ''
+        reload_settings()
+        self._workspace = tempfile.mkdtemp()
+        self._directory = os.path.join(self._workspace, 'cards')
+        make_cards(self._directory)
+        self._service = PctService()
+
+    def tearDown(self):
+        self._service.shutdown()
+        shutil.rmtree(self._workspace, ignore_errors=True)
+        if self._previous is None:
+            os.environ.pop('PCT_RENDER_CACHE_DIRECTORY', None)
+        else:
+            os.environ['PCT_RENDER_CACHE_DIRECTORY'] = self._previous
+        reload_settings()
+
+    def dispatch(self, method, url, params=None, headers=None):
+        body = b'' if params is None else json.dumps(params).encode('utf-8')
+        return self._service.dispatch(method, url, headers, body)
+
+    def json(self, response):
+        return json.loads(response.get_body().decode('utf-8'))
+
+    def create(self, **params):
+        params.setdefault('directory', self._directory)
+        params.setdefault('magic', False)
+        params.setdefault('duplicates', 'off')
+        response = self.dispatch('POST', '/sessions', params)
+        self.assertEqual(response.get_status(), 201, response.get_body())
+        return self.json(response)['session']
+
+    def test_unknown_route(self):
+        self.assertEqual(self.dispatch('GET', '/nothing').get_status(), 404)
+
+    def test_stats(self):
+        response = self.dispatch('GET', '/stats')
+        self.assertEqual(response.get_status(), 200)
+        self.assertIn('slots', self.json(response))
+        self.assertEqual(self.dispatch('POST', '/stats').get_status(), 405)
+
+    def test_invalid_body(self):
+        response = self._service.dispatch('POST', '/sessions', None, b'{')
+        self.assertEqual(response.get_status(), 400)
+        response = self.dispatch('POST', '/sessions', [1, 2])
+        self.assertEqual(response.get_status(), 400)
+
+    def test_create_requires_directory(self):
+        response = self.dispatch('POST', '/sessions', {})
+        self.assertEqual(response.get_status(), 400)
+        response = self.dispatch('POST', '/sessions', {
+            'directory': os.path.join(self._workspace, 'missing'),
+        })
+        self.assertEqual(response.get_status(), 404)
+
+    def test_create_and_close(self):
+        session = self.create()
+        response = self.dispatch('GET', '/sessions/' + session)
+        self.assertEqual(response.get_status(), 200)
+        self.assertEqual(
+            self.json(response)['images'],
+            ['card0.jpg', 'card1.jpg'],
+        )
+        response = self.dispatch('DELETE', '/sessions/' + session)
+        self.assertEqual(response.get_status(), 200)
+        response = self.dispatch('GET', '/sessions/' + session)
+        self.assertEqual(response.get_status(), 404)
+
+    def test_session_evicted_before_locking(self):
+        sessions = self._service._sessions
+        get = sessions.get
+        def get_and_evict(session_id):
+            # Another request evicts the session once it has been looked up
+            found = get(session_id)
+            sessions.close(session_id)
+            return found
+        for method, url, params in (
+                ('GET', '', None),
+                ('GET', '/composition.jpg', None),
+                ('POST', '/rotate', {'index': 0, 'angle': 90})):
+            url = '/sessions/' + self.create() + url
+            sessions.get = get_and_evict
+            response = self.dispatch(method, url, params)
+            sessions.get = get
+            self.assertEqual(response.get_status(), 404, url)
+
+    def test_one_session_per_directory(self):
+        session = self.create()
+        response = self.dispatch('POST', '/sessions', {
+            'directory': self._directory,
+            'magic': False,
+        })
+        self.assertEqual(response.get_status(), 409)
+        self.dispatch('DELETE', '/sessions/' + session)
+        self.create()
+
+    def test_boolean_strings(self):
+        session = self.create(magic='false')
+        composer = self._service._sessions.get(session).get_composer()
+        self.assertEqual(
+            [c.get_operations() for c in composer._get_composers()],
+            [[], []],
+        )
+
+    def test_invalid_parameters(self):
+        for params in ({'magic': 'maybe'}, {'strength': 'strong'}):
+            params['directory'] = self._directory
+            response = self.dispatch('POST', '/sessions', params)
+            self.assertEqual(response.get_status(), 400, params)
+
+        session = '/sessions/' + self.create()
+        for method, url, params in (
+                ('GET', session + '/composition.jpg?width=wide', None),
+                ('GET', session + '/images/first.jpg', None),
+                ('POST', session + '/rotate', {'index': 'first'}),
+                ('POST', session + '/rotate', {'index': 0, 'angle': 1.5}),
+                ('POST', session + '/rotate', {'index': True}),
+                ('POST', session + '/reindex', {'index_in': 0}),
+                ('POST', session + '/undo', {})):
+            response = self.dispatch(method, url, params)
+            self.assertEqual(response.get_status(), 400, url)
+
+    def test_rotate_and_undo(self):
+        session = '/sessions/' + self.create()
+        response = self.dispatch('POST', session + '/rotate', {
+            'index': '0',
+            'angle': 90,
+        })
+        self.assertEqual(response.get_status(), 200)
+        self.assertTrue(self.json(response)['success'])
+        response = self.dispatch('POST', session + '/undo', {'index': 0})
+        self.assertTrue(self.json(response)['success'])
+
+    def test_images_are_cached_by_etag(self):
+        url = '/sessions/{}/images/0.jpg?width=100'.format(self.create())
+        response = self.dispatch('GET', url)
+        self.assertEqual(response.get_status(), 200)
+        self.assertEqual(response.get_headers()['Content-Type'], 'image/jpeg')
+        response = self.dispatch('GET', url, headers={
+            'If-None-Match': response.get_headers()['ETag'],
+        })
+        self.assertEqual(response.get_status(), 304)
+
+    def test_errors_are_not_returned(self):
+        session = '/sessions/' + self.create()
+        def fail(session, params):
+            raise RuntimeError('internal detail')
+        self._service._actions['fit'] = fail
+        log = io.StringIO()
+        with redirect_stderr(log):
+            response = self.dispatch('POST', session + '/fit', {'index': 0})
+        self.assertEqual(response.get_status(), 500)
+        self.assertNotIn(b'internal detail', response.get_body())
+        self.assertIn('internal detail', log.getvalue())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests of spilling interactor sessions to disk and restoring them.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import cv2
+import numpy
+
+from pct.common.settings import (
+    reload_settings,
+)
+from pct.composer.composer import (
+    PctComposer,
+)
+from pct.datamanagement.files import (
+    get_input_image_filepaths,
+    get_journal_filepath,
+)
+from pct.datamanagement.journal import (
+    PctJournal,
+)
+from pct.interactor.sessions import (
+    PctSessionManager,
+)
+
+def make_cards(directory, count=3, height=120, width=80):
+    os.makedirs(directory)
+    for index in range(count):
+        image = numpy.full((height, width, 3), 255, numpy.uint8)
+        cv2.rectangle(
+            image,
+            (10 + index * 3, 10),
+            (width - 10, height - 10 - index * 5),
+            (0, 0, 200),
+            2,
+        )
+        cv2.imwrite(
+            os.path.join(directory, 'card{}.jpg'.format(index)),
+            image,
+        )
+    return sorted(get_input_image_filepaths(directory))
+
+class PctSessionManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self._previous = os.environ.get('PCT_RENDER_CACHE_DIRECTORY')
+        os.environ['PCT_RENDER_CACHE_DIRECTORY'] = ''
+        reload_settings()
+        self._workspace = tempfile.mkdtemp()
+        self._directories = []
+        self._filepaths = []
+        for name in ('first', 'second'):
+            directory = os.path.join(self._workspace, name)
+            self._filepaths.append(make_cards(directory))
+            self._directories.append(directory)
+        # Without a budget, every inactive session is evicted
+        self._sessions = PctSessionManager(budget_mb=0, headless=True)
+
+    def tearDown(self):
+        self._sessions.close_all()
+        shutil.rmtree(self._workspace, ignore_errors=True)
+        if self._previous is None:
+            os.environ.pop('PCT_RENDER_CACHE_DIRECTORY', None)
+        else:
+            os.environ['PCT_RENDER_CACHE_DIRECTORY'] = self._previous
+        reload_settings()
+
+    def open(self, index):
+        session = self._sessions.open(
+            self._directories[index],
+            self._filepaths[index],
+        )
+        self._sessions.activate(session.get_name())
+        return session
+
+    def get_state(self, composer):
+        # Undo histories are given up when spilling, the edits aren't
+        return (
+            composer.get_image_files(),
+            composer.get_journal_operations(),
+            composer.get_signatures(),
+            [c.get_image() for c in composer._get_composers()],
+        )
+
+    def assertState(self, state, other):
+        self.assertEqual(state[:3], other[:3])
+        for image, other_image in zip(state[3], other[3]):
+            self.assertTrue(numpy.array_equal(image, other_image))
+
+    def edit(self, session):
+        composer = session.get_composer()
+        composer.rotate(0, 90)
+        composer.rotate(2, 180)
+        composer.rotate(2, 90)
+        composer.undo(2)
+        composer.reindex_image(0, 1)
+
+    def test_inactive_sessions_are_spilled(self):
+        first = self.open(0)
+        self.edit(first)
+        image_files = first.get_image_files()
+        self.open(1)
+
+        self.assertFalse(first.is_loaded())
+        self.assertEqual(self._sessions.get_session_nbytes(first), 0)
+        self.assertEqual(first.get_image_files(), image_files)
+        spill_files = first.get_spill_files()
+        self.assertEqual(sorted(spill_files), sorted(image_files))
+        for filepath in spill_files.values():
+            self.assertTrue(os.path.isfile(filepath))
+
+    def test_restore(self):
+        first = self.open(0)
+        self.edit(first)
+        state = self.get_state(first.get_composer())
+        second = self.open(1)
+        spill_files = list(first.get_spill_files().values())
+
+        self.assertIs(self._sessions.activate(first.get_name()), first)
+        self.assertTrue(first.is_loaded())
+        self.assertState(self.get_state(first.get_composer()), state)
+        self.assertIsNone(first.get_spill_files())
+        for filepath in spill_files:
+            self.assertFalse(os.path.exists(filepath))
+        self.assertFalse(second.is_loaded())
+
+    def test_restored_sessions_keep_journaling(self):
+        first = self.open(0)
+        self.edit(first)
+        self.open(1)
+        self._sessions.activate(first.get_name())
+        first.get_composer().rotate(1, 90)
+        state = self.get_state(first.get_composer())
+
+        # A fresh load recovers the edits made before and after the spill
+        composer = PctComposer(
+            self._filepaths[0],
+            headless=True,
+            journal=PctJournal(get_journal_filepath(self._directories[0])),
+        )
+        composer.prepare()
+        try:
+            self.assertGreater(composer.recover(), 0)
+            recovered = self.get_state(composer)
+            self.assertEqual(recovered[:3], state[:3])
+            self.assertEqual(
+                [i.shape for i in recovered[3]],
+                [i.shape for i in state[3]],
+            )
+        finally:
+            composer.cleanup()
+
+    def test_close_all_removes_spills(self):
+        first = self.open(0)
+        self.open(1)
+        spill_files = list(first.get_spill_files().values())
+        self._sessions.close_all()
+        self.assertEqual(self._sessions.list(), [])
+        for filepath in spill_files:
+            self.assertFalse(os.path.exists(filepath))
+
+if __name__ == '__main__':
+    unittest.main()
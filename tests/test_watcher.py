@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests of PctDirectoryWatcher, driven by an injected clock.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import cv2
+import numpy
+
+from pct.composer.composer import (
+    PctComposer,
+)
+from pct.datamanagement.watcher import (
+    PctDirectoryWatcher,
+)
+
+def write_card(filepath, value=255, height=120, width=80):
+    image = numpy.full((height, width, 3), value, numpy.uint8)
+    cv2.rectangle(image, (10, 10), (width - 10, height - 10), (0, 0, 0), 2)
+    cv2.imwrite(filepath, image)
+
+class PctDirectoryWatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+        self._filepaths = []
+        for index in range(3):
+            filepath = os.path.join(
+                self._directory,
+                'card{}.jpg'.format(index),
+            )
+            write_card(filepath)
+            self._filepaths.append(filepath)
+        self._now = 0.0
+
+    def tearDown(self):
+        shutil.rmtree(self._directory, ignore_errors=True)
+
+    def clock(self):
+        return self._now
+
+    def settle(self, watcher):
+        # Polls until the changes have been stable for the debounce period
+        self.assertIsNone(watcher.poll())
+        self._now += 10
+        return watcher.poll()
+
+    def load(self):
+        composer = PctComposer(self._filepaths, headless=True)
+        composer.prepare()
+        return composer
+
+    def test_no_changes(self):
+        watcher = PctDirectoryWatcher(self._directory, 1, clock=self.clock)
+        self._now += 10
+        self.assertIsNone(watcher.poll())
+
+    def test_changes_are_debounced(self):
+        watcher = PctDirectoryWatcher(self._directory, 1, clock=self.clock)
+        write_card(os.path.join(self._directory, 'card3.jpg'))
+        self.assertIsNone(watcher.poll())
+        self._now += 0.5
+        self.assertIsNone(watcher.poll())
+        self._now += 1
+        changes = watcher.poll()
+        self.assertEqual(changes.get_added(), [
+            os.path.join(self._directory, 'card3.jpg'),
+        ])
+        self._now += 10
+        self.assertIsNone(watcher.poll())
+
+    def test_changed_before_watch_started(self):
+        composer = self.load()
+        signatures = composer.get_signatures()
+        write_card(self._filepaths[1], value=0, height=160)
+        os.remove(self._filepaths[2])
+        write_card(os.path.join(self._directory, 'card3.jpg'))
+        self.assertEqual(composer.get_signatures(), signatures)
+
+        watcher = PctDirectoryWatcher(
+            self._directory,
+            1,
+            signatures=signatures,
+            clock=self.clock,
+        )
+        changes = self.settle(watcher)
+        self.assertEqual(changes.get_changed(), [self._filepaths[1]])
+        self.assertEqual(changes.get_removed(), [self._filepaths[2]])
+        self.assertEqual(changes.get_added(), [
+            os.path.join(self._directory, 'card3.jpg'),
+        ])
+        composer.cleanup()
+
+    def test_journal_header_is_signed_at_load(self):
+        composer = self.load()
+        header = composer._get_journal_header()
+        write_card(self._filepaths[0], value=0, height=160)
+        self.assertEqual(composer._get_journal_header(), header)
+        composer.cleanup()
+
+if __name__ == '__main__':
+    unittest.main()